@@ -2,16 +2,26 @@ import os
 import logging
 import json
 import time
+_IMPORT_STARTED = time.perf_counter()  # Начало импорта модуля, для отчета о запуске
 import threading
+import functools
+import contextlib
 import random
 import string
 import requests
 from uuid import uuid4
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import re
+import html
 import hashlib
 import base64
 import hmac
+import bisect
+import heapq
+import math
+import struct
 
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 
@@ -35,11 +45,18 @@ LOT_BINDINGS_FILE = os.path.join(DATA_DIR, "lot_bindings.json")
 CONFIG_FILE = os.path.join(DATA_DIR, "config.json")
 TEMPLATES_FILE = os.path.join(DATA_DIR, "message_templates.json")
 
-# Состояния для интерактивного добавления аккаунта
-ADD_ACCOUNT_STATES = {}  # chat_id -> {state: "login|password|type|api_key", data: {}}
-EDIT_TEMPLATE_STATES = {}  # chat_id -> {template_name: "...", editing: True/False}
-ADMIN_ID_STATES = {}  # chat_id -> {setting: True/False}
-ADD_BINDING_STATES = {}  # chat_id -> {state: "name|type|duration", data: {}}
+CONVERSATIONS_FILE = os.path.join(DATA_DIR, "conversations.json")
+LIVE_BOARDS_FILE = os.path.join(DATA_DIR, "live_boards.json")
+OUTBOX_FILE = os.path.join(DATA_DIR, "outbox.json")
+ORDER_INDEX_FILE = os.path.join(DATA_DIR, "order_index.json")
+BACKORDERS_FILE = os.path.join(DATA_DIR, "backorders.json")
+DEMAND_STATS_FILE = os.path.join(DATA_DIR, "demand_stats.json")
+
+# Интерактивные диалоги (хранятся в conversations, см. ConversationStore)
+CONVERSATION_TTL = 30 * 60  # Незавершенный диалог забывается через 30 минут
+CONVERSATION_MAX = 500  # Не больше стольких диалогов одновременно
+# add_account: login|password|type|api_key, add_binding: name|type|duration|edit_type|edit_duration,
+# edit_template: text, return_search: query
 
 # Создаем директории при необходимости
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -51,6 +68,10 @@ CARDINAL = None
 lot_bindings = {}  # lot_id -> {"account_type": "...", "duration_hours": N}
 message_templates = {}  # template_name -> template_text
 admin_id = None  # ID администратора
+DIGEST_MODE = False  # Сводка событий для администратора вместо отдельных сообщений
+DIGEST_WINDOW = 15  # Окно сводки, минут
+ALLOCATION_POLICY = "lru"  # Порядок выдачи свободных аккаунтов, см. ALLOCATION_POLICIES
+REMINDER_MINUTES = [15]  # За сколько минут до окончания аренды напоминать покупателю
 binding_hash_map = {}  # Сопоставление хешей с именами лотов
 
 # Стандартные шаблоны сообщений
@@ -67,6 +88,29 @@ DEFAULT_TEMPLATES = {
                    "• Не меняйте пароль от аккаунта\n"
                    "• Не включайте двухфакторную аутентификацию",
     
+    "rental_start_multi": "🎮 <b>Аренда аккаунтов Steam</b>\n\n"
+                         "{accounts}\n\n"
+                         "🔰 Тип: {account_type}\n"
+                         "⏱ Срок аренды: {duration_hours} ч.\n"
+                         "⌛ Дата окончания: {end_time}\n\n"
+                         "❗ <b>Важно:</b>\n"
+                         "• По истечении срока доступ будет заблокирован\n"
+                         "• Пароли будут изменены\n"
+                         "• Не меняйте пароли от аккаунтов\n"
+                         "• Не включайте двухфакторную аутентификацию",
+    
+    "rental_backorder": "⏳ <b>Все аккаунты сейчас заняты</b>\n\n"
+                       "Ваш заказ #{order_id} в очереди, место: {position}.\n"
+                       "Ожидаемое время выдачи: {eta}\n\n"
+                       "Аккаунт будет выдан автоматически, как только освободится. "
+                       "Отдельно ничего писать не нужно.",
+    
+    "rental_reminder": "⏳ <b>Аренда скоро закончится</b>\n\n"
+                      "👤 Аккаунт: <code>{login}</code>\n"
+                      "⌛ Осталось: {minutes_left} мин. (до {end_time})\n\n"
+                      "Чтобы продлить, оплатите этот лот еще раз - время добавится к текущей аренде, "
+                      "данные для входа не изменятся.",
+    
     "rental_end": "⏰ <b>Аренда аккаунта завершена</b>\n\n"
                  "Срок аренды аккаунта Steam истек. Доступ прекращен, пароль изменен.\n"
                  "Благодарим за использование нашего сервиса!",
@@ -75,6 +119,12 @@ DEFAULT_TEMPLATES = {
                        "Аренда аккаунта Steam была принудительно завершена администратором.\n"
                        "Доступ прекращен, пароль изменен.",
     
+    "rental_extend": "➕ <b>Аренда продлена</b>\n\n"
+                    "👤 Логин: <code>{login}</code>\n"
+                    "⏱ Добавлено: {duration_hours} ч.\n"
+                    "⌛ Новая дата окончания: {end_time}\n\n"
+                    "Данные для входа не изменились, продолжайте пользоваться аккаунтом.",
+    
     "admin_rental_start": "✅ <b>Аккаунт выдан</b>\n\n"
                          "🔹 Заказ: <code>#{order_id}</code>\n"
                          "🔹 Покупатель: <b>{username}</b>\n"
@@ -92,7 +142,1314 @@ DEFAULT_TEMPLATES = {
                        "🔐 Новый пароль: <code>{new_password}</code>"
 }
 
+# Метрики
+METRICS_FILE = os.path.join(DATA_DIR, "metrics.prom")
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+EXPIRY_LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 3600)
+
+class Metrics:
+    """Счетчики, значения и гистограммы для экспорта в формате Prometheus"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.gauges = {}      # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> {"buckets": (...), "counts": [...], "sum": x, "count": n}
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Увеличивает счетчик"""
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """Устанавливает текущее значение"""
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """Добавляет наблюдение в гистограмму"""
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+                self.histograms[key] = hist
+            for i, bound in enumerate(hist["buckets"]):
+                if value <= bound:
+                    hist["counts"][i] += 1
+                    break
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def get_counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def get_gauge(self, name, **labels):
+        with self.lock:
+            return self.gauges.get(self._key(name, labels), 0)
+
+    def counters_by_label(self, name, label):
+        """Возвращает значения счетчика, сгруппированные по одной метке"""
+        result = {}
+        with self.lock:
+            for (counter_name, labels), value in self.counters.items():
+                if counter_name == name:
+                    label_value = dict(labels).get(label, "")
+                    result[label_value] = result.get(label_value, 0) + value
+        return result
+
+    def histogram_stats(self, name, **labels):
+        """Возвращает (count, avg, p95) для гистограммы; p95 — верхняя граница корзины"""
+        with self.lock:
+            hist = self.histograms.get(self._key(name, labels))
+            if not hist or not hist["count"]:
+                return 0, 0.0, 0.0
+            count, total = hist["count"], hist["sum"]
+            threshold = count * 0.95
+            running = 0
+            p95 = float("inf")
+            for bound, bucket_count in zip(hist["buckets"], hist["counts"]):
+                running += bucket_count
+                if running >= threshold:
+                    p95 = bound
+                    break
+            return count, total / count, p95
+
+    def histogram_labels(self, name, label):
+        """Возвращает значения метки, для которых есть данные гистограммы"""
+        with self.lock:
+            return sorted({dict(labels).get(label, "") for hist_name, labels in self.histograms if hist_name == name})
+
+    def render_prometheus(self):
+        """Формирует текст в формате Prometheus exposition"""
+        def fmt_labels(labels, extra=None):
+            items = list(labels) + (extra or [])
+            if not items:
+                return ""
+            escaped = (
+                f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                for k, v in items
+            )
+            return "{" + ",".join(escaped) + "}"
+
+        lines = []
+        with self.lock:
+            lines.append("# TYPE steamrent_uptime_seconds gauge")
+            lines.append(f"steamrent_uptime_seconds {time.time() - self.started_at:.0f}")
+            seen = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{fmt_labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} gauge")
+                    seen.add(name)
+                lines.append(f"{name}{fmt_labels(labels)} {value}")
+            for (name, labels), hist in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                running = 0
+                for bound, bucket_count in zip(hist["buckets"], hist["counts"]):
+                    running += bucket_count
+                    lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {running}")
+                lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{fmt_labels(labels)} {hist['sum']:.6f}")
+                lines.append(f"{name}_count{fmt_labels(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=METRICS_FILE):
+        """Сохраняет метрики в файл для сборщика (node_exporter textfile и т.п.)"""
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp_path, path)
+            return True
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения метрик: {e}")
+            return False
+
+metrics = Metrics()
+
+def write_json_file(path, data):
+    """Атомарно записывает JSON в файл и учитывает время и размер записи в метриках"""
+    started = time.perf_counter()
+    payload = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+    file_name = os.path.basename(path)
+    metrics.observe("steamrent_persist_seconds", time.perf_counter() - started, file=file_name)
+    metrics.set_gauge("steamrent_persist_bytes", len(payload), file=file_name)
+    return len(payload)
+
+# Структурированное логирование
+DEBUG_TARGETS = {"order": set(), "account": set()}  # Заказы и аккаунты с подробным логированием
+_log_sample_counters = {}  # event -> количество вызовов (для выборочного логирования)
+_log_sample_lock = threading.Lock()
+
+class LazyFields:
+    """Поля события, которые форматируются только при реальной записи в лог"""
+    __slots__ = ("fields",)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        parts = []
+        for key, value in self.fields.items():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    value = f"<ошибка: {e}>"
+            parts.append(f"{key}={value}")
+        return " ".join(parts)
+
+def log_event(level, event, sample=1, **fields):
+    """Пишет структурированное событие с ленивым форматированием.
+
+    sample=N пишет только первое и каждое N-е событие с таким именем.
+    Значения-функции вычисляются только если запись действительно попадет в лог.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if sample > 1:
+        with _log_sample_lock:
+            count = _log_sample_counters.get(event, 0)
+            _log_sample_counters[event] = count + 1
+        if count % sample:
+            return
+        fields["sampled"] = f"1/{sample}"
+    logger.log(level, "%s %s %s", LOGGER_PREFIX, event, LazyFields(fields))
+
+def is_debug_target(order_id=None, login=None):
+    """Проверяет, включен ли подробный режим для заказа или аккаунта"""
+    if order_id is not None and str(order_id) in DEBUG_TARGETS["order"]:
+        return True
+    if login is not None and login in DEBUG_TARGETS["account"]:
+        return True
+    return False
+
+def log_debug(event, order_id=None, login=None, **fields):
+    """Отладочное событие: для отмеченных заказов/аккаунтов пишется на уровне INFO"""
+    level = logging.INFO if is_debug_target(order_id, login) else logging.DEBUG
+    if order_id is not None:
+        fields["order"] = order_id
+    if login is not None:
+        fields["account"] = login
+    log_event(level, event, **fields)
+
+# Трассировка выполнения
+TRACE_BUFFER_SIZE = 200  # Сколько последних трасс хранить в памяти
+
+class _NullSpan:
+    """Пустой span, когда трассировка выключена"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record = getattr(self.tracer.local, "current", None)
+        if record is not None:
+            record["spans"].append((self.name, self.started - record["_t0"], time.perf_counter() - self.started))
+        return False
+
+class _Trace:
+    def __init__(self, tracer, kind, key):
+        self.tracer = tracer
+        self.kind = kind
+        self.key = key
+        self.profiler = None
+
+    def __enter__(self):
+        self.record = {
+            "kind": self.kind,
+            "key": str(self.key),
+            "started": time.time(),
+            "duration": 0.0,
+            "spans": [],
+            "profile": None,
+            "error": None,
+            "_t0": time.perf_counter(),
+        }
+        self.tracer.local.current = self.record
+        if self.tracer.profile_rate and random.random() < self.tracer.profile_rate:
+            self.profiler = self.tracer.start_profiler()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record = self.record
+        record["duration"] = time.perf_counter() - record.pop("_t0")
+        if exc is not None:
+            record["error"] = f"{exc_type.__name__}: {exc}"
+        if self.profiler is not None:
+            record["profile"] = self.tracer.stop_profiler(self.profiler)
+        self.tracer.local.current = None
+        with self.tracer.lock:
+            self.tracer.traces.append(record)
+        return False
+
+class Tracer:
+    """Опциональная трассировка этапов обработки заказов и истечений с кольцевым буфером"""
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self.traces = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.enabled = False
+        self.profile_rate = 0.0  # Доля трасс, для которых снимается cProfile
+        self._profiler_lock = threading.Lock()  # cProfile может работать только один за раз
+
+    def trace(self, kind, key):
+        """Начинает трассу; внутри уже идущей трассы работает как обычный span"""
+        if not self.enabled:
+            return _NULL_SPAN
+        if getattr(self.local, "current", None) is not None:
+            return _Span(self, kind)
+        return _Trace(self, kind, key)
+
+    def span(self, name):
+        """Замер этапа внутри текущей трассы"""
+        if not self.enabled or getattr(self.local, "current", None) is None:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def start_profiler(self):
+        if not self._profiler_lock.acquire(blocking=False):
+            return None
+        try:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        except Exception as e:
+            self._profiler_lock.release()
+            logger.warning(f"{LOGGER_PREFIX} Не удалось запустить cProfile: {e}")
+            return None
+
+    def stop_profiler(self, profiler):
+        try:
+            profiler.disable()
+            import io
+            import pstats
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(15)
+            return stream.getvalue()[:3000]
+        except Exception as e:
+            return f"Ошибка профилирования: {e}"
+        finally:
+            self._profiler_lock.release()
+
+    def slowest(self, count=5):
+        with self.lock:
+            traces = list(self.traces)
+        return sorted(traces, key=lambda record: record["duration"], reverse=True)[:count]
+
+tracer = Tracer()
+
+# Ленивая инициализация
+STATE_READY = threading.Event()  # Устанавливается, когда данные загружены
+STATE_SETTLED = threading.Event()  # Загрузка закончилась: успешно или с ошибкой
+CONVERSATIONS_READY = threading.Event()  # Диалоги загружены: текстовый обработчик знает, чьи сообщения его
+STATE_LOAD_ERROR = None  # Ошибка загрузки: обработчики и сохранение отключены до перезапуска
+STATE_WAIT_TIMEOUT = 30  # Сколько обработчик ждет загрузки данных, секунд
+STARTUP_TIMINGS = {}  # phase -> секунды
+_state_loader_lock = threading.Lock()
+_state_loader_started = False
+_rsa_backend = None
+
+def record_startup_timing(phase, seconds):
+    """Запоминает длительность этапа запуска"""
+    STARTUP_TIMINGS[phase] = seconds
+    metrics.set_gauge("steamrent_startup_seconds", round(seconds, 4), phase=phase)
+
+def get_rsa_backend():
+    """Возвращает классы RSA из Crypto, импортируя их один раз"""
+    global _rsa_backend
+    if _rsa_backend is None:
+        started = time.perf_counter()
+        from Crypto.PublicKey import RSA
+        from Crypto.Cipher import PKCS1_v1_5
+        _rsa_backend = (RSA, PKCS1_v1_5)
+        record_startup_timing("crypto_import", time.perf_counter() - started)
+    return _rsa_backend
+
+def start_state_loading():
+    """Запускает фоновую загрузку данных, если она еще не запущена"""
+    global _state_loader_started
+    with _state_loader_lock:
+        if _state_loader_started:
+            return
+        _state_loader_started = True
+    threading.Thread(target=load_state_background, daemon=True).start()
+
+def load_state_background():
+    """Загружает аккаунты, аренды и привязки лотов вне потока запуска Cardinal"""
+    global STATE_LOAD_ERROR
+    started = time.perf_counter()
+    repairs, expired, queued = [], 0, 0
+    try:
+        # Диалоги первыми: по ним текстовый обработчик решает, ждать ли остальные данные
+        conversations.load()
+        CONVERSATIONS_READY.set()
+        rental_manager.load_data()
+        load_lot_bindings()
+        live_board.load()
+        funpay_delivery.load()
+        backorders.load()
+        
+        # Сверяем данные до того, как обработчики начнут с ними работать
+        reconcile_started = time.perf_counter()
+        repairs, expired = rental_manager.reconcile()
+        queued = len(rental_manager.rotation_queue)
+        reminders.rebuild()
+        demand.load()
+        record_startup_timing("reconcile", time.perf_counter() - reconcile_started)
+    except Exception as e:
+        # Без данных обработчики не запускаем: первое же сохранение затерло бы файлы пустым состоянием
+        STATE_LOAD_ERROR = str(e) or type(e).__name__
+        logger.error(f"{LOGGER_PREFIX} Ошибка фоновой загрузки данных, плагин переходит в аварийный режим: {e}")
+        notify_admin(
+            f"🚨 <b>Данные аренды не загрузились</b>\n\n"
+            f"Ошибка: <code>{STATE_LOAD_ERROR}</code>\n\n"
+            f"Заказы не обрабатываются, файлы данных не перезаписываются. "
+            f"Исправьте файлы в папке плагина и перезапустите Cardinal."
+        )
+        return
+    else:
+        STATE_READY.set()
+    finally:
+        record_startup_timing("state_load", time.perf_counter() - started)
+        CONVERSATIONS_READY.set()
+        STATE_SETTLED.set()
+    logger.info(f"{LOGGER_PREFIX} Данные загружены за {STARTUP_TIMINGS['state_load']:.2f} с: "
+                f"{len(rental_manager.accounts)} аккаунтов, {len(rental_manager.rentals)} аренд, "
+                f"{len(lot_bindings)} привязок")
+    
+    if repairs or expired:
+        report_reconcile(repairs, expired, queued)
+
+    # Прогреваем Crypto заранее, чтобы первая смена пароля не платила за импорт
+    try:
+        get_rsa_backend()
+    except ImportError as e:
+        logger.warning(f"{LOGGER_PREFIX} Библиотека Crypto недоступна, смена пароля через API не будет работать: {e}")
+
+def get_admin_chat_id():
+    """Возвращает чат администратора: из настроек плагина или из настроек Cardinal"""
+    if admin_id:
+        return admin_id
+    try:
+        return CARDINAL.MAIN_CFG["telegram"]["admin_id"]
+    except Exception:
+        return None
+
+def report_reconcile(repairs, expired, queued):
+    """Сообщает администратору об исправлениях, сделанных при запуске"""
+    for repair in repairs:
+        logger.warning(f"{LOGGER_PREFIX} Восстановление: {repair}")
+    
+    text = "🛠 <b>Восстановление после перезапуска</b>\n\n"
+    if expired:
+        text += f"⏰ Завершено аренд, истекших во время простоя: <b>{expired}</b>\n"
+    if queued:
+        text += f"🔑 Поставлено в очередь на смену пароля: <b>{queued}</b>\n"
+    if repairs:
+        text += f"\n🔧 <b>Исправлено ({len(repairs)}):</b>\n"
+        for repair in repairs[:20]:
+            text += f"• {repair}\n"
+        if len(repairs) > 20:
+            text += f"... и еще {len(repairs) - 20}\n"
+    notify_admin(text)
+
+def wait_until_ready(timeout=STATE_WAIT_TIMEOUT):
+    """Ждет загрузки данных; возвращает False, если не дождались или загрузка не удалась"""
+    if STATE_READY.is_set():
+        return True
+    start_state_loading()
+    STATE_SETTLED.wait(timeout)
+    return STATE_READY.is_set()
+
+def requires_state(handler):
+    """Оборачивает Telegram-обработчик: сначала дожидается загрузки данных"""
+    @functools.wraps(handler)
+    def wrapper(message, *args, **kwargs):
+        if not wait_until_ready():
+            if STATE_LOAD_ERROR:
+                text = "❌ Данные не загрузились, плагин в аварийном режиме. Подробности отправлены администратору"
+            else:
+                text = "⏳ Данные еще загружаются, повторите команду через несколько секунд"
+            try:
+                CARDINAL.telegram.bot.reply_to(message, text)
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка отправки сообщения о загрузке: {e}")
+            return None
+        return handler(message, *args, **kwargs)
+    return wrapper
+
+def has_conversation(message):
+    """Фильтр общего текстового обработчика: у чата есть диалог плагина, остальной текст уходит другим плагинам.
+    Фильтр выполняется в потоке опроса бота, поэтому загрузку диалогов не ждет: до нее текст не наш"""
+    if not CONVERSATIONS_READY.is_set():
+        start_state_loading()
+        return False
+    return conversations.get(message.chat.id) is not None
+
+# Исходящие уведомления Telegram
+NOTIFY_CHAT_INTERVAL = 1.0  # Telegram: не больше одного сообщения в секунду в один чат
+NOTIFY_GLOBAL_RATE = 25  # и не больше ~30 сообщений в секунду от бота
+NOTIFY_QUEUE_MAX = 500  # При переполнении отбрасываются самые старые уведомления
+NOTIFY_DIGEST_MAX = 10  # Сколько ожидающих уведомлений чата объединять в одно сообщение
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_MESSAGE_LIMIT = 4096
+NOTIFY_DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+RETRY_AFTER_RE = re.compile(r"retry after (\d+)", re.IGNORECASE)
+
+def get_retry_after(error):
+    """Возвращает retry_after из ответа 429 Telegram или None"""
+    result = getattr(error, "result_json", None)
+    if isinstance(result, dict):
+        retry_after = (result.get("parameters") or {}).get("retry_after")
+        if retry_after:
+            return float(retry_after)
+    match = RETRY_AFTER_RE.search(str(error))
+    return float(match.group(1)) if match else None
+
+def truncate_lines(text, limit=3900, suffix="..."):
+    """Обрезает HTML-текст по целым строкам: обрезка посреди строки может разорвать тег, и Telegram отклонит сообщение"""
+    if len(text) <= limit:
+        return text
+    cut = text.rfind("\n", 0, limit - len(suffix))
+    return (text[:cut].rstrip("\n") + "\n" if cut > 0 else "") + suffix
+
+def split_lines(text, limit=3900):
+    """Делит HTML-текст на сообщения не длиннее limit по целым строкам; слишком длинная строка обрезается"""
+    parts, current = [], ""
+    for line in text.split("\n"):
+        line = truncate_lines(line, limit)
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current.strip():
+        parts.append(current)
+    return parts
+
+class TelegramNotifier:
+    """Очередь уведомлений с лимитами Telegram, учетом retry_after и объединением в сводки"""
+    
+    def __init__(self, chat_interval=NOTIFY_CHAT_INTERVAL, global_rate=NOTIFY_GLOBAL_RATE,
+                 queue_max=NOTIFY_QUEUE_MAX, digest_max=NOTIFY_DIGEST_MAX):
+        self.chat_interval = chat_interval
+        self.global_rate = global_rate
+        self.queue_max = queue_max
+        self.digest_max = digest_max
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()  # chat_id -> deque уведомлений, чаты обслуживаются по кругу
+        self.next_allowed = {}  # chat_id -> время (monotonic), раньше которого в чат не пишем
+        self.recent = deque()  # Время последних отправок для общего лимита
+        self.paused_until = 0.0  # Пауза после 429
+        self.size = 0
+        self.thread = None
+    
+    def send(self, chat_id, text, parse_mode="HTML", **kwargs):
+        """Ставит сообщение в очередь и сразу возвращается"""
+        entry = {"text": text, "parse_mode": parse_mode, "kwargs": kwargs,
+                 "queued": time.monotonic(), "attempts": 0}
+        with self.cond:
+            if self.size >= self.queue_max:
+                self._drop_oldest()
+            self.queues.setdefault(chat_id, deque()).append(entry)
+            self.size += 1
+            metrics.set_gauge("steamrent_notification_queue_depth", self.size)
+            self.cond.notify()
+        self.start()
+    
+    def _drop_oldest(self):
+        chat_id = min(self.queues, key=lambda chat: self.queues[chat][0]["queued"])
+        self.queues[chat_id].popleft()
+        if not self.queues[chat_id]:
+            del self.queues[chat_id]
+        self.size -= 1
+        metrics.inc("steamrent_telegram_dropped_total", reason="overflow")
+        logger.warning(f"{LOGGER_PREFIX} Очередь уведомлений переполнена, самое старое уведомление отброшено")
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                chat_id, batch, wait = self._take()
+                if batch is None:
+                    self.cond.wait(wait)
+                    continue
+            self._deliver(chat_id, batch)
+    
+    def _take(self):
+        """Выбирает чат, в который можно писать сейчас; возвращает (chat_id, пачка, None) или (None, None, ожидание)"""
+        if not self.size:
+            return None, None, None
+        now = time.monotonic()
+        if now < self.paused_until:
+            return None, None, self.paused_until - now
+        while self.recent and self.recent[0] <= now - 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.global_rate:
+            return None, None, self.recent[0] + 1 - now
+        
+        ready = next((chat for chat in self.queues if self.next_allowed.get(chat, 0) <= now), None)
+        if ready is None:
+            return None, None, min(self.next_allowed[chat] for chat in self.queues) - now
+        
+        # Обычные HTML-уведомления одного чата сводим в одно сообщение, с клавиатурой - отправляем отдельно
+        queue = self.queues.pop(ready)
+        batch = [queue.popleft()]
+        length = len(batch[0]["text"])
+        while (queue and len(batch) < self.digest_max and self._mergeable(batch[0]) and self._mergeable(queue[0])
+               and length + len(queue[0]["text"]) + len(NOTIFY_DIGEST_SEPARATOR) + 100 <= NOTIFY_MESSAGE_LIMIT):
+            length += len(queue[0]["text"]) + len(NOTIFY_DIGEST_SEPARATOR)
+            batch.append(queue.popleft())
+        if queue:
+            self.queues[ready] = queue  # В конец круга
+        
+        self.size -= len(batch)
+        self.next_allowed[ready] = now + self.chat_interval
+        self.recent.append(now)
+        metrics.set_gauge("steamrent_notification_queue_depth", self.size)
+        return ready, batch, None
+    
+    @staticmethod
+    def _mergeable(entry):
+        return entry["parse_mode"] == "HTML" and not entry["kwargs"]
+    
+    def _deliver(self, chat_id, batch):
+        first = batch[0]
+        if len(batch) == 1:
+            text = first["text"]
+        else:
+            text = f"📬 <b>Сводка уведомлений ({len(batch)})</b>\n\n" + NOTIFY_DIGEST_SEPARATOR.join(entry["text"] for entry in batch)
+        
+        try:
+            with tracer.span("telegram_notify"):
+                CARDINAL.telegram.bot.send_message(chat_id, text, parse_mode=first["parse_mode"], **first["kwargs"])
+        except Exception as e:
+            self._failed(chat_id, batch, e)
+            return
+        
+        now = time.monotonic()
+        metrics.inc("steamrent_telegram_sent_total")
+        if len(batch) > 1:
+            metrics.inc("steamrent_telegram_merged_total", len(batch) - 1)
+        for entry in batch:
+            metrics.observe("steamrent_notification_delay_seconds", now - entry["queued"])
+    
+    def _failed(self, chat_id, batch, error):
+        """Возвращает пачку в начало очереди чата или отбрасывает после исчерпания попыток"""
+        now = time.monotonic()
+        retry_after = get_retry_after(error)
+        if retry_after:
+            # 429 не тратит попытку: ждем, сколько просит Telegram
+            logger.warning(f"{LOGGER_PREFIX} Telegram ограничил отправку, пауза {retry_after:.0f} с")
+            metrics.inc("steamrent_telegram_delayed_total", len(batch), reason="flood")
+            retry = batch
+        else:
+            logger.error(f"{LOGGER_PREFIX} Ошибка отправки уведомления в чат {chat_id}: {error}")
+            retry = []
+            for entry in batch:
+                entry["attempts"] += 1
+                if entry["attempts"] < NOTIFY_MAX_ATTEMPTS:
+                    retry.append(entry)
+                else:
+                    metrics.inc("steamrent_telegram_dropped_total", reason="error")
+            if retry:
+                metrics.inc("steamrent_telegram_delayed_total", len(retry), reason="error")
+        
+        with self.cond:
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            elif retry:
+                self.next_allowed[chat_id] = now + 2 ** retry[0]["attempts"]
+            if retry:
+                queue = self.queues.setdefault(chat_id, deque())
+                queue.extendleft(reversed(retry))
+                self.size += len(retry)
+                metrics.set_gauge("steamrent_notification_queue_depth", self.size)
+            self.cond.notify()
+
+notifier = TelegramNotifier()
+
+def notify_admin(text, **kwargs):
+    """Отправляет уведомление администратору через очередь; False, если администратор неизвестен"""
+    chat_id = get_admin_chat_id()
+    if not chat_id or not CARDINAL:
+        return False
+    notifier.send(chat_id, text, **kwargs)
+    return True
+
+# Сводка событий для администратора
+DIGEST_KINDS = {
+    "issued": "✅ Выдано",
+    "extended": "➕ Продлено",
+    "backorder": "⏳ В очереди",
+    "expired": "⏰ Завершено",
+    "failed": "❌ Ошибки",
+    "low_stock": "⚠️ Мало аккаунтов",
+}
+DIGEST_DETAIL_LINES = 15  # Строк подробностей на каждый вид событий
+
+class AdminDigest:
+    """Копит события за окно DIGEST_WINDOW и отправляет их одной сводкой"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}  # вид -> [строки]
+        self.started = None
+    
+    def add(self, kind, line, text, critical=False):
+        """Учитывает событие; без режима сводки и для критичных событий text уходит сразу"""
+        if critical or not DIGEST_MODE:
+            notify_admin(text)
+        if not DIGEST_MODE:
+            return
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+            self.events.setdefault(kind, []).append(line)
+        metrics.inc("steamrent_digest_events_total", kind=kind)
+    
+    def flush(self, force=False):
+        """Отправляет сводку, если окно истекло (или force); возвращает True, если сводка отправлена"""
+        with self.lock:
+            if not self.events or (not force and time.time() - self.started < DIGEST_WINDOW * 60):
+                return False
+            events, started = self.events, self.started
+            self.events, self.started = {}, None
+        
+        minutes = max(1, round((time.time() - started) / 60))
+        text = f"📊 <b>Сводка за {minutes} мин.</b>\n\n"
+        for kind, title in DIGEST_KINDS.items():
+            if kind in events:
+                text += f"{title}: <b>{len(events[kind])}</b>\n"
+        for kind, title in DIGEST_KINDS.items():
+            lines = events.get(kind)
+            if not lines:
+                continue
+            text += f"\n<b>{title}</b>\n"
+            text += "\n".join(f"• {line}" for line in lines[:DIGEST_DETAIL_LINES]) + "\n"
+            if len(lines) > DIGEST_DETAIL_LINES:
+                text += f"... и еще {len(lines) - DIGEST_DETAIL_LINES}\n"
+        # Сводка по всем видам событий может не поместиться в одно сообщение Telegram
+        for part in split_lines(text):
+            notify_admin(part)
+        metrics.inc("steamrent_digests_sent_total")
+        return True
+
+admin_digest = AdminDigest()
+
+# Доставка сообщений покупателям FunPay
+FUNPAY_COALESCE_DELAY = 2.0  # Сколько ждать перед отправкой из очереди, чтобы объединить сообщения одному покупателю
+FUNPAY_MAX_ATTEMPTS = 8
+FUNPAY_RETRY_MAX_DELAY = 600  # Предел экспоненциальной паузы между попытками, секунд
+FUNPAY_MESSAGE_LIMIT = 2000
+FUNPAY_CHAT_CACHE_MAX = 1000
+
+class FunPayDelivery:
+    """Отправка сообщений покупателям: кеш чатов, подтверждение доставки и надежная очередь повторов"""
+    
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.chats = OrderedDict()  # user_id -> (chat_id, chat_name), последние использованные в конце
+        self.outbox = []  # [{id, user_id, username, text, kind, attempts, next_attempt}]
+        self.wakeup = threading.Event()
+        self.thread = None
+    
+    def remember_chat(self, user_id, chat_id, chat_name=None):
+        """Запоминает настоящий чат покупателя (из входящих сообщений)"""
+        if not user_id or not chat_id:
+            return
+        with self.lock:
+            self.chats.pop(user_id, None)
+            self.chats[user_id] = (chat_id, chat_name)
+            while len(self.chats) > FUNPAY_CHAT_CACHE_MAX:
+                self.chats.popitem(last=False)
+    
+    def resolve_chat(self, user_id, username):
+        """Возвращает (chat_id, chat_name): из кеша, через Cardinal или адрес личного чата"""
+        with self.lock:
+            cached = self.chats.get(user_id)
+        if cached:
+            metrics.inc("steamrent_funpay_chat_cache_total", result="hit")
+            return cached
+        metrics.inc("steamrent_funpay_chat_cache_total", result="miss")
+        
+        chat_id, chat_name = None, username
+        if username and hasattr(CARDINAL.account, "get_chat_by_name"):
+            try:
+                chat = CARDINAL.account.get_chat_by_name(username, True)
+                if chat:
+                    chat_id, chat_name = chat.id, chat.name
+            except Exception as e:
+                logger.debug(f"{LOGGER_PREFIX} Чат {username} не найден через Cardinal: {e}")
+        if chat_id is None:
+            chat_id = f"users-{user_id}-{CARDINAL.account.id}"
+        self.remember_chat(user_id, chat_id, chat_name)
+        return chat_id, chat_name
+    
+    def _send_now(self, user_id, username, text):
+        """Одна попытка отправки; возвращает None при подтвержденной доставке или текст ошибки"""
+        if not CARDINAL or not hasattr(CARDINAL, "account") or not hasattr(CARDINAL.account, "send_message"):
+            return "методы отправки недоступны"
+        chat_id, chat_name = self.resolve_chat(user_id, username)
+        try:
+            with tracer.span("funpay_send"):
+                result = CARDINAL.account.send_message(chat_id, text, chat_name=chat_name, interlocutor_id=user_id,
+                                                       image_id=None, add_to_ignore_list=True,
+                                                       update_last_saved_message=False, leave_as_unread=False)
+        except Exception as e:
+            # Возможно, чат в кеше устарел - в следующий раз определяем заново
+            with self.lock:
+                self.chats.pop(user_id, None)
+            return str(e) or e.__class__.__name__
+        if result is None:
+            return "FunPay не подтвердил отправку"
+        return None
+    
+    def send(self, user_id, username, text, kind="message"):
+        """Отправляет сразу; при неудаче ставит в очередь повторов. Возвращает (доставлено, ошибка)"""
+        error = self._send_now(user_id, username, text)
+        if error is None:
+            metrics.inc("steamrent_funpay_sent_total", kind=kind)
+            return True, None
+        logger.error(f"{LOGGER_PREFIX} Сообщение покупателю {username} не доставлено ({kind}): {error}")
+        self._enqueue(user_id, username, text, kind, attempts=1)
+        return False, error
+    
+    def enqueue(self, user_id, username, text, kind="message"):
+        """Ставит сообщение в очередь; сообщения одному покупателю за FUNPAY_COALESCE_DELAY уходят одним"""
+        self._enqueue(user_id, username, text, kind)
+    
+    def _enqueue(self, user_id, username, text, kind, attempts=0):
+        delay = FUNPAY_COALESCE_DELAY if not attempts else self.retry_delay(attempts)
+        with self.lock:
+            self.outbox.append({"id": uuid4().hex[:12], "user_id": user_id, "username": username, "text": text,
+                                "kind": kind, "attempts": attempts, "next_attempt": time.time() + delay})
+            self.save()
+        self.start()
+        self.wakeup.set()
+    
+    @staticmethod
+    def retry_delay(attempts):
+        return min(FUNPAY_RETRY_MAX_DELAY, 5 * 2 ** attempts)
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        STATE_READY.wait()
+        while True:
+            with self.lock:
+                due = min((entry["next_attempt"] for entry in self.outbox), default=None)
+            # Без сообщений в очереди поток спит до следующего enqueue
+            timeout = None if due is None else max(0.0, due - time.time())
+            if self.wakeup.wait(timeout):
+                self.wakeup.clear()
+                continue
+            try:
+                self.process_outbox()
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка обработки очереди сообщений FunPay: {e}")
+    
+    def process_outbox(self):
+        """Отправляет наступившие сообщения, объединяя их по покупателям"""
+        now = time.time()
+        with self.lock:
+            # Покупателю с наступившим сообщением отправляем и остальные его сообщения из очереди
+            due_users = {entry["user_id"] for entry in self.outbox if entry["next_attempt"] <= now}
+            groups = OrderedDict()
+            for entry in self.outbox:
+                if entry["user_id"] in due_users:
+                    groups.setdefault(entry["user_id"], []).append(entry)
+        
+        for user_id, entries in groups.items():
+            # Объединяем, пока укладываемся в лимит длины сообщения FunPay
+            batch, length = [], 0
+            for entry in entries:
+                if batch and length + len(entry["text"]) + 2 > FUNPAY_MESSAGE_LIMIT:
+                    break
+                batch.append(entry)
+                length += len(entry["text"]) + 2
+            
+            error = self._send_now(user_id, batch[0]["username"], "\n\n".join(entry["text"] for entry in batch))
+            with self.lock:
+                if error is None:
+                    sent_ids = {entry["id"] for entry in batch}
+                    self.outbox = [entry for entry in self.outbox if entry["id"] not in sent_ids]
+                    for entry in batch:
+                        metrics.inc("steamrent_funpay_sent_total", kind=entry["kind"])
+                    if len(batch) > 1:
+                        metrics.inc("steamrent_funpay_coalesced_total", len(batch) - 1)
+                else:
+                    self._retry_later(batch, error)
+                self.save()
+    
+    def _retry_later(self, batch, error):
+        dropped = []
+        for entry in batch:
+            entry["attempts"] += 1
+            entry["next_attempt"] = time.time() + self.retry_delay(entry["attempts"])
+            if entry["attempts"] >= FUNPAY_MAX_ATTEMPTS:
+                dropped.append(entry)
+        metrics.inc("steamrent_funpay_failed_total", len(batch))
+        logger.warning(f"{LOGGER_PREFIX} Сообщение покупателю {batch[0]['username']} не доставлено, "
+                       f"попытка {batch[0]['attempts']}: {error}")
+        for entry in dropped:
+            self.outbox.remove(entry)
+            metrics.inc("steamrent_funpay_dropped_total", kind=entry["kind"])
+            admin_digest.add(
+                "failed",
+                f"{entry['username']}: сообщение ({entry['kind']}) не доставлено",
+                f"⚠️ <b>Сообщение покупателю не доставлено</b>\n\n"
+                f"Покупатель: <b>{entry['username']}</b>\n"
+                f"Попыток: {entry['attempts']}\n"
+                f"<b>Ошибка:</b> {error}\n\n"
+                f"<code>{entry['text'][:500]}</code>"
+            )
+    
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    stored = json.load(f)
+                with self.lock:
+                    self.outbox = stored
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка загрузки очереди сообщений FunPay: {e}")
+        if self.outbox:
+            logger.info(f"{LOGGER_PREFIX} В очереди сообщений FunPay: {len(self.outbox)}")
+            self.start()
+            self.wakeup.set()
+    
+    def save(self):
+        metrics.set_gauge("steamrent_funpay_outbox_depth", len(self.outbox))
+        if not self.path:
+            return
+        try:
+            with self.lock:
+                write_json_file(self.path, self.outbox)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения очереди сообщений FunPay: {e}")
+
+funpay_delivery = FunPayDelivery(OUTBOX_FILE)
+
+# Маршрутизация кнопок
+class CallbackRouter:
+    """Таблица callback-действий: точные коды и префиксы с параметром"""
+    
+    def __init__(self, namespace="srent_"):
+        self.namespace = namespace
+        self.exact = {}     # action -> handler(call)
+        self.prefixes = {}  # action -> handler(call, param), совпадает по границе "_"
+    
+    def add(self, action, handler, prefix=False):
+        """Регистрирует действие; для prefix=True остаток callback data передается параметром"""
+        (self.prefixes if prefix else self.exact)[action] = handler
+    
+    def resolve(self, data):
+        """Возвращает (маршрут, обработчик, параметр) или (None, None, None)"""
+        if not data.startswith(self.namespace):
+            return None, None, None
+        action = data[len(self.namespace):]
+        
+        handler = self.exact.get(action)
+        if handler:
+            return action, handler, None
+        
+        # Самый длинный префикс выигрывает, поэтому порядок регистрации не важен
+        end = len(action)
+        while True:
+            end = action.rfind("_", 0, end)
+            if end < 0:
+                return None, None, None
+            handler = self.prefixes.get(action[:end])
+            if handler:
+                return action[:end], handler, action[end + 1:]
+    
+    def dispatch(self, call):
+        """Вызывает обработчик для call.data; возвращает False, если маршрут не найден"""
+        route, handler, param = self.resolve(call.data)
+        if handler is None:
+            metrics.inc("steamrent_callbacks_total", route="unknown")
+            CARDINAL.telegram.bot.answer_callback_query(call.id, "Неизвестное действие")
+            return False
+        
+        metrics.inc("steamrent_callbacks_total", route=route)
+        started = time.perf_counter()
+        try:
+            if param is None:
+                handler(call)
+            else:
+                handler(call, param)
+        finally:
+            metrics.observe("steamrent_callback_seconds", time.perf_counter() - started, route=route)
+            # Другие обработчики могли перерисовать сообщение - хеш кешированного экрана больше не верен
+            if route not in render_cache.views:
+                render_cache.forget(call.message.chat.id, call.message.message_id)
+        return True
+
+callback_router = CallbackRouter()
+
+class CallbackTokens:
+    """Короткие стабильные токены для значений в callback data (лимит Telegram - 64 байта)"""
+    
+    def __init__(self, length=10):
+        self.length = length
+        self.values = {}  # token -> value
+    
+    def token(self, value):
+        token = hashlib.md5(str(value).encode("utf-8")).hexdigest()[:self.length]
+        self.values[token] = value
+        return token
+    
+    def resolve(self, token, candidates=()):
+        """Возвращает значение по токену; после перезапуска ищет его среди candidates"""
+        if token not in self.values:
+            for value in candidates:
+                self.token(value)
+        return self.values.get(token)
+
+account_tokens = CallbackTokens()
+
+# Кеш отрисованных экранов меню
+BINDINGS_VERSION = 0  # Растет при каждом изменении привязок лотов
+RENDER_SENT_MAX = 1000  # Сколько сообщений помнить для пропуска повторных редактирований
+
+def view_state_version():
+    """Версия состояния, от которой зависят экраны меню"""
+    return (rental_manager.version, BINDINGS_VERSION, RUNNING)
+
+class RenderCache:
+    """Готовые экраны (текст, клавиатура) по версии состояния и хеши последнего содержимого сообщений"""
+    
+    def __init__(self, sent_max=RENDER_SENT_MAX):
+        self.lock = threading.Lock()
+        self.views = {}  # маршрут экрана -> (ключ, текст, клавиатура)
+        self.sent = OrderedDict()  # (chat_id, message_id) -> хеш показанного содержимого
+        self.sent_max = sent_max
+    
+    def render(self, view, builder, ticking=False):
+        """Возвращает экран из кеша или строит его заново; ticking - экран с обратным отсчетом (обновляется раз в минуту)"""
+        key = (view_state_version(), int(time.time() // 60) if ticking else None)
+        with self.lock:
+            cached = self.views.get(view)
+        if cached and cached[0] == key:
+            metrics.inc("steamrent_render_cache_total", view=view, result="hit")
+            return cached[1], cached[2]
+        
+        metrics.inc("steamrent_render_cache_total", view=view, result="miss")
+        with tracer.span(f"render_{view}"):
+            text, markup = builder()
+        with self.lock:
+            self.views[view] = (key, text, markup)
+        return text, markup
+    
+    @staticmethod
+    def content_hash(text, markup):
+        payload = text + "\0" + (markup.to_json() if markup else "")
+        return hashlib.md5(payload.encode("utf-8")).hexdigest()
+    
+    def is_shown(self, chat_id, message_id, digest):
+        with self.lock:
+            return self.sent.get((chat_id, message_id)) == digest
+    
+    def remember(self, chat_id, message_id, digest):
+        with self.lock:
+            self.sent.pop((chat_id, message_id), None)
+            self.sent[(chat_id, message_id)] = digest
+            while len(self.sent) > self.sent_max:
+                self.sent.popitem(last=False)
+    
+    def forget(self, chat_id, message_id):
+        with self.lock:
+            self.sent.pop((chat_id, message_id), None)
+
+render_cache = RenderCache()
+
+def edit_cached_view(call, view, builder, answer, ticking=False):
+    """Показывает экран из кеша; не редактирует сообщение, если на нем уже это содержимое"""
+    text, markup = render_cache.render(view, builder, ticking)
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    digest = render_cache.content_hash(text, markup)
+    
+    if render_cache.is_shown(chat_id, message_id, digest):
+        metrics.inc("steamrent_render_edits_skipped_total", view=view)
+        CARDINAL.telegram.bot.answer_callback_query(call.id, f"{answer} - актуально")
+        return False
+    
+    try:
+        CARDINAL.telegram.bot.edit_message_text(
+            text,
+            chat_id,
+            message_id,
+            reply_markup=markup,
+            parse_mode="HTML"
+        )
+    except Exception as edit_error:
+        # Сообщение изменили вне кеша, но содержимое совпало
+        if "message is not modified" not in str(edit_error):
+            raise
+    render_cache.remember(chat_id, message_id, digest)
+    CARDINAL.telegram.bot.answer_callback_query(call.id, answer)
+    return True
+
+# Состояния интерактивных диалогов
+class ConversationStore:
+    """Один диалог на чат: тип, шаг и данные, с TTL, ограничением размера и сохранением в файл"""
+    
+    def __init__(self, path=None, ttl=CONVERSATION_TTL, max_size=CONVERSATION_MAX):
+        self.path = path  # None - только в памяти
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # chat_id -> {kind, state, data, updated}, от старых к новым
+    
+    def start(self, chat_id, kind, state, data=None):
+        """Начинает диалог, заменяя предыдущий диалог этого чата"""
+        with self.lock:
+            self.entries.pop(chat_id, None)
+            self.entries[chat_id] = {"kind": kind, "state": state, "data": data or {}, "updated": time.time()}
+            # Вытесняем самые старые диалоги сверх лимита
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                metrics.inc("steamrent_conversations_evicted_total", reason="size")
+            entry = self.entries[chat_id]
+        self.save()
+        return entry
+    
+    def get(self, chat_id, kind=None):
+        """Возвращает диалог чата (если указан kind - только такого типа) или None"""
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry and time.time() - entry["updated"] > self.ttl:
+                del self.entries[chat_id]
+                metrics.inc("steamrent_conversations_evicted_total", reason="ttl")
+                entry = None
+        if entry is None or (kind and entry["kind"] != kind):
+            return None
+        return entry
+    
+    def set_state(self, chat_id, state):
+        """Переводит диалог на следующий шаг и сохраняет накопленные данные"""
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is None:
+                return
+            entry["state"] = state
+            entry["updated"] = time.time()
+            self.entries.move_to_end(chat_id)
+        self.save()
+    
+    def take(self, chat_id, kind=None, state=None):
+        """Завершает и возвращает непросроченный диалог чата, если совпадают kind и state; иначе None"""
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if (entry is None or time.time() - entry["updated"] > self.ttl
+                    or (kind and entry["kind"] != kind) or (state and entry["state"] != state)):
+                return None
+            del self.entries[chat_id]
+        self.save()
+        return entry
+    
+    def finish(self, chat_id, kind=None):
+        """Завершает диалог чата (если указан kind - только такого типа)"""
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is None or (kind and entry["kind"] != kind):
+                return
+            del self.entries[chat_id]
+        self.save()
+    
+    def evict_expired(self):
+        """Удаляет просроченные диалоги, возвращает их количество"""
+        deadline = time.time() - self.ttl
+        with self.lock:
+            expired = [chat_id for chat_id, entry in self.entries.items() if entry["updated"] < deadline]
+            for chat_id in expired:
+                del self.entries[chat_id]
+        if expired:
+            metrics.inc("steamrent_conversations_evicted_total", len(expired), reason="ttl")
+            self.save()
+        return len(expired)
+    
+    def load(self):
+        """Загружает незавершенные диалоги после перезапуска"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            with self.lock:
+                self.entries = OrderedDict(
+                    (int(chat_id), entry)
+                    for chat_id, entry in sorted(stored.items(), key=lambda item: item[1]["updated"])
+                )
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка загрузки диалогов: {e}")
+        self.evict_expired()
+    
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with self.lock:
+                snapshot = {str(chat_id): entry for chat_id, entry in self.entries.items()}
+            write_json_file(self.path, snapshot)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения диалогов: {e}")
+
+conversations = ConversationStore(CONVERSATIONS_FILE)
+CONVERSATION_HANDLERS = {}  # kind -> handler(message, conversation), заполняется в init_plugin
+
+def steam_request(endpoint, url, session=None, **kwargs):
+    """Выполняет POST-запрос к Steam, учитывая задержку и ошибки по endpoint"""
+    kwargs.setdefault("timeout", 15)
+    started = time.perf_counter()
+    try:
+        response = (session or requests).post(url, **kwargs)
+    except Exception:
+        metrics.inc("steamrent_steam_requests_total", endpoint=endpoint, outcome="error")
+        raise
+    finally:
+        metrics.observe("steamrent_steam_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+    metrics.inc("steamrent_steam_requests_total", endpoint=endpoint, outcome="ok" if response.ok else "error")
+    return response
+
+# Коды Steam Guard для аккаунтов с мобильным аутентификатором
+STEAM_GUARD_CHARS = "23456789BCDFGHJKMNPQRTVWXY"
+STEAM_GUARD_PERIOD = 30  # Код меняется каждые 30 секунд
+STEAM_TIME_URL = "https://api.steampowered.com/ITwoFactorService/QueryTime/v0001"
+STEAM_TIME_SYNC_INTERVAL = 3600  # Как часто сверяем время с сервером Steam
+STEAM_TIME_RETRY_INTERVAL = 300  # Повтор сверки после ошибки
+
+def decode_shared_secret(shared_secret):
+    """Ключ аутентификатора из base64; ValueError, если это не 20-байтный секрет"""
+    try:
+        key = base64.b64decode(shared_secret, validate=True)
+    except Exception:
+        raise ValueError("shared_secret должен быть в base64")
+    if len(key) != 20:
+        raise ValueError("shared_secret должен содержать 20 байт")
+    return key
+
+def generate_steam_guard_code(shared_secret, timestamp):
+    """Код Steam Guard: TOTP с HMAC-SHA1 и алфавитом Steam из 5 символов"""
+    key = decode_shared_secret(shared_secret)
+    digest = hmac.new(key, struct.pack(">Q", int(timestamp) // STEAM_GUARD_PERIOD), hashlib.sha1).digest()
+    offset = digest[19] & 0x0F
+    value = struct.unpack(">I", digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    code = ""
+    for _ in range(5):
+        value, index = divmod(value, len(STEAM_GUARD_CHARS))
+        code += STEAM_GUARD_CHARS[index]
+    return code
+
+class SteamGuard:
+    """Коды Steam Guard по времени сервера Steam; код текущего периода кешируется для каждого аккаунта"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.offset = 0  # Время Steam минус локальное, секунд
+        self.next_sync = 0.0
+        self.codes = {}  # login -> (период, код)
+    
+    def server_time(self):
+        """Текущее время сервера Steam с учетом сверенного смещения"""
+        if time.time() >= self.next_sync:
+            self.sync()
+        return time.time() + self.offset
+    
+    def sync(self):
+        """Сверяет локальные часы с сервером Steam; при ошибке оставляет прежнее смещение"""
+        self.next_sync = time.time() + STEAM_TIME_RETRY_INTERVAL
+        try:
+            response = steam_request("query_time", STEAM_TIME_URL, data={"steamid": "0"}, timeout=10)
+            server_time = int(response.json()["response"]["server_time"])
+        except Exception as e:
+            logger.warning(f"{LOGGER_PREFIX} Не удалось сверить время с сервером Steam: {e}")
+            return False
+        offset = server_time - int(time.time())
+        with self.lock:
+            if offset != self.offset:
+                # Коды со старым смещением могли относиться к другому периоду
+                self.codes.clear()
+            self.offset = offset
+        metrics.set_gauge("steamrent_steam_time_offset_seconds", offset)
+        self.next_sync = time.time() + STEAM_TIME_SYNC_INTERVAL
+        return True
+    
+    def code(self, account):
+        """Возвращает (код, секунд до смены кода) для аккаунта с shared_secret"""
+        now = self.server_time()
+        period = int(now) // STEAM_GUARD_PERIOD
+        with self.lock:
+            cached = self.codes.get(account.login)
+            if cached and cached[0] == period:
+                metrics.inc("steamrent_steam_guard_codes_total", result="cached")
+                code = cached[1]
+            else:
+                code = generate_steam_guard_code(account.shared_secret, now)
+                self.codes[account.login] = (period, code)
+                metrics.inc("steamrent_steam_guard_codes_total", result="generated")
+        return code, STEAM_GUARD_PERIOD - int(now) % STEAM_GUARD_PERIOD
+    
+    def forget(self, login):
+        with self.lock:
+            self.codes.pop(login, None)
+
+steam_guard = SteamGuard()
+
 # Классы данных
+ROTATION_MAX_ATTEMPTS = 5  # Сколько обращений к Steam (смен и проверок входа) делаем, прежде чем убрать аккаунт в карантин
+
+# Здоровье аккаунтов: ниже порога аккаунт уходит в карантин вместо пула свободных
+HEALTH_MAX = 100
+HEALTH_QUARANTINE_THRESHOLD = 50
+HEALTH_ROTATION_SUCCESS = 5    # Успешная смена пароля
+HEALTH_ROTATION_FAILURE = 15   # Неудачная попытка смены пароля (капча, Steam Guard, неверный пароль)
+HEALTH_COMPLAINT_PENALTY = 25  # Жалоба покупателя
+HEALTH_RELEASE_SCORE = 70      # Здоровье после успешной перепроверки или ручного возврата
+QUARANTINE_RECHECK_INTERVAL = 3600  # Первая перепроверка через час, дальше интервал удваивается
+QUARANTINE_RECHECK_MAX_INTERVAL = 24 * 3600
+
 class Account:
     def __init__(self, login, password, status="available", account_type="standard", api_key=None):
         self.login = login
@@ -102,6 +1459,16 @@ class Account:
         self.rental_id = None
         self.api_key = api_key  # API ключ для управления Steam сессиями
         self.original_password = password  # Сохраняем изначальный пароль
+        self.pending_rotation = None  # {old_password, new_password, started, attempts} пока Steam не подтвердил смену
+        self.last_rental_end = None  # Когда аккаунт последний раз освободился
+        self.rental_count = 0  # Сколько раз аккаунт выдавался
+        self.rented_hours = 0  # Суммарный срок аренд, часов
+        self.last_rotation = None  # Когда пароль последний раз успешно сменен
+        self.failure_count = 0  # Неудачные попытки смены пароля
+        self.health = HEALTH_MAX  # Оценка по сменам пароля и жалобам
+        self.complaints = 0  # Жалобы покупателей
+        self.quarantine = None  # {reason, since, checks, next_check}; since = None - карантин после возврата
+        self.shared_secret = None  # Секрет мобильного аутентификатора для кодов Steam Guard
         
     def to_dict(self):
         return {
@@ -111,7 +1478,17 @@ class Account:
             "type": self.type,
             "rental_id": self.rental_id,
             "api_key": self.api_key,
-            "original_password": self.original_password
+            "original_password": self.original_password,
+            "pending_rotation": self.pending_rotation,
+            "last_rental_end": self.last_rental_end,
+            "rental_count": self.rental_count,
+            "rented_hours": self.rented_hours,
+            "last_rotation": self.last_rotation,
+            "failure_count": self.failure_count,
+            "health": self.health,
+            "complaints": self.complaints,
+            "quarantine": self.quarantine,
+            "shared_secret": self.shared_secret
         }
         
     @staticmethod
@@ -125,101 +1502,193 @@ class Account:
         )
         account.rental_id = data.get("rental_id")
         account.original_password = data.get("original_password", data["password"])
+        account.pending_rotation = data.get("pending_rotation")
+        account.last_rental_end = data.get("last_rental_end")
+        account.rental_count = data.get("rental_count", 0)
+        account.rented_hours = data.get("rented_hours", 0)
+        account.last_rotation = data.get("last_rotation")
+        account.failure_count = data.get("failure_count", 0)
+        account.health = data.get("health", HEALTH_MAX)
+        account.complaints = data.get("complaints", 0)
+        account.quarantine = data.get("quarantine")
+        account.shared_secret = data.get("shared_secret")
         return account
 
-    def change_password(self, new_password=None):
-        """Изменяет пароль аккаунта, возвращает новый пароль"""
+    def is_available(self):
+        """Можно ли выдать аккаунт: свободен и пароль точно известен"""
+        return self.status == "available" and not self.pending_rotation
+    
+    def adjust_health(self, delta):
+        """Меняет оценку здоровья в пределах 0..HEALTH_MAX"""
+        self.health = max(0, min(HEALTH_MAX, self.health + delta))
+    
+    def is_healthy(self):
+        return self.health >= HEALTH_QUARANTINE_THRESHOLD
+
+    def change_password(self, new_password=None, persist=None):
+        """Изменяет пароль аккаунта, возвращает действующий пароль.
+        
+        persist вызывается до обращения к Steam, чтобы незавершенная смена пароля пережила падение,
+        и после него, чтобы результат смены был на диске до того, как о нем узнает вызывающий.
+        """
         if new_password is None:
             # Генерируем случайный надежный пароль
             new_password = generate_strong_password()
         
-        # Здесь можно добавить вызов API Steam для смены пароля
         old_password = self.password
-        self.password = new_password
         
-        # Пытаемся сменить пароль через API Steam, если есть API ключ
-        if self.api_key:
-            success = self.change_password_via_api(old_password, new_password)
-            if success:
-                logger.info(f"{LOGGER_PREFIX} Пароль для аккаунта {self.login} успешно изменен через API")
-            else:
-                logger.warning(f"{LOGGER_PREFIX} Не удалось изменить пароль через API для {self.login}")
+        # Без API ключа пароль меняется только локально
+        if not self.api_key:
+            self.password = new_password
+            self.last_rotation = time.time()
+            return new_password
+        
+        self.pending_rotation = {
+            "old_password": old_password,
+            "new_password": new_password,
+            "started": time.time(),
+            "attempts": 0
+        }
+        if persist:
+            persist()
+        
+        self.resolve_pending_rotation()
+        if persist:
+            persist()
+        return self.password
+
+    def resolve_pending_rotation(self):
+        """Завершает смену пароля из pending_rotation; возвращает True, если смена подтверждена.
+        False с pending_rotation - повторить позже, без него - попытки исчерпаны и аккаунт помечен для карантина"""
+        pending = self.pending_rotation
+        if not pending:
+            return True
+        
+        success, message, _ = self.change_password_via_api(pending["old_password"], pending["new_password"])
+        pending["attempts"] = pending.get("attempts", 0) + 1
+        
+        if success:
+            logger.info(f"{LOGGER_PREFIX} Пароль для аккаунта {self.login} успешно изменен через API")
+            self.password = pending["new_password"]
+            self.pending_rotation = None
+            self.last_rotation = time.time()
+            self.adjust_health(HEALTH_ROTATION_SUCCESS)
+            return True
+        
+        if message.startswith("Ошибка авторизации") and pending["attempts"] < ROTATION_MAX_ATTEMPTS:
+            # Старый пароль не подходит: возможно, Steam успел принять смену до сбоя. Проверяем только входом
+            pending["attempts"] += 1
+            if self.verify_password_via_api(pending["new_password"]):
+                logger.warning(f"{LOGGER_PREFIX} Смена пароля для {self.login} уже была применена, принимаем новый пароль")
+                self.password = pending["new_password"]
+                self.pending_rotation = None
+                self.last_rotation = time.time()
+                return True
         
-        return new_password
+        self.failure_count += 1
+        self.adjust_health(-HEALTH_ROTATION_FAILURE)
+        metrics.inc("steamrent_rotation_failures_total")
+        if pending["attempts"] >= ROTATION_MAX_ATTEMPTS:
+            # Смена не подтвердилась: последний известный пароль знает предыдущий арендатор,
+            # поэтому аккаунт уходит в карантин (RentalManager.settle_returned) и ждет администратора
+            logger.error(f"{LOGGER_PREFIX} Не удалось изменить пароль через API для {self.login} "
+                         f"после {pending['attempts']} попыток: {message}")
+            metrics.inc("steamrent_rotation_abandoned_total")
+            self.password = pending["old_password"]
+            self.pending_rotation = None
+            if not self.quarantine:
+                self.quarantine = {"reason": f"Steam не принял смену пароля после {pending['attempts']} попыток: {message}",
+                                   "since": None, "checks": 0, "next_check": None}
+            return False
+        
+        logger.warning(f"{LOGGER_PREFIX} Не удалось изменить пароль через API для {self.login}: {message}")
+        return False
 
+    def login_via_api(self, password):
+        """Входит в Steam с паролем, возвращает (session, steamid, headers, ошибка)"""
+        # Получаем rsatimestamp и publickey_mod для шифрования пароля
+        get_key_url = "https://steamcommunity.com/login/getrsakey/"
+        get_key_data = {
+            "username": self.login,
+            "donotcache": int(time.time() * 1000)
+        }
+        
+        # Настройки для запросов
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+            "Accept": "application/json, text/plain, */*",
+            "Origin": "https://steamcommunity.com",
+            "Referer": "https://steamcommunity.com/login/home/"
+        }
+        
+        # Получаем RSA ключ для шифрования пароля
+        key_response = steam_request("getrsakey", get_key_url, data=get_key_data, headers=headers)
+        if not key_response.ok:
+            logger.error(f"{LOGGER_PREFIX} Ошибка получения RSA ключа: {key_response.status_code}")
+            return None, None, headers, "Ошибка получения RSA ключа"
+        
+        key_data = key_response.json()
+        if not key_data.get("success"):
+            logger.error(f"{LOGGER_PREFIX} Сервер не вернул RSA ключ: {key_data}")
+            return None, None, headers, "Сервер не вернул RSA ключ"
+        
+        # Подготавливаем данные для шифрования
+        timestamp = key_data.get("timestamp")
+        modulus = int(key_data.get("publickey_mod"), 16)
+        exponent = int(key_data.get("publickey_exp"), 16)
+        
+        # Шифруем пароль с помощью RSA
+        RSA, PKCS1_v1_5 = get_rsa_backend()
+        
+        key = RSA.construct((modulus, exponent))
+        cipher = PKCS1_v1_5.new(key)
+        encrypted_password = base64.b64encode(cipher.encrypt(password.encode('utf-8')))
+        
+        # Данные для авторизации
+        login_data = {
+            "username": self.login,
+            "password": encrypted_password.decode('utf-8'),
+            "rsatimestamp": timestamp,
+            "remember_login": True,
+            "captchagid": -1,
+            "captcha_text": ""
+        }
+        
+        # URL для входа
+        login_url = "https://steamcommunity.com/login/dologin/"
+        
+        # Выполняем вход
+        session = requests.Session()
+        login_response = steam_request("dologin", login_url, session=session, data=login_data, headers=headers)
+        login_result = login_response.json()
+        
+        if not login_result.get("success"):
+            error_message = login_result.get("message", "Неизвестная ошибка авторизации")
+            logger.error(f"{LOGGER_PREFIX} Ошибка авторизации в Steam: {error_message}")
+            return None, None, headers, f"Ошибка авторизации: {error_message}"
+        
+        steamid = login_result.get("transfer_parameters", {}).get("steamid")
+        if not steamid:
+            logger.error(f"{LOGGER_PREFIX} Не удалось получить steamid после авторизации")
+            return None, None, headers, "Не удалось получить steamid"
+        return session, steamid, headers, None
+    
+    def verify_password_via_api(self, password):
+        """Проверяет пароль одним входом в Steam, без смены пароля"""
+        try:
+            _, steamid, _, error = self.login_via_api(password)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Исключение при проверке пароля через API: {str(e)}")
+            return False
+        return error is None and bool(steamid)
+    
     def change_password_via_api(self, old_password, new_password):
         """Изменяет пароль аккаунта через Steam API"""
         try:
-            # Используем правильный API URL для обновления пароля
-            api_url = "https://api.steampowered.com/IAuthenticationService/UpdatePassword/v1/"
-            
-            # Получаем rsatimestamp и publickey_mod для шифрования пароля
-            get_key_url = "https://steamcommunity.com/login/getrsakey/"
-            get_key_data = {
-                "username": self.login,
-                "donotcache": int(time.time() * 1000)
-            }
-            
-            # Настройки для запросов
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "Accept": "application/json, text/plain, */*",
-                "Origin": "https://steamcommunity.com",
-                "Referer": "https://steamcommunity.com/login/home/"
-            }
-            
-            # Получаем RSA ключ для шифрования пароля
-            key_response = requests.post(get_key_url, data=get_key_data, headers=headers)
-            if not key_response.ok:
-                logger.error(f"{LOGGER_PREFIX} Ошибка получения RSA ключа: {key_response.status_code}")
-                return False, "Ошибка получения RSA ключа", None
-            
-            key_data = key_response.json()
-            if not key_data.get("success"):
-                logger.error(f"{LOGGER_PREFIX} Сервер не вернул RSA ключ: {key_data}")
-                return False, "Сервер не вернул RSA ключ", None
-            
-            # Подготавливаем данные для шифрования
-            timestamp = key_data.get("timestamp")
-            modulus = int(key_data.get("publickey_mod"), 16)
-            exponent = int(key_data.get("publickey_exp"), 16)
-            
-            # Шифруем пароль с помощью RSA
-            from Crypto.PublicKey import RSA
-            from Crypto.Cipher import PKCS1_v1_5
-            
-            key = RSA.construct((modulus, exponent))
-            cipher = PKCS1_v1_5.new(key)
-            encrypted_password = base64.b64encode(cipher.encrypt(old_password.encode('utf-8')))
-            
-            # Данные для авторизации
-            login_data = {
-                "username": self.login,
-                "password": encrypted_password.decode('utf-8'),
-                "rsatimestamp": timestamp,
-                "remember_login": True,
-                "captchagid": -1,
-                "captcha_text": ""
-            }
-            
-            # URL для входа
-            login_url = "https://steamcommunity.com/login/dologin/"
-            
-            # Выполняем вход
-            session = requests.Session()
-            login_response = session.post(login_url, data=login_data, headers=headers)
-            login_result = login_response.json()
-            
-            if not login_result.get("success"):
-                error_message = login_result.get("message", "Неизвестная ошибка авторизации")
-                logger.error(f"{LOGGER_PREFIX} Ошибка авторизации в Steam: {error_message}")
-                return False, f"Ошибка авторизации: {error_message}", None
-            
-            # Если авторизация успешна, меняем пароль
-            steamid = login_result.get("transfer_parameters", {}).get("steamid")
-            if not steamid:
-                logger.error(f"{LOGGER_PREFIX} Не удалось получить steamid после авторизации")
-                return False, "Не удалось получить steamid", None
+            # Входим со старым паролем, затем меняем его
+            session, steamid, headers, error = self.login_via_api(old_password)
+            if error:
+                return False, error, None
             
             # Получаем токен доступа из cookie
             sessionid = None
@@ -245,7 +1714,7 @@ class Account:
             change_password_url = "https://steamcommunity.com/profiles/" + steamid + "/edit/changepassword"
             
             # Выполняем запрос на изменение пароля
-            change_response = session.post(change_password_url, data=change_password_data, headers=headers)
+            change_response = steam_request("changepassword", change_password_url, session=session, data=change_password_data, headers=headers)
             
             # Проверяем успешность изменения пароля
             if change_response.ok and "successfully updated" in change_response.text.lower():
@@ -261,8 +1730,6 @@ class Account:
 
     def end_session(self):
         """Завершает сессии на аккаунте"""
-        self.status = "available"  # Меняем статус на доступный
-        
         if self.api_key:
             try:
                 # Пытаемся завершить сессии через API
@@ -292,7 +1759,7 @@ class Account:
             }
             
             # Отправляем запрос к API
-            response = requests.post(api_url, headers=headers, data=data, timeout=10)
+            response = steam_request("revoke_sessions", api_url, headers=headers, data=data, timeout=10)
             if response.status_code == 200:
                 try:
                     result = response.json()
@@ -304,22 +1771,16 @@ class Account:
             logger.error(f"{LOGGER_PREFIX} Ошибка API запроса для завершения сессий: {e}")
             return False
 
-    def reset_to_original_password(self):
+    def reset_to_original_password(self, persist=None):
         """Сбрасывает пароль к исходному значению"""
-        if self.original_password:
-            old_password = self.password
-            self.password = self.original_password
-            
-            # Пытаемся сменить пароль через API Steam, если есть API ключ
-            if self.api_key:
-                success = self.change_password_via_api(old_password, self.original_password)
-                if success:
-                    logger.info(f"{LOGGER_PREFIX} Пароль для аккаунта {self.login} сброшен к исходному через API")
-                else:
-                    logger.warning(f"{LOGGER_PREFIX} Не удалось сбросить пароль через API для {self.login}")
-            
-            return True
-        return False
+        if not self.original_password:
+            return False
+        
+        self.change_password(self.original_password, persist=persist)
+        if self.password != self.original_password:
+            logger.warning(f"{LOGGER_PREFIX} Не удалось сбросить пароль через API для {self.login}")
+            return False
+        return True
 
 class Rental:
     def __init__(self, account_login, user_id, username, duration_hours, order_id=None):
@@ -332,6 +1793,8 @@ class Rental:
         self.end_time = self.start_time + (duration_hours * 3600)
         self.order_id = order_id
         self.is_active = True
+        self.complained = False  # Покупатель уже пожаловался на аккаунт этой аренды
+        self.reminders_sent = []  # Отправленные напоминания, минут до окончания
         
     def to_dict(self):
         return {
@@ -343,7 +1806,9 @@ class Rental:
             "duration_hours": self.duration_hours,
             "end_time": self.end_time,
             "order_id": self.order_id,
-            "is_active": self.is_active
+            "is_active": self.is_active,
+            "complained": self.complained,
+            "reminders_sent": self.reminders_sent
         }
         
     @staticmethod
@@ -359,6 +1824,8 @@ class Rental:
         rental.start_time = data["start_time"]
         rental.end_time = data["end_time"]
         rental.is_active = data["is_active"]
+        rental.complained = data.get("complained", False)
+        rental.reminders_sent = data.get("reminders_sent", [])
         return rental
         
     def is_expired(self):
@@ -375,6 +1842,8 @@ class Rental:
         """Продлевает аренду на указанное количество часов"""
         self.duration_hours += additional_hours
         self.end_time += additional_hours * 3600
+        # Напоминания относятся к новому времени окончания
+        self.reminders_sent = []
         return True
     
     def get_formatted_end_time(self):
@@ -417,7 +1886,8 @@ def format_message(template_name, **kwargs):
     
     # Заменяем переменные в шаблоне
     try:
-        formatted_message = template.format(**kwargs)
+        with tracer.span("format_message"):
+            formatted_message = template.format(**kwargs)
         return formatted_message
     except KeyError as e:
         logger.error(f"{LOGGER_PREFIX} Ошибка форматирования шаблона: отсутствует ключ {e}")
@@ -426,15 +1896,217 @@ def format_message(template_name, **kwargs):
         logger.error(f"{LOGGER_PREFIX} Ошибка форматирования шаблона: {e}")
         return template
 
+# Индекс активных аренд
+class ActiveRentalIndex:
+    """Поиск по активным арендам: префикс логина, покупатель, номер заказа; результаты по времени окончания.
+    Полностью строится после загрузки и сверки, дальше обновляется при выдаче, возврате и продлении"""
+    
+    def __init__(self):
+        self.version = None  # Версия index_version менеджера, по которой построен индекс
+        self.by_end = []     # Отсортированные (end_time, rental.id, rental), раньше заканчивающиеся - первыми
+        self.logins = []     # Отсортированные (login.lower(), rental.id, rental) для поиска по префиксу
+        self.usernames = []  # Отсортированные (username.lower(), rental.id, rental)
+        self.by_order = {}   # order_id -> [rental]: заказ на несколько аккаунтов дает несколько аренд
+        self.by_user = {}    # user_id -> [rental], раньше заканчивающиеся - первыми
+        self.by_user_type = {}  # (user_id, нормализованный тип) -> [rental], раньше заканчивающиеся - первыми
+        self.types = {}      # rental.id -> нормализованный тип, под которым аренда лежит в by_user_type
+    
+    def rebuild(self, rentals, version, accounts=None):
+        self.by_end, self.logins, self.usernames = [], [], []
+        self.by_order, self.by_user, self.by_user_type, self.types = {}, {}, {}, {}
+        for rental in rentals:
+            if rental.is_active:
+                account = (accounts or {}).get(rental.account_login)
+                self.add(rental, account.type if account else None)
+        self.version = version
+    
+    @staticmethod
+    def _insort(items, key, rental):
+        bisect.insort(items, (key, rental.id, rental))
+    
+    @staticmethod
+    def _discard(items, key, rental):
+        index = bisect.bisect_left(items, (key, rental.id))
+        if index < len(items) and items[index][1] == rental.id:
+            del items[index]
+    
+    @staticmethod
+    def _insert_by_end(groups, group_key, rental):
+        rentals = groups.setdefault(group_key, [])
+        rentals.append(rental)
+        rentals.sort(key=lambda item: item.end_time)
+    
+    @staticmethod
+    def _remove_from(groups, group_key, rental):
+        rentals = groups.get(group_key)
+        if rentals and rental in rentals:
+            rentals.remove(rental)
+            if not rentals:
+                del groups[group_key]
+    
+    def add(self, rental, account_type=None):
+        """Добавляет активную аренду"""
+        self._insort(self.by_end, rental.end_time, rental)
+        self._insort(self.logins, rental.account_login.lower(), rental)
+        self._insort(self.usernames, str(rental.username).lower(), rental)
+        if rental.order_id:
+            self._insert_by_end(self.by_order, normalize_order_id(rental.order_id), rental)
+        self._insert_by_end(self.by_user, rental.user_id, rental)
+        if account_type is not None:
+            normalized_type = normalize_account_type(account_type)
+            self.types[rental.id] = normalized_type
+            self._insert_by_end(self.by_user_type, (rental.user_id, normalized_type), rental)
+    
+    def remove(self, rental, end_time=None):
+        """Убирает аренду; end_time - время окончания, под которым она была добавлена"""
+        self._discard(self.by_end, rental.end_time if end_time is None else end_time, rental)
+        self._discard(self.logins, rental.account_login.lower(), rental)
+        self._discard(self.usernames, str(rental.username).lower(), rental)
+        if rental.order_id:
+            self._remove_from(self.by_order, normalize_order_id(rental.order_id), rental)
+        self._remove_from(self.by_user, rental.user_id, rental)
+        normalized_type = self.types.pop(rental.id, None)
+        if normalized_type is not None:
+            self._remove_from(self.by_user_type, (rental.user_id, normalized_type), rental)
+    
+    def move(self, rental, old_end_time):
+        """Переставляет продленную аренду на новое время окончания"""
+        normalized_type = self.types.get(rental.id)
+        self.remove(rental, old_end_time)
+        self.add(rental, normalized_type)
+    
+    @staticmethod
+    def _prefix_range(items, prefix):
+        start = bisect.bisect_left(items, (prefix,))
+        end = bisect.bisect_left(items, (prefix + "\uffff",))
+        return [rental for _, _, rental in items[start:end]]
+    
+    def search(self, query=""):
+        """Возвращает аренды по запросу: пусто - все, #123 - заказ, @name - покупатель, иначе префикс"""
+        query = (query or "").strip().lower()
+        if not query:
+            return [rental for _, _, rental in self.by_end]
+        if query.startswith("#"):
+            return list(self.by_order.get(query[1:], ()))
+        if query.startswith("@"):
+            found = self._prefix_range(self.usernames, query[1:])
+        else:
+            found = self._prefix_range(self.logins, query) + self._prefix_range(self.usernames, query)
+            found += self.by_order.get(query, ())
+        unique = {rental.id: rental for rental in found}
+        return sorted(unique.values(), key=lambda rental: rental.end_time)
+
+def normalize_order_id(order_id):
+    """Ключ заказа для индексов: без "#" и регистра"""
+    return str(order_id).strip().lstrip("#").lower()
+
+def normalize_account_type(account_type):
+    """Ключ типа аккаунта для сравнения: без регистра, точек и пробелов"""
+    return str(account_type).lower().replace('.', '').replace(' ', '')
+
+# Политики выбора свободного аккаунта
+ALLOCATION_POLICIES = {
+    "first": "первый свободный в порядке добавления",
+    "lru": "дольше всех простаивающий",
+    "least_used": "с наименьшим суммарным сроком аренд",
+    "health": "самый здоровый (смены пароля, жалобы), затем наименее использованный",
+}
+
+def allocation_key(policy, account, position):
+    """Приоритет аккаунта в очереди выдачи: меньше - раньше"""
+    if policy == "lru":
+        return (account.last_rental_end or 0, position)
+    if policy == "least_used":
+        return (account.rented_hours, account.rental_count, position)
+    if policy == "health":
+        return (-account.health, account.rented_hours, position)
+    return (position,)
+
+class AccountPool:
+    """Свободные аккаунты по типам в кучах приоритетов политики выдачи.
+    Записи удаляются лениво: устаревшие отбрасываются при выборе, поэтому выбор и возврат - O(log n).
+    Число свободных аккаунтов типа ведется отдельно и меняется в push и take"""
+    
+    def __init__(self):
+        self.policy = ALLOCATION_POLICY
+        self.heaps = {}      # нормализованный тип -> [(ключ, stamp, login)]
+        self.stamps = {}     # login -> stamp последней записи; старые записи аккаунта недействительны
+        self.positions = {}  # login -> порядок добавления для политики "first" и равных ключей
+        self.free = {}       # нормализованный тип -> set(login) свободных аккаунтов
+        self.free_types = {} # login -> нормализованный тип, под которым аккаунт учтен в free
+        self.counter = 0
+    
+    def rebuild(self, accounts):
+        self.policy = ALLOCATION_POLICY
+        self.heaps, self.stamps, self.free, self.free_types = {}, {}, {}, {}
+        for account in accounts.values():
+            self.push(account)
+    
+    def push(self, account):
+        """Ставит аккаунт в кучу его типа с актуальным ключом, если его можно выдать, иначе убирает из свободных"""
+        if not account.is_available():
+            self.take(account.login)
+            return
+        normalized_type = normalize_account_type(account.type)
+        if self.free_types.get(account.login) != normalized_type:
+            self.take(account.login)
+            self.free.setdefault(normalized_type, set()).add(account.login)
+            self.free_types[account.login] = normalized_type
+        self.counter += 1
+        position = self.positions.setdefault(account.login, self.counter)
+        self.stamps[account.login] = self.counter
+        heap = self.heaps.setdefault(normalized_type, [])
+        heapq.heappush(heap, (allocation_key(self.policy, account, position), self.counter, account.login))
+    
+    def take(self, login):
+        """Убирает аккаунт из свободных (выдан, удален, отключен); его записи в куче станут недействительны"""
+        self.stamps.pop(login, None)
+        normalized_type = self.free_types.pop(login, None)
+        if normalized_type is not None:
+            self.free[normalized_type].discard(login)
+    
+    def count(self, account_type):
+        """Число свободных аккаунтов типа за O(1)"""
+        return len(self.free.get(normalize_account_type(account_type), ()))
+    
+    def select(self, accounts, account_type):
+        """Лучший свободный аккаунт типа по политике или None; аккаунт остается в куче до выдачи"""
+        if self.policy != ALLOCATION_POLICY:
+            self.rebuild(accounts)
+        normalized_type = normalize_account_type(account_type)
+        heap = self.heaps.get(normalized_type)
+        while heap:
+            _, stamp, login = heap[0]
+            account = accounts.get(login)
+            if (account and self.stamps.get(login) == stamp and account.is_available()
+                    and normalize_account_type(account.type) == normalized_type):
+                return account
+            heapq.heappop(heap)
+            if account is None or (self.stamps.get(login) == stamp and not account.is_available()):
+                # Аккаунт перестал быть свободным в обход take
+                self.take(login)
+        return None
+
 # Управление данными
 class RentalManager:
-    def __init__(self):
+    def __init__(self, autoload=True):
         self.accounts = {}  # login -> Account
         self.rentals = {}   # id -> Rental
-        self.load_data()
+        self.orders = {}    # order_id -> [rental_id]: выполненные заказы, хранится в ORDER_INDEX_FILE
+        self.orders_in_flight = set()  # Заказы, которые выдаются прямо сейчас
+        self.rotation_queue = {}  # login -> rental_id | None: аккаунты, ждущие смены пароля
+        self.lock = threading.RLock()  # Изменения аккаунтов и аренд из разных потоков
+        self._batch_state = threading.local()  # scope групповой операции потока: пока он есть, save_data только помечает изменения
+        self.version = 0  # Растет при каждом изменении данных, по нему обновляются кэши панелей
+        self.index_version = 0  # Растет, когда аренды меняются в обход индекса (загрузка, сверка)
+        self.rental_index = ActiveRentalIndex()
+        self.pool = AccountPool()  # Свободные аккаунты в порядке политики выдачи
+        self.quarantined = set()  # Логины аккаунтов в карантине, вне пула выдачи
+        if autoload:
+            self.load_data()
         
     def load_data(self):
-        """Загружает данные из файлов"""
+        """Загружает данные из файлов; поврежденный файл аккаунтов или аренд вызывает исключение"""
         # Загрузка аккаунтов
         if os.path.exists(ACCOUNTS_FILE):
             try:
@@ -446,7 +2118,7 @@ class RentalManager:
                     }
             except Exception as e:
                 logger.error(f"{LOGGER_PREFIX} Ошибка загрузки аккаунтов: {e}")
-                self.accounts = {}
+                raise
         
         # Загрузка аренд
         if os.path.exists(RENTALS_FILE):
@@ -459,28 +2131,95 @@ class RentalManager:
                     }
             except Exception as e:
                 logger.error(f"{LOGGER_PREFIX} Ошибка загрузки аренд: {e}")
-                self.rentals = {}
+                raise
+        
+        # Индекс выполненных заказов; аренды дополняют его, если файл индекса потерян или устарел
+        self.orders = {}
+        if os.path.exists(ORDER_INDEX_FILE):
+            try:
+                with open(ORDER_INDEX_FILE, "r", encoding="utf-8") as f:
+                    # Старый формат индекса хранил один rental_id на заказ
+                    self.orders = {key: value if isinstance(value, list) else [value]
+                                   for key, value in json.load(f).items()}
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка загрузки индекса заказов: {e}")
+        for rental in self.rentals.values():
+            if rental.order_id:
+                rental_ids = self.orders.setdefault(normalize_order_id(rental.order_id), [])
+                if rental.id not in rental_ids:
+                    rental_ids.append(rental.id)
+        
+        self.quarantined = {login for login, account in self.accounts.items() if account.status == "quarantined"}
+        self.pool.rebuild(self.accounts)
+        self.version += 1
+        self.index_version += 1
+    
+    def save_data(self, force=False):
+        """Сохраняет данные в файлы; force записывает их сразу, даже внутри групповой операции"""
+        if STATE_LOAD_ERROR:
+            # Данные в памяти неполные: не затираем ими файлы
+            logger.error(f"{LOGGER_PREFIX} Сохранение пропущено: данные не загрузились ({STATE_LOAD_ERROR})")
+            return
+        with self.lock:
+            self.version += 1
+            scope = getattr(self._batch_state, "scope", None)
+            if scope is not None and not force:
+                scope["dirty"] = True
+                return
+        with tracer.span("save_data"), self.lock:
+            self._save_data()
+    
+    def save_rotation(self):
+        """Сохраняет состояние смены пароля сразу: пароль, который Steam может успеть принять,
+        должен оказаться на диске до обращения к Steam, а не в конце групповой операции"""
+        self.save_data(force=True)
+    
+    @contextlib.contextmanager
+    def batch(self, scope=None):
+        """Откладывает сохранение до конца блока: одна запись файлов на всю групповую операцию.
+        Действует только в текущем потоке; рабочие потоки операции входят в нее с общим scope,
+        а сохранения остальных потоков (выдача заказов) выполняются сразу.
+        Смена пароля сохраняется мимо блока через save_rotation"""
+        outer = getattr(self._batch_state, "scope", None)
+        scope = scope or outer or {"depth": 0, "dirty": False}
+        self._batch_state.scope = scope
+        with self.lock:
+            scope["depth"] += 1
+        try:
+            yield scope
+        finally:
+            self._batch_state.scope = outer
+            with self.lock:
+                scope["depth"] -= 1
+                flush = not scope["depth"] and scope["dirty"]
+                if flush:
+                    scope["dirty"] = False
+            if flush:
+                self.save_data()
     
-    def save_data(self):
-        """Сохраняет данные в файлы"""
+    def _save_data(self):
         # Сохранение аккаунтов
         try:
             accounts_data = {
                 login: account.to_dict()
                 for login, account in self.accounts.items()
             }
-            with open(ACCOUNTS_FILE, "w", encoding="utf-8") as f:
-                json.dump(accounts_data, f, ensure_ascii=False, indent=2)
+            write_json_file(ACCOUNTS_FILE, accounts_data)
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Ошибка сохранения аккаунтов: {e}")
         
         # Сохранение аренд
         try:
             rentals_data = [rental.to_dict() for rental in self.rentals.values()]
-            with open(RENTALS_FILE, "w", encoding="utf-8") as f:
-                json.dump(rentals_data, f, ensure_ascii=False, indent=2)
+            write_json_file(RENTALS_FILE, rentals_data)
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Ошибка сохранения аренд: {e}")
+        
+        # Сохранение индекса заказов
+        try:
+            write_json_file(ORDER_INDEX_FILE, self.orders)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения индекса заказов: {e}")
     
     def add_account(self, login, password, account_type="standard", api_key=None):
         """Добавляет новый аккаунт"""
@@ -494,7 +2233,9 @@ class RentalManager:
             account_type = "repo"
         
         self.accounts[login] = Account(login, password, "available", account_type, api_key)
+        self.pool.push(self.accounts[login])
         self.save_data()
+        backorders.notify()
         return True, "Аккаунт успешно добавлен"
     
     def update_account(self, login, **kwargs):
@@ -510,14 +2251,31 @@ class RentalManager:
             account.original_password = kwargs.get("original_password", account.password)
         
         if "type" in kwargs:
-            account.type = kwargs["type"]
+            self._retype_account(account, kwargs["type"])
         
         if "api_key" in kwargs:
             account.api_key = kwargs["api_key"]
         
+        if "shared_secret" in kwargs:
+            account.shared_secret = kwargs["shared_secret"]
+            steam_guard.forget(login)
+        
         self.save_data()
         return True, "Аккаунт успешно обновлен"
     
+    def _retype_account(self, account, account_type):
+        # Аренда на аккаунте переносится в индексе под новый тип, иначе повторная покупка ее не найдет
+        with self.lock:
+            index = self._refresh_index()
+            rental = self.rentals.get(account.rental_id) if account.rental_id else None
+            if rental and rental.is_active:
+                index.remove(rental)
+                index.add(rental, account_type)
+                demand.remove_expiry(account.type, rental.id, rental.end_time)
+                demand.add_expiry(account_type, rental)
+            account.type = account_type
+            self.pool.push(account)
+    
     def remove_account(self, login):
         """Удаляет аккаунт"""
         if login not in self.accounts:
@@ -528,61 +2286,179 @@ class RentalManager:
             return False, "Нельзя удалить аккаунт, который сейчас в аренде"
         
         del self.accounts[login]
+        self.pool.take(login)
+        self.quarantined.discard(login)
         self.save_data()
         return True, "Аккаунт успешно удален"
     
+    def _refresh_index(self):
+        # Полностью индекс строится лениво после загрузки и сверки, остальные изменения вносятся в него сразу
+        if self.rental_index.version != self.index_version:
+            self.rental_index.rebuild(self.rentals.values(), self.index_version, self.accounts)
+        return self.rental_index
+    
+    def search_active_rentals(self, query=""):
+        """Ищет активные аренды через индекс"""
+        with self.lock:
+            return self._refresh_index().search(query)
+    
+    def active_rentals_for_user(self, user_id):
+        """Активные аренды покупателя из индекса, ближайшие к завершению в начале"""
+        with self.lock:
+            return list(self._refresh_index().by_user.get(user_id, ()))
+    
+    def expected_return(self, account_type, n=1):
+        """Время окончания n-й по счету активной аренды типа (когда освободится n-й аккаунт) или None"""
+        return demand.nth_expiry(account_type, n)
+    
+    def find_active_rental(self, user_id, account_type):
+        """Активная аренда покупателя с аккаунтом того же типа (ближайшая к завершению) или None"""
+        with self.lock:
+            rentals = self._refresh_index().by_user_type.get((user_id, normalize_account_type(account_type)), ())
+            # Истекшие аренды уже возвращаются потоком проверки, продлевать их нельзя
+            return next((rental for rental in rentals if not rental.is_expired()), None)
+    
+    def select_accounts(self, logins=None, account_type=None, status=None, idle_hours=None):
+        """Отбирает логины по списку и фильтрам: тип, статус, простой не меньше idle_hours"""
+        now = time.time()
+        normalized_type = account_type.lower().replace('.', '').replace(' ', '') if account_type else None
+        candidates = logins if logins else list(self.accounts)
+        selected = []
+        for login in candidates:
+            account = self.accounts.get(login)
+            if account is None:
+                if logins:
+                    selected.append(login)  # Пусть групповая операция сообщит, что аккаунта нет
+                continue
+            if normalized_type and account.type.lower().replace('.', '').replace(' ', '') != normalized_type:
+                continue
+            if status and account.status != status:
+                continue
+            if idle_hours is not None:
+                # Аккаунты, которые ни разу не сдавались, считаются простаивающими бесконечно
+                if account.status == "rented" or now - (account.last_rental_end or 0) < idle_hours * 3600:
+                    continue
+            selected.append(login)
+        return selected
+    
+    def bulk_update(self, logins, action, value=None):
+        """Удаляет, отключает, включает или меняет тип аккаунтов одной записью; возвращает [(login, ok, detail)]"""
+        results = []
+        with self.lock, self.batch():
+            for login in logins:
+                account = self.accounts.get(login)
+                if account is None:
+                    results.append((login, False, "аккаунт не найден"))
+                elif action == "delete":
+                    success, message = self.remove_account(login)
+                    results.append((login, success, message))
+                elif account.status == "rented":
+                    results.append((login, False, "аккаунт в аренде"))
+                elif action == "disable":
+                    account.status = "disabled"
+                    self.pool.take(login)
+                    account.quarantine = None
+                    self.quarantined.discard(login)
+                    results.append((login, True, "отключен"))
+                elif action == "enable":
+                    if account.status != "disabled":
+                        results.append((login, False, "аккаунт не отключен"))
+                        continue
+                    account.status = "available"
+                    self.pool.push(account)
+                    results.append((login, True, "включен"))
+                elif action == "retype":
+                    old_type = account.type
+                    self._retype_account(account, value)
+                    results.append((login, True, f"{old_type} → {value}"))
+                else:
+                    results.append((login, False, f"неизвестное действие {action}"))
+            self.save_data()
+        return results
+    
     def get_available_account(self, account_type=None):
         """Возвращает доступный аккаунт указанного типа"""
         if not account_type:
             # Если тип не указан, вернем любой доступный
             for login, account in self.accounts.items():
-                if account.status == "available":
-                    logger.info(f"{LOGGER_PREFIX} Выбран любой доступный аккаунт: {login} ({account.type})")
+                if account.is_available():
+                    log_debug("account.selected", login=login, type=account.type, match="any")
                     return account
             logger.warning(f"{LOGGER_PREFIX} Нет доступных аккаунтов в системе")
             return None
     
-        logger.info(f"{LOGGER_PREFIX} Поиск доступного аккаунта по типу: {account_type}")
-            
         # Используем нормализацию для сравнения типов
-        normalized_type = account_type.lower().replace('.', '').replace(' ', '')
-        logger.info(f"{LOGGER_PREFIX} Нормализованный тип: {normalized_type}")
+        normalized_type = normalize_account_type(account_type)
+        log_event(logging.DEBUG, "account.lookup", type=account_type, normalized=normalized_type, policy=ALLOCATION_POLICY)
         
-        # Вывод всех доступных типов для отладки
-        available_types = [(account.login, account.type, account.status) for account in self.accounts.values()]
-        logger.info(f"{LOGGER_PREFIX} Доступные аккаунты: {available_types}")
-        
-        # Сначала пытаемся найти точное совпадение
-        for login, account in self.accounts.items():
-            if account.status == "available" and account.type.lower() == account_type.lower():
-                logger.info(f"{LOGGER_PREFIX} Найдено точное совпадение: {login} ({account.type})")
+        # Берем лучший аккаунт по политике выдачи из кучи типа
+        with self.lock:
+            account = self.pool.select(self.accounts, account_type)
+            if account:
+                log_debug("account.selected", login=account.login, type=account.type, match=ALLOCATION_POLICY)
                 return account
-                
-        # Если не нашли точное совпадение, ищем с нормализацией
-        for login, account in self.accounts.items():
-            if account.status == "available":
-                normalized_account_type = account.type.lower().replace('.', '').replace(' ', '')
-                if normalized_account_type == normalized_type:
-                    logger.info(f"{LOGGER_PREFIX} Найдено совпадение по нормализации: {login} ({account.type})")
+            
+            # Счетчик видит свободный аккаунт, а в куче его нет - пул рассогласован, пересобираем кучи
+            if self.pool.count(account_type):
+                metrics.inc("steamrent_pool_rebuilds_total")
+                logger.debug(f"{LOGGER_PREFIX} Пул свободных аккаунтов типа {account_type} устарел, пересобираем")
+                self.pool.rebuild(self.accounts)
+                account = self.pool.select(self.accounts, account_type)
+                if account:
+                    log_debug("account.selected", login=account.login, type=account.type, match=ALLOCATION_POLICY)
                     return account
         
-        # Специальная обработка для R.E.P.O / REPO
-        if normalized_type == "repo":
-            for login, account in self.accounts.items():
-                if account.status == "available":
-                    acc_type = account.type.lower().replace('.', '').replace(' ', '')
-                    if acc_type == "repo":
-                        logger.info(f"{LOGGER_PREFIX} Найдено совпадение REPO: {login} ({account.type})")
-                        return account
-        
         logger.warning(f"{LOGGER_PREFIX} Не найдено доступных аккаунтов типа {account_type}")
         return None
     
     def rent_account(self, user_id, username, duration_hours, account_type=None, order_id=None, specific_account=None):
         """Аренда аккаунта"""
+        with self.lock:
+            result = self._rent_account(user_id, username, duration_hours, account_type, order_id, specific_account)
+            if result[0]:
+                self._track_rental(result[2], result[3])
+            return result
+    
+    def rent_accounts(self, user_id, username, duration_hours, account_type, order_id, count):
+        """Выдает count аккаунтов типа одной операцией: все или ни одного, одна запись данных.
+        Возвращает (успех, сообщение, [(account, rental)])"""
+        with self.lock, self.batch():
+            if self.count_available(account_type) < count:
+                return False, f"Недостаточно свободных аккаунтов: нужно {count}", []
+            issued = []
+            for _ in range(count):
+                success, message, account, rental = self._rent_account(
+                    user_id, username, duration_hours, account_type, order_id, None
+                )
+                if not success:
+                    # Откатываем уже выданные, чтобы заказ не был выполнен частично
+                    for account, rental in issued:
+                        account.status = "available"
+                        account.rental_id = None
+                        account.rental_count -= 1
+                        account.rented_hours -= duration_hours
+                        del self.rentals[rental.id]
+                        self._refresh_index().remove(rental)
+                        self.pool.push(account)
+                    if order_id:
+                        self.orders.pop(normalize_order_id(order_id), None)
+                    self.save_data()
+                    return False, message, []
+                issued.append((account, rental))
+            # Таймеры и прогноз - только когда выдан весь заказ, откатывать их не придется
+            for account, rental in issued:
+                self._track_rental(account, rental)
+            return True, "Аккаунты успешно арендованы", issued
+    
+    def _track_rental(self, account, rental):
+        # Напоминания покупателю и расписание возвратов для прогноза спроса
+        reminders.schedule(rental)
+        demand.add_expiry(account.type, rental)
+    
+    def _rent_account(self, user_id, username, duration_hours, account_type, order_id, specific_account):
         # Если указан конкретный аккаунт для аренды
         if specific_account:
-            if specific_account.login in self.accounts and self.accounts[specific_account.login].status == "available":
+            if specific_account.login in self.accounts and self.accounts[specific_account.login].is_available():
                 account = self.accounts[specific_account.login]
             else:
                 return False, "Указанный аккаунт недоступен", None, None
@@ -593,130 +2469,421 @@ class RentalManager:
         if not account:
             return False, "Нет доступных аккаунтов", None, None
         
-        # Создаем запись об аренде
+        # Создаем запись об аренде; индекс актуализируем до ее добавления, чтобы не учесть ее дважды
         rental = Rental(account.login, user_id, username, duration_hours, order_id)
+        index = self._refresh_index()
         
-        # Обновляем статус аккаунта
+        # Обновляем статус аккаунта и статистику использования
         account.status = "rented"
+        self.pool.take(account.login)
         account.rental_id = rental.id
+        account.rental_count += 1
+        account.rented_hours += duration_hours
         
         # Сохраняем данные
         self.rentals[rental.id] = rental
+        index.add(rental, account.type)
+        if order_id:
+            # Заказ на несколько аккаунтов ссылается на все свои аренды
+            self.orders.setdefault(normalize_order_id(order_id), []).append(rental.id)
         self.save_data()
         
+        live_board.notify("rental_start")
+        # Без открытых панелей запас не считаем
+        if live_board.boards and self.count_available(account.type) <= LIVE_BOARD_LOW_STOCK:
+            live_board.notify("low_stock")
+        
         return True, "Аккаунт успешно арендован", account, rental
     
+    def count_available(self, account_type):
+        """Количество свободных аккаунтов типа по счетчикам пула"""
+        with self.lock:
+            return self.pool.count(account_type)
+    
+    def find_rental_by_order(self, order_id):
+        """Первая аренда, выданная по заказу, или None"""
+        rentals = self.find_rentals_by_order(order_id)
+        return rentals[0] if rentals else None
+    
+    def find_rentals_by_order(self, order_id):
+        """Все аренды, выданные по заказу, в порядке выдачи"""
+        return [self.rentals[rental_id] for rental_id in self.orders.get(normalize_order_id(order_id), ())
+                if rental_id in self.rentals]
+    
+    def claim_order(self, order_id):
+        """Занимает заказ перед выдачей: "claimed", "fulfilled" (уже выдан) или "in_flight" (выдается)"""
+        key = normalize_order_id(order_id)
+        with self.lock:
+            if key in self.orders:
+                return "fulfilled"
+            if key in self.orders_in_flight:
+                return "in_flight"
+            self.orders_in_flight.add(key)
+            return "claimed"
+    
+    def release_order(self, order_id):
+        """Снимает отметку выдачи; выполненный заказ остается в индексе"""
+        with self.lock:
+            self.orders_in_flight.discard(normalize_order_id(order_id))
+    
     def return_account(self, rental_id):
         """Возвращает аккаунт от аренды"""
-        if rental_id not in self.rentals:
-            return False, "Аренда не найдена"
-        
-        rental = self.rentals[rental_id]
-        if not rental.is_active:
-            return False, "Аренда уже завершена"
-        
-        # Находим аккаунт
-        if rental.account_login not in self.accounts:
-            logger.error(f"{LOGGER_PREFIX} Аккаунт для аренды {rental_id} не найден")
+        with tracer.trace("return", rental_id):
+            return self._return_account(rental_id)
+    
+    def _return_account(self, rental_id):
+        # Закрываем аренду под блокировкой, а обращения к Steam выполняем без нее,
+        # чтобы несколько возвратов шли параллельно
+        with self.lock:
+            if rental_id not in self.rentals:
+                return False, "Аренда не найдена", None
+            
+            rental = self.rentals[rental_id]
+            if not rental.is_active:
+                return False, "Аренда уже завершена", None
+            
+            # Находим аккаунт
+            if rental.account_login not in self.accounts:
+                logger.error(f"{LOGGER_PREFIX} Аккаунт для аренды {rental_id} не найден")
+                rental.is_active = False
+                self._refresh_index().remove(rental)
+                self.save_data()
+                return False, "Аккаунт не найден", None
+            
+            account = self.accounts[rental.account_login]
+            
+            # Аккаунт остается занятым до конца смены пароля
+            account.rental_id = None
             rental.is_active = False
-            self.save_data()
-            return False, "Аккаунт не найден"
-        
-        account = self.accounts[rental.account_login]
-        
-        # Обновляем статус
-        account.status = "available"
-        account.rental_id = None
-        rental.is_active = False
+            self._refresh_index().remove(rental)
+            demand.remove_expiry(account.type, rental.id, rental.end_time)
         
         # Генерируем новый пароль и завершаем сессии
-        new_password = account.change_password()
+        with tracer.span("change_password"):
+            new_password = account.change_password(persist=self.save_rotation)
+        if account.pending_rotation:
+            # Steam не подтвердил смену: аккаунт остается занятым, пока поток проверки не доведет смену до конца
+            with self.lock:
+                self.rotation_queue[account.login] = None
         
         # Завершаем сессии
         try:
-            account.end_session()
+            with tracer.span("end_session"):
+                account.end_session()
             logger.info(f"{LOGGER_PREFIX} Сессии для аккаунта {account.login} завершены")
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Ошибка завершения сессий для аккаунта {account.login}: {e}")
         
-        # Сохраняем данные
-        self.save_data()
+        # Обновляем статус и сохраняем данные
+        with self.lock:
+            account.last_rental_end = time.time()
+            if not account.pending_rotation:
+                self.settle_returned(account)
+            self.save_data()
         
+        live_board.notify("rental_end")
+        backorders.notify()
         return True, "Аккаунт успешно возвращен", new_password
     
+    def find_expired_rentals(self):
+        """Возвращает id активных аренд с истекшим сроком"""
+        return [rental_id for rental_id, rental in list(self.rentals.items())
+                if rental.is_active and rental.is_expired()]
+    
+    def expire_rental(self, rental_id):
+        """Завершает истекшую аренду, возвращает (rental, account, new_password) или None"""
+        rental = self.rentals.get(rental_id)
+        if not rental or not rental.is_active or rental.account_login not in self.accounts:
+            return None
+        
+        account = self.accounts[rental.account_login]
+        metrics.observe("steamrent_expiry_lag_seconds", max(0.0, time.time() - rental.end_time),
+                        buckets=EXPIRY_LAG_BUCKETS)
+        success, message, new_password = self.return_account(rental_id)
+        if not success:
+            try:
+                logger.error(f"{LOGGER_PREFIX} Ошибка возврата истекшей аренды: {message}")
+            except Exception:
+                pass
+            return None
+        
+        metrics.inc("steamrent_rentals_expired_total")
+        return rental, account, new_password
+    
     def check_expired_rentals(self):
         """Проверяет истекшие аренды и возвращает их список"""
         expired_rentals = []
         
-        for rental_id, rental in list(self.rentals.items()):
-            if rental.is_active and rental.is_expired():
-                account_login = rental.account_login
-                if account_login in self.accounts:
-                    account = self.accounts[account_login]
-                    success, message, new_password = self.return_account(rental_id)
-                    if success:
-                        expired_rentals.append((rental, account, new_password))
-                    else:
-                        try:
-                            logger.error(f"{LOGGER_PREFIX} Ошибка возврата истекшей аренды: {message}")
-                        except Exception:
-                            pass
+        for rental_id in self.find_expired_rentals():
+            result = self.expire_rental(rental_id)
+            if result:
+                expired_rentals.append(result)
         
         return expired_rentals
     
+    def reconcile(self):
+        """Сверяет аккаунты и аренды после перезапуска, возвращает (исправления, число завершенных аренд)"""
+        now = time.time()
+        repairs = []
+        expired = 0
+        active_by_login = {}  # login -> активная аренда
+        
+        # Проход по арендам: аренды без аккаунта и дубли на одном аккаунте
+        for rental in self.rentals.values():
+            if not rental.is_active:
+                continue
+            if rental.account_login not in self.accounts:
+                rental.is_active = False
+                repairs.append(f"Аренда {rental.username} закрыта: аккаунт {rental.account_login} не найден")
+                continue
+            other = active_by_login.get(rental.account_login)
+            if other:
+                # Оставляем аренду, которая заканчивается позже
+                stale, rental = (other, rental) if other.end_time <= rental.end_time else (rental, other)
+                stale.is_active = False
+                repairs.append(f"Аренда {stale.username} на {stale.account_login} закрыта: на аккаунте две активные аренды")
+            active_by_login[rental.account_login] = rental
+        
+        # Проход по аккаунтам: статус должен совпадать с активной арендой
+        for login, account in self.accounts.items():
+            rental = active_by_login.get(login)
+            
+            if account.pending_rotation:
+                self.rotation_queue[login] = None
+                repairs.append(f"{login}: смена пароля прервана, будет проверена")
+            
+            if rental is None:
+                if account.status == "rented":
+                    # Аренды нет или она завершена: пароль мог остаться у арендатора, меняем его перед выдачей
+                    account.rental_id = None
+                    self.rotation_queue.setdefault(login, None)
+                    repairs.append(f"{login}: помечен арендованным без активной аренды, будет освобожден")
+                elif account.rental_id:
+                    account.rental_id = None
+                    repairs.append(f"{login}: удалена ссылка на завершенную аренду")
+                continue
+            
+            if account.rental_id != rental.id or account.status == "available":
+                account.rental_id = rental.id
+                if account.status == "available":
+                    account.status = "rented"
+                    self.pool.take(login)
+                repairs.append(f"{login}: восстановлена связь с арендой {rental.username}")
+            
+            if rental.end_time <= now:
+                # Аренда истекла, пока плагин был выключен: закрываем сразу, пароль меняем в фоне
+                metrics.observe("steamrent_expiry_lag_seconds", now - rental.end_time, buckets=EXPIRY_LAG_BUCKETS)
+                rental.is_active = False
+                account.rental_id = None
+                self.rotation_queue[login] = rental.id
+                expired += 1
+        
+        if repairs or expired:
+            self.index_version += 1
+            self.save_data()
+        return repairs, expired
+    
+    def process_rotation_queue(self):
+        """Меняет пароли из очереди; возвращает (rental, account, new_password) для завершенных аренд"""
+        finished = []
+        changed = False
+        
+        # Очередь и учет меняем под блокировкой, обращения к Steam выполняем без нее
+        with self.lock:
+            queued = list(self.rotation_queue.items())
+        
+        for login, rental_id in queued:
+            with self.lock:
+                account = self.accounts.get(login)
+                if not account:
+                    self.rotation_queue.pop(login, None)
+                    continue
+            
+            # Сначала разбираемся с неподтвержденной сменой пароля
+            rotated = False
+            if account.pending_rotation:
+                account.resolve_pending_rotation()
+                changed = True
+                if account.pending_rotation:
+                    continue
+                # Смена подтверждена или попытки исчерпаны: тогда account.quarantine уведет аккаунт в карантин
+                rotated = True
+            
+            # Аккаунт освобождается только после смены пароля
+            if account.status == "rented" and not account.rental_id:
+                if not rotated:
+                    with tracer.span("change_password"):
+                        account.change_password(persist=self.save_rotation)
+                    changed = True
+                    if account.pending_rotation:
+                        continue
+                new_password = account.password
+                try:
+                    with tracer.span("end_session"):
+                        account.end_session()
+                except Exception as e:
+                    logger.error(f"{LOGGER_PREFIX} Ошибка завершения сессий для аккаунта {login}: {e}")
+                with self.lock:
+                    account.last_rental_end = time.time()
+                    self.settle_returned(account)
+                    rental = self.rentals.get(rental_id) if rental_id else None
+                if rental:
+                    metrics.inc("steamrent_rentals_expired_total")
+                    finished.append((rental, account, new_password))
+            elif account.status == "available":
+                # Свободный аккаунт после сброса пароля тоже проходит проверку здоровья
+                with self.lock:
+                    self.settle_returned(account)
+            else:
+                with self.lock:
+                    self.pool.push(account)
+            
+            with self.lock:
+                self.rotation_queue.pop(login, None)
+        
+        if changed:
+            self.save_data()
+        return finished
+    
+    def settle_returned(self, account):
+        """Возвращенный аккаунт уходит в пул свободных или, если нездоров, в карантин; True - в пуле"""
+        if account.quarantine or not account.is_healthy():
+            reason = (account.quarantine or {}).get("reason") or f"здоровье {account.health}"
+            self._quarantine(account, reason)
+            return False
+        account.status = "available"
+        self.pool.push(account)
+        return True
+    
+    def _quarantine(self, account, reason):
+        # Куча пула отбросит запись аккаунта сама: он больше не свободен
+        account.status = "quarantined"
+        self.pool.take(account.login)
+        account.quarantine = {"reason": reason, "since": time.time(), "checks": 0,
+                              "next_check": time.time() + QUARANTINE_RECHECK_INTERVAL}
+        self.quarantined.add(account.login)
+        metrics.inc("steamrent_quarantined_total")
+        logger.warning(f"{LOGGER_PREFIX} Аккаунт {account.login} помещен в карантин: {reason}")
+        notify_admin(
+            f"🟡 <b>Аккаунт в карантине</b>\n\n"
+            f"Аккаунт: <code>{account.login}</code>\n"
+            f"Тип: <code>{account.type}</code>\n"
+            f"Причина: {reason}\n"
+            f"Здоровье: <b>{account.health}</b>\n\n"
+            f"Аккаунт не выдается до перепроверки. Вернуть вручную: <code>/srent_health release {account.login}</code>"
+        )
+    
+    def quarantine_account(self, login, reason):
+        """Убирает аккаунт из выдачи; арендованный уйдет в карантин после возврата"""
+        with self.lock:
+            account = self.accounts.get(login)
+            if not account:
+                return False, "Аккаунт не найден"
+            if account.status == "quarantined":
+                return False, "Аккаунт уже в карантине"
+            if account.status == "rented":
+                account.quarantine = {"reason": reason, "since": None, "checks": 0, "next_check": None}
+                self.save_data()
+                return True, "Аккаунт уйдет в карантин после окончания аренды"
+            self._quarantine(account, reason)
+            self.save_data()
+        return True, "Аккаунт помещен в карантин"
+    
+    def release_account(self, login):
+        """Возвращает аккаунт из карантина в пул свободных"""
+        with self.lock:
+            account = self.accounts.get(login)
+            if not account or login not in self.quarantined:
+                return False, "Аккаунт не в карантине"
+            self.quarantined.discard(login)
+            account.quarantine = None
+            account.health = max(account.health, HEALTH_RELEASE_SCORE)
+            account.status = "available"
+            self.pool.push(account)
+            self.save_data()
+        backorders.notify()
+        return True, "Аккаунт возвращен в пул свободных"
+    
+    def record_complaint(self, rental):
+        """Учитывает жалобу покупателя на аккаунт аренды (одну на аренду); возвращает аккаунт или None"""
+        with self.lock:
+            account = self.accounts.get(rental.account_login)
+            if not account or rental.complained:
+                return None
+            rental.complained = True
+            account.complaints += 1
+            account.adjust_health(-HEALTH_COMPLAINT_PENALTY)
+            self.save_data()
+        metrics.inc("steamrent_complaints_total")
+        return account
+    
+    def recheck_quarantine(self):
+        """Перепроверяет аккаунты карантина, у которых подошел срок; возвращает [(account, освобожден)]"""
+        now = time.time()
+        with self.lock:
+            due = [self.accounts[login] for login in self.quarantined
+                   if login in self.accounts and self.accounts[login].api_key
+                   and not self.accounts[login].pending_rotation
+                   and (self.accounts[login].quarantine or {}).get("next_check", 0) <= now]
+        
+        results = []
+        for account in due:
+            # Аккаунт здоров, если Steam принимает вход и смену пароля
+            started = time.time()
+            with tracer.span("quarantine_recheck"):
+                account.change_password(persist=self.save_rotation)
+            if account.last_rotation and account.last_rotation >= started:
+                self.release_account(account.login)
+                metrics.inc("steamrent_quarantine_rechecks_total", result="released")
+                results.append((account, True))
+                continue
+            with self.lock:
+                if account.pending_rotation:
+                    self.rotation_queue[account.login] = None
+                quarantine = account.quarantine or {}
+                quarantine["checks"] = quarantine.get("checks", 0) + 1
+                quarantine["next_check"] = time.time() + min(QUARANTINE_RECHECK_MAX_INTERVAL,
+                                                             QUARANTINE_RECHECK_INTERVAL * 2 ** quarantine["checks"])
+                account.quarantine = quarantine
+                self.save_data()
+            metrics.inc("steamrent_quarantine_rechecks_total", result="failed")
+            results.append((account, False))
+        return results
+    
     def get_account_by_type(self, account_type):
         """Возвращает доступный аккаунт указанного типа"""
         if not account_type:
             return None
+        return self.get_available_account(account_type)
+    
+    def extend_rental(self, rental_id, additional_hours, order_id=None):
+        """Продлевает аренду на указанное количество часов; заказ продления попадает в индекс заказов"""
+        with self.lock:
+            if rental_id not in self.rentals:
+                return False, "Аренда не найдена"
             
-        logger.info(f"{LOGGER_PREFIX} Поиск аккаунта по типу: {account_type}")
+            rental = self.rentals[rental_id]
+            if not rental.is_active:
+                return False, "Аренда уже завершена"
+            if rental.is_expired():
+                return False, "Срок аренды истек, аккаунт возвращается"
             
-        # Нормализация типа для лучшего сравнения
-        normalized_type = account_type.lower().replace('.', '').replace(' ', '')
-        logger.info(f"{LOGGER_PREFIX} Нормализованный тип: {normalized_type}")
-        
-        # Вывод всех доступных типов для отладки
-        available_types = [(account.login, account.type, account.status) for account in self.accounts.values()]
-        logger.info(f"{LOGGER_PREFIX} Доступные аккаунты: {available_types}")
-        
-        # Сначала пытаемся найти точное совпадение
-        for login, account in self.accounts.items():
-            if account.status == "available" and account.type.lower() == account_type.lower():
-                logger.info(f"{LOGGER_PREFIX} Найдено точное совпадение: {login} ({account.type})")
-                return account
-                
-        # Если не нашли точное совпадение, ищем, убрав специальные символы
-        for login, account in self.accounts.items():
-            if account.status == "available":
-                normalized_account_type = account.type.lower().replace('.', '').replace(' ', '')
-                if normalized_account_type == normalized_type:
-                    logger.info(f"{LOGGER_PREFIX} Найдено совпадение по нормализации: {login} ({account.type})")
-                    return account
-                    
-        # Специальная обработка для R.E.P.O / REPO
-        if normalized_type == "repo":
-            for login, account in self.accounts.items():
-                if account.status == "available":
-                    acc_type = account.type.lower().replace('.', '').replace(' ', '')
-                    if acc_type == "repo":
-                        logger.info(f"{LOGGER_PREFIX} Найдено совпадение REPO: {login} ({account.type})")
-                        return account
-        
-        logger.warning(f"{LOGGER_PREFIX} Не найдено доступных аккаунтов типа {account_type}")                
-        return None
-    
-    def extend_rental(self, rental_id, additional_hours):
-        """Продлевает аренду на указанное количество часов"""
-        if rental_id not in self.rentals:
-            return False, "Аренда не найдена"
-        
-        rental = self.rentals[rental_id]
-        if not rental.is_active:
-            return False, "Аренда уже завершена"
-        
-        # Продлеваем аренду
-        rental.extend_rental(additional_hours)
-        self.save_data()
+            # Продлеваем аренду: новое время окончания проверка истечения увидит на следующем проходе
+            index = self._refresh_index()
+            old_end_time = rental.end_time
+            rental.extend_rental(additional_hours)
+            index.move(rental, old_end_time)
+            account = self.accounts.get(rental.account_login)
+            if account:
+                account.rented_hours += additional_hours
+                demand.remove_expiry(account.type, rental.id, old_end_time)
+                demand.add_expiry(account.type, rental)
+            if order_id:
+                self.orders[normalize_order_id(order_id)] = [rental.id]
+            self.save_data()
+        # Старые таймеры аренды отбросятся при срабатывании: время окончания не совпадет
+        reminders.schedule(rental)
+        live_board.notify("rental_extend")
         
         return True, f"Аренда продлена на {additional_hours} ч. Новое время окончания: {rental.get_formatted_end_time()}"
     
@@ -729,12 +2896,17 @@ class RentalManager:
         if account.status == "rented":
             return False, "Нельзя сбросить пароль арендованного аккаунта"
         
-        # Сбрасываем пароль
-        if account.reset_to_original_password():
+        # Сбрасываем пароль; пока Steam не подтвердит смену, аккаунт не считается свободным
+        reset = account.reset_to_original_password(persist=self.save_rotation)
+        self.pool.push(account)
+        if reset:
             self.save_data()
             return True, f"Пароль аккаунта сброшен к исходному: {account.password}"
-        else:
-            return False, "Не удалось сбросить пароль (исходный пароль не сохранен)"
+        if account.pending_rotation:
+            self.rotation_queue[login] = None
+            self.save_data()
+            return False, "Steam не подтвердил смену пароля, попытка будет повторена автоматически"
+        return False, "Не удалось сбросить пароль (исходный пароль не сохранен)"
     
     def get_account_info(self, login):
         """Возвращает подробную информацию об аккаунте"""
@@ -772,13 +2944,13 @@ class RentalManager:
         
         return info
 
-# Создаем глобальный менеджер аренды
-rental_manager = RentalManager()
+# Создаем глобальный менеджер аренды; данные загружаются в фоне после init_plugin
+rental_manager = RentalManager(autoload=False)
 
 # Добавим функцию для загрузки конфигурации
 def load_config():
     """Загружает настройки из файла конфигурации"""
-    global AUTO_START, admin_id, message_templates
+    global AUTO_START, admin_id, message_templates, DIGEST_MODE, DIGEST_WINDOW, ALLOCATION_POLICY, REMINDER_MINUTES
     
     # Загружаем основные настройки
     if os.path.exists(CONFIG_FILE):
@@ -788,6 +2960,11 @@ def load_config():
                 AUTO_START = config.get("auto_start", AUTO_START)
                 if "admin_id" in config and config["admin_id"] is not None:
                     admin_id = config["admin_id"]
+                DIGEST_MODE = config.get("digest_mode", DIGEST_MODE)
+                DIGEST_WINDOW = config.get("digest_window", DIGEST_WINDOW)
+                if config.get("allocation_policy") in ALLOCATION_POLICIES:
+                    ALLOCATION_POLICY = config["allocation_policy"]
+                REMINDER_MINUTES = config.get("reminder_minutes", REMINDER_MINUTES)
                 logger.info(f"{LOGGER_PREFIX} Загружена настройка автозапуска: {AUTO_START}")
                 logger.info(f"{LOGGER_PREFIX} Загружен admin_id: {admin_id}")
         except Exception as e:
@@ -802,6 +2979,9 @@ def load_config():
             with open(TEMPLATES_FILE, "r", encoding="utf-8") as f:
                 message_templates = json.load(f)
                 logger.info(f"{LOGGER_PREFIX} Загружено {len(message_templates)} шаблонов сообщений")
+            # Шаблоны, добавленные в новых версиях, дополняют сохраненные
+            for name, template in DEFAULT_TEMPLATES.items():
+                message_templates.setdefault(name, template)
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Ошибка загрузки шаблонов сообщений: {e}")
             # Используем стандартные шаблоны
@@ -817,7 +2997,11 @@ def save_config():
     try:
         config = {
             "auto_start": AUTO_START,
-            "admin_id": admin_id
+            "admin_id": admin_id,
+            "digest_mode": DIGEST_MODE,
+            "digest_window": DIGEST_WINDOW,
+            "allocation_policy": ALLOCATION_POLICY,
+            "reminder_minutes": REMINDER_MINUTES
         }
         with open(CONFIG_FILE, "w", encoding="utf-8") as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
@@ -840,7 +3024,9 @@ def save_templates():
 
 def load_lot_bindings():
     """Загружает привязки лотов из файла"""
-    global lot_bindings
+    global lot_bindings, BINDINGS_VERSION
+    
+    BINDINGS_VERSION += 1
     
     if os.path.exists(LOT_BINDINGS_FILE):
         try:
@@ -856,12 +3042,14 @@ def load_lot_bindings():
 
 def save_lot_bindings():
     """Сохраняет привязки лотов в файл"""
+    global BINDINGS_VERSION
+    
+    BINDINGS_VERSION += 1
     try:
         # Убедимся, что директория существует
         os.makedirs(os.path.dirname(LOT_BINDINGS_FILE), exist_ok=True)
         
-        with open(LOT_BINDINGS_FILE, "w", encoding="utf-8") as f:
-            json.dump(lot_bindings, f, ensure_ascii=False, indent=2)
+        write_json_file(LOT_BINDINGS_FILE, lot_bindings)
         logger.info(f"{LOGGER_PREFIX} Сохранено {len(lot_bindings)} привязок лотов")
         return True
     except Exception as e:
@@ -927,18 +3115,12 @@ def set_admin_id_cmd(message):
             parse_mode="HTML"
         )
 
-def set_admin_id_callback(call):
+def set_admin_id_callback(call, chat_id_str):
     """Устанавливает ID администратора через callback"""
     global admin_id
     
-    # Получаем ID из callback data
-    data = call.data.split('_')
-    if len(data) < 4:
-        CARDINAL.telegram.bot.answer_callback_query(call.id, "Ошибка в данных callback")
-        return
-    
     try:
-        new_admin_id = int(data[3])
+        new_admin_id = int(chat_id_str)
         admin_id = new_admin_id
         save_config()
         
@@ -1077,10 +3259,7 @@ def edit_template_cmd(message):
         template = message_templates[text]
         
         # Сохраняем состояние редактирования
-        EDIT_TEMPLATE_STATES[message.chat.id] = {
-            "template_name": text,
-            "editing": True
-        }
+        conversations.start(message.chat.id, "edit_template", "text", {"template_name": text})
         
         CARDINAL.telegram.bot.send_message(
             message.chat.id,
@@ -1108,20 +3287,51 @@ def edit_template_cmd(message):
             parse_mode="HTML"
         )
 
-def handle_template_edit(message):
+TEMPLATE_FIELDS = ("login", "password", "account_type", "duration_hours", "end_time",
+                   "username", "order_id", "new_password")
+
+def handle_template_edit(message, conversation=None):
     """Обрабатывает ввод нового текста для шаблона"""
-    # Проверяем, находится ли пользователь в процессе редактирования шаблона
-    if message.chat.id in EDIT_TEMPLATE_STATES:
-        if handle_template_edit(message):
-            return True
+    chat_id = message.chat.id
+    conversation = conversation or conversations.get(chat_id, "edit_template")
+    if not conversation:
+        return False
     
-    # Проверяем, находится ли пользователь в процессе добавления привязки
-    if message.chat.id in ADD_BINDING_STATES:
-        if handle_binding_add_steps(message):
-            return True
+    template_name = conversation["data"]["template_name"]
+    text = message.text or ""
+    
+    # Проверяем запрос на отмену
+    if text.lower() in ["отмена", "cancel", "/cancel", "/отмена"]:
+        conversations.finish(chat_id)
+        CARDINAL.telegram.bot.send_message(chat_id, "❌ Редактирование шаблона отменено.")
+        return True
+    
+    # Проверяем, что шаблон подставляется без ошибок
+    try:
+        text.format(**{field: "" for field in TEMPLATE_FIELDS})
+    except (KeyError, IndexError, ValueError) as e:
+        CARDINAL.telegram.bot.send_message(
+            chat_id,
+            f"❌ <b>Ошибка в шаблоне:</b> {e}\n\n"
+            "Проверьте имена переменных в фигурных скобках и отправьте текст еще раз "
+            "или напишите <code>отмена</code>.",
+            parse_mode="HTML"
+        )
+        return True
     
-    # Если не редактируем шаблон и не добавляем привязку, проверяем добавление аккаунта
-    return handle_account_add_steps(message)
+    message_templates[template_name] = text
+    save_templates()
+    conversations.finish(chat_id)
+    
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("📝 К шаблонам", callback_data="srent_list_templates"))
+    CARDINAL.telegram.bot.send_message(
+        chat_id,
+        f"✅ Шаблон <b>{template_name}</b> сохранен.",
+        reply_markup=markup,
+        parse_mode="HTML"
+    )
+    return True
 
 def reset_templates_cmd(message):
     """Сбрасывает все шаблоны к стандартным значениям"""
@@ -1181,58 +3391,82 @@ def reset_templates_cancel_callback(call):
     
     CARDINAL.telegram.bot.answer_callback_query(call.id, "Операция отменена")
 
+# Уведомления об окончании аренды
+def notify_rental_expired(rental, account, new_password):
+    """Уведомляет покупателя и администратора об окончании аренды"""
+    logger.info(f"{LOGGER_PREFIX} Аренда истекла: {rental.account_login} ({rental.username})")
+    
+    # Отправляем уведомление пользователю; несколько аренд одного покупателя, истекших вместе, - одним сообщением
+    funpay_delivery.enqueue(
+        rental.user_id,
+        rental.username,
+        "Срок аренды аккаунта Steam истек. Доступ прекращен, пароль изменен.",
+        kind="rental_end"
+    )
+    
+    # Отправляем уведомление администратору; чат выбирает notify_admin, как и для остальных событий
+    admin_digest.add(
+        "expired",
+        f"{rental.username}: <code>{rental.account_login}</code> ({account.type}), новый пароль <code>{new_password}</code>",
+        format_message("admin_rental_end", 
+            username=rental.username,
+            login=rental.account_login,
+            account_type=account.type,
+            new_password=new_password
+        )
+    )
+
 # Отдельный поток для проверки истекших аренд
 def check_rentals_thread():
     """Запускает проверку истекших аренд в отдельном потоке"""
     logger.info(f"{LOGGER_PREFIX} Запущен поток проверки истекших аренд")
     
+    # Не проверяем аренды, пока они не загружены
+    STATE_READY.wait()
+    
     while True:
         try:
+            # Доводим до конца смены паролей, отложенные при сбоях и восстановлении
+            if rental_manager.rotation_queue:
+                for result in rental_manager.process_rotation_queue():
+                    notify_rental_expired(*result)
+            
             if RUNNING:
                 # Проверяем истекшие аренды
-                expired_rentals = rental_manager.check_expired_rentals()
+                expired_ids = rental_manager.find_expired_rentals()
                 
-                # Обрабатываем истекшие аренды
-                for rental, account, new_password in expired_rentals:
-                    logger.info(f"{LOGGER_PREFIX} Аренда истекла: {rental.account_login} ({rental.username})")
-                    
-                    # Отправляем уведомление пользователю
-                    try:
-                        # Отправляем простое текстовое сообщение
-                        message = "Срок аренды аккаунта Steam истек. Доступ прекращен, пароль изменен."
-                        
-                        if hasattr(CARDINAL, 'account') and hasattr(CARDINAL.account, 'send_message'):
-                            # Получаем данные чата
-                            chat_id = f"users-{rental.user_id}-{CARDINAL.account.id}"
-                            interlocutor_id = rental.user_id
-                            chat_name = f"Переписка с {rental.username}"
-                            
-                            # Используем низкоуровневый метод отправки сообщений
-                            CARDINAL.account.send_message(chat_id, message, chat_name, interlocutor_id, None, True, False, False)
-                            logger.info(f"{LOGGER_PREFIX} Сообщение об окончании аренды отправлено пользователю {rental.username}")
-                        else:
-                            logger.warning(f"{LOGGER_PREFIX} Невозможно отправить сообщение: методы отправки недоступны")
-                    except Exception as e:
-                        logger.error(f"{LOGGER_PREFIX} Ошибка отправки сообщения об окончании аренды: {e}")
-                    
-                    # Отправляем уведомление администратору
-                    if admin_id:
-                        try:
-                            admin_message = format_message("admin_rental_end", 
-                                username=rental.username,
-                                login=rental.account_login,
-                                account_type=account.type,
-                                new_password=new_password
-                            )
-                            
-                            CARDINAL.telegram.bot.send_message(
-                                admin_id,
-                                admin_message,
-                                parse_mode="HTML"
-                            )
-                        except Exception as e:
-                            logger.error(f"{LOGGER_PREFIX} Ошибка отправки уведомления администратору: {e}")
+                # Обрабатываем истекшие аренды, каждую в своей трассе
+                for rental_id in expired_ids:
+                    with tracer.trace("expiry", rental_id):
+                        result = rental_manager.expire_rental(rental_id)
+                        if result:
+                            notify_rental_expired(*result)
+
+            # Изменения без отдельного события (аккаунты, запуск/остановка) попадают на панель раз в минуту
+            live_board.notify_if_changed()
+            
+            # Перепроверяем аккаунты карантина, у которых подошел срок
+            if rental_manager.quarantined:
+                for account, released in rental_manager.recheck_quarantine():
+                    if released:
+                        notify_admin(f"🩺 Аккаунт <code>{account.login}</code> прошел перепроверку и возвращен из карантина")
+            
+            # Ждущие заказы получают аккаунты, освобожденные без отдельного события (смена пароля, включение)
+            backorders.notify()
+            
+            # Прогноз запаса меняется и без заказов: предупреждаем заранее и сохраняем статистику
+            demand.check_alerts()
+            demand.save()
+            
+            # Отправляем сводку для администратора, если окно истекло
+            admin_digest.flush()
+            
+            # Забываем брошенные диалоги
+            conversations.evict_expired()
             
+            # Выгружаем метрики для внешнего сборщика
+            metrics.dump()
+
             # Пауза между проверками
             time.sleep(60)  # Проверяем каждую минуту
             
@@ -1240,7 +3474,982 @@ def check_rentals_thread():
             logger.error(f"{LOGGER_PREFIX} Ошибка в потоке проверки аренд: {e}")
             time.sleep(60)  # В случае ошибки тоже ждем минуту
 
+# Живая панель статуса
+LIVE_BOARD_MIN_INTERVAL = 3.0  # Не чаще одного редактирования панелей за столько секунд
+LIVE_BOARD_LOW_STOCK = 1  # Пул считается почти пустым при стольких свободных аккаунтах
+LIVE_BOARD_RENTALS = 5  # Сколько ближайших завершений показывать
+
+def build_live_board_view():
+    """Строит текст закрепленной панели; без обратного отсчета, чтобы она не менялась без событий"""
+    status_emoji = "🟢" if RUNNING else "🔴"
+    text = "📌 <b>ПАНЕЛЬ АРЕНДЫ</b>\n\n"
+    text += f"<b>Статус:</b> {status_emoji} <b>{'АКТИВНА' if RUNNING else 'ОСТАНОВЛЕНА'}</b>\n"
+    text += "━━━━━━━━━━━━━━━━━━━━━━\n"
+    
+    # Пулы аккаунтов: свободно / всего. Панель строится в своем потоке, поэтому данные снимаем под блокировкой
+    pools = {}
+    with rental_manager.lock:
+        for account in rental_manager.accounts.values():
+            pool = pools.setdefault(account.type, [0, 0])
+            pool[1] += 1
+            if account.is_available():
+                pool[0] += 1
+        active = rental_manager.search_active_rentals()
+    text += "🖥️ <b>ПУЛЫ</b> (свободно / всего)\n"
+    if not pools:
+        text += "Аккаунтов нет\n"
+    for acc_type, (available, total) in sorted(pools.items()):
+        warning = " ⚠️ мало" if available <= LIVE_BOARD_LOW_STOCK else ""
+        text += f"• <b>{acc_type.upper()}</b>: {available} / {total}{warning}\n"
+    text += "━━━━━━━━━━━━━━━━━━━━━━\n"
+    
+    # Ближайшие завершения аренд
+    text += f"⏰ <b>АРЕНДЫ:</b> {len(active)} активных\n"
+    for rental in active[:LIVE_BOARD_RENTALS]:
+        text += f"• {rental.username}: <code>{rental.account_login}</code> до {datetime.fromtimestamp(rental.end_time).strftime('%H:%M')}\n"
+    if len(active) > LIVE_BOARD_RENTALS:
+        text += f"… и еще {len(active) - LIVE_BOARD_RENTALS}\n"
+    text += "━━━━━━━━━━━━━━━━━━━━━━\n"
+    text += "<i>Обновляется автоматически. /srent_live - отключить</i>"
+    return text, None
+
+class LiveBoard:
+    """Закрепленные сообщения со статусом, которые обновляются по событиям аренды"""
+    
+    def __init__(self, path=None, min_interval=LIVE_BOARD_MIN_INTERVAL):
+        self.path = path
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.boards = {}  # chat_id -> message_id
+        self.changed = threading.Event()
+        self.last_push = 0.0
+        self.pushed_version = None
+        self.thread = None
+    
+    def notify(self, reason):
+        """Отмечает изменение; без включенных панелей ничего не делает"""
+        if not self.boards:
+            return
+        metrics.inc("steamrent_live_board_events_total", reason=reason)
+        self.changed.set()
+    
+    def notify_if_changed(self):
+        if self.boards and view_state_version() != self.pushed_version:
+            self.notify("state")
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        STATE_READY.wait()
+        while True:
+            # Простаивает без событий; пачку событий за интервал сводим в одно редактирование
+            self.changed.wait()
+            delay = self.last_push + self.min_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.changed.clear()
+            try:
+                self.push()
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка обновления панели статуса: {e}")
+            self.last_push = time.monotonic()
+    
+    def push(self):
+        """Редактирует все панели, на которых содержимое устарело"""
+        self.pushed_version = view_state_version()
+        text, markup = render_cache.render("live_board", build_live_board_view)
+        digest = render_cache.content_hash(text, markup)
+        with self.lock:
+            boards = list(self.boards.items())
+        
+        for chat_id, message_id in boards:
+            if render_cache.is_shown(chat_id, message_id, digest):
+                continue
+            try:
+                CARDINAL.telegram.bot.edit_message_text(text, chat_id, message_id, parse_mode="HTML")
+                metrics.inc("steamrent_live_board_edits_total")
+            except Exception as e:
+                if "message is not modified" not in str(e):
+                    # Сообщение удалено или недоступно - панель отключается
+                    logger.warning(f"{LOGGER_PREFIX} Панель статуса в чате {chat_id} отключена: {e}")
+                    self.remove(chat_id)
+                    continue
+            render_cache.remember(chat_id, message_id, digest)
+    
+    def enable(self, chat_id):
+        """Отправляет и закрепляет панель в чате"""
+        text, markup = render_cache.render("live_board", build_live_board_view)
+        sent = CARDINAL.telegram.bot.send_message(chat_id, text, parse_mode="HTML")
+        try:
+            CARDINAL.telegram.bot.pin_chat_message(chat_id, sent.message_id, disable_notification=True)
+        except Exception as e:
+            logger.warning(f"{LOGGER_PREFIX} Не удалось закрепить панель статуса в чате {chat_id}: {e}")
+        with self.lock:
+            self.boards[chat_id] = sent.message_id
+        render_cache.remember(chat_id, sent.message_id, render_cache.content_hash(text, markup))
+        self.last_push = time.monotonic()
+        self.save()
+        self.start()
+    
+    def remove(self, chat_id):
+        """Отключает панель чата, возвращает id ее сообщения или None"""
+        with self.lock:
+            message_id = self.boards.pop(chat_id, None)
+        if message_id is not None:
+            render_cache.forget(chat_id, message_id)
+            self.save()
+        return message_id
+    
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            with self.lock:
+                self.boards = {int(chat_id): message_id for chat_id, message_id in stored.items()}
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка загрузки панелей статуса: {e}")
+        if self.boards:
+            # Данные могли измениться, пока плагин был выключен
+            self.start()
+            self.notify("startup")
+    
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with self.lock:
+                snapshot = {str(chat_id): message_id for chat_id, message_id in self.boards.items()}
+            write_json_file(self.path, snapshot)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения панелей статуса: {e}")
+
+live_board = LiveBoard(LIVE_BOARDS_FILE)
+
+def live_board_cmd(message):
+    """Включает/выключает закрепленную панель статуса в текущем чате"""
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может управлять панелью статуса.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        message_id = live_board.remove(message.chat.id)
+        if message_id is not None:
+            try:
+                CARDINAL.telegram.bot.unpin_chat_message(message.chat.id, message_id)
+            except Exception:
+                pass
+            CARDINAL.telegram.bot.send_message(message.chat.id, "📌 Панель статуса отключена")
+            return
+        
+        live_board.enable(message.chat.id)
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике live_board_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+# Очередь ожидания заказов
+class BackorderQueue:
+    """Заказы, которым не хватило аккаунтов: FIFO по нормализованному типу, хранится в файле"""
+    
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.queues = OrderedDict()  # нормализованный тип -> deque заказов, старые первыми
+        self.wakeup = threading.Event()
+        self.thread = None
+    
+    def __len__(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+    
+    def pending(self, account_type):
+        """Сколько заказов типа ждет в очереди"""
+        with self.lock:
+            return len(self.queues.get(normalize_account_type(account_type), ()))
+    
+    def contains(self, order_id):
+        key = normalize_order_id(order_id)
+        with self.lock:
+            return any(normalize_order_id(entry["order_id"]) == key
+                       for queue in self.queues.values() for entry in queue)
+    
+    def add(self, order_id, user_id, username, account_type, duration_hours, count=1):
+        """Ставит заказ в конец очереди типа; возвращает (место, ожидаемое время выдачи или None)"""
+        normalized_type = normalize_account_type(account_type)
+        with self.lock:
+            queue = self.queues.setdefault(normalized_type, deque())
+            queue.append({"order_id": str(order_id), "user_id": user_id, "username": username,
+                          "account_type": account_type, "duration_hours": duration_hours,
+                          "count": count, "created": time.time()})
+            position = len(queue)
+            needed = sum(entry["count"] for entry in queue)
+            self.save()
+        metrics.inc("steamrent_backorders_total", event="queued")
+        # Заказ получит аккаунт, когда освободятся все аккаунты, нужные заказам перед ним
+        needed -= rental_manager.count_available(account_type)
+        eta = rental_manager.expected_return(account_type, needed) if needed > 0 else time.time()
+        return position, eta
+    
+    def remove(self, order_id):
+        """Убирает заказ из очереди; возвращает его запись или None"""
+        key = normalize_order_id(order_id)
+        with self.lock:
+            for normalized_type, queue in list(self.queues.items()):
+                for entry in queue:
+                    if normalize_order_id(entry["order_id"]) == key:
+                        queue.remove(entry)
+                        if not queue:
+                            del self.queues[normalized_type]
+                        self.save()
+                        return entry
+        return None
+    
+    def entries(self):
+        """Снимок очереди: [(место, запись)] по типам"""
+        with self.lock:
+            return [(position, dict(entry)) for queue in self.queues.values()
+                    for position, entry in enumerate(queue, 1)]
+    
+    def notify(self):
+        """Будит поток выдачи, если есть ждущие заказы"""
+        if not self.queues:
+            return
+        self.start()
+        self.wakeup.set()
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        STATE_READY.wait()
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if not RUNNING:
+                continue
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка выдачи заказов из очереди: {e}")
+    
+    def drain(self):
+        """Выдает аккаунты старейшим заказам каждого типа, пока хватает свободных"""
+        with self.lock:
+            types = list(self.queues)
+        for normalized_type in types:
+            while True:
+                with self.lock:
+                    queue = self.queues.get(normalized_type)
+                    if not queue:
+                        break
+                    entry = queue[0]
+                    if rental_manager.count_available(entry["account_type"]) < entry["count"]:
+                        break
+                    queue.popleft()
+                    if not queue:
+                        del self.queues[normalized_type]
+                    self.save()
+                if not self.fulfil(entry):
+                    # Аккаунт успели занять - заказ остается первым в очереди
+                    with self.lock:
+                        self.queues.setdefault(normalized_type, deque()).appendleft(entry)
+                        self.queues.move_to_end(normalized_type, last=False)
+                        self.save()
+                    break
+    
+    @staticmethod
+    def fulfil(entry):
+        order_id = entry["order_id"]
+        state = rental_manager.claim_order(order_id)
+        if state == "fulfilled":
+            return True
+        if state != "claimed":
+            return False
+        try:
+            with tracer.trace("backorder", order_id):
+                if not issue_order(order_id, entry["user_id"], entry["username"], entry["account_type"],
+                                   entry["duration_hours"], entry["count"]):
+                    return False
+        finally:
+            rental_manager.release_order(order_id)
+        metrics.inc("steamrent_backorders_total", event="fulfilled")
+        metrics.observe("steamrent_backorder_wait_seconds", time.time() - entry["created"], buckets=EXPIRY_LAG_BUCKETS)
+        logger.info(f"{LOGGER_PREFIX} Заказ {order_id} выдан из очереди через {int(time.time() - entry['created'])} с")
+        return True
+    
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            with self.lock:
+                self.queues = OrderedDict((normalized_type, deque(entries))
+                                          for normalized_type, entries in stored.items() if entries)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка загрузки очереди заказов: {e}")
+        # Пока плагин был выключен, аккаунты могли освободиться
+        self.notify()
+    
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with self.lock:
+                snapshot = {normalized_type: list(queue) for normalized_type, queue in self.queues.items()}
+                metrics.set_gauge("steamrent_backorders_pending", sum(len(queue) for queue in snapshot.values()))
+            write_json_file(self.path, snapshot)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения очереди заказов: {e}")
+
+backorders = BackorderQueue(BACKORDERS_FILE)
+
+def backorders_cmd(message):
+    """Показывает очередь ожидающих заказов; /srent_backorders cancel ЗАКАЗ убирает заказ из нее"""
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может управлять очередью заказов.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        parts = message.text.split()
+        if len(parts) > 2 and parts[1].lower() == "cancel":
+            entry = backorders.remove(parts[2])
+            if entry:
+                metrics.inc("steamrent_backorders_total", event="cancelled")
+                CARDINAL.telegram.bot.send_message(
+                    message.chat.id,
+                    f"🗑 Заказ <code>#{entry['order_id']}</code> ({entry['username']}) убран из очереди",
+                    parse_mode="HTML"
+                )
+            else:
+                CARDINAL.telegram.bot.send_message(message.chat.id, "❌ Такого заказа в очереди нет")
+            return
+        
+        entries = backorders.entries()
+        if not entries:
+            CARDINAL.telegram.bot.send_message(message.chat.id, "📭 Очередь заказов пуста")
+            return
+        
+        text = f"⏳ <b>Очередь заказов</b> ({len(entries)})\n\n"
+        for position, entry in entries[:30]:
+            waited = int((time.time() - entry["created"]) // 60)
+            text += (f"{position}. <code>#{entry['order_id']}</code> {entry['username']}: "
+                     f"{entry['account_type']} ×{entry['count']}, {entry['duration_hours']} ч., ждет {waited} мин.\n")
+        text += "\nУбрать заказ: <code>/srent_backorders cancel ЗАКАЗ</code>"
+        CARDINAL.telegram.bot.send_message(message.chat.id, text, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике backorders_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+# Напоминания об окончании аренды
+REMINDER_TICK = 5  # Шаг колеса таймеров, секунд
+REMINDER_WHEEL_SLOTS = 720  # Слотов в колесе: один оборот - час
+
+class TimingWheel:
+    """Хешированное колесо таймеров: добавление O(1), тик разбирает только свой слот"""
+    
+    def __init__(self, tick=REMINDER_TICK, slots=REMINDER_WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.time() // tick)  # Номер последнего обработанного тика
+        self.size = 0
+    
+    def schedule(self, when, item):
+        """Ставит item на время when; прошедшее время срабатывает на следующем тике"""
+        tick_number = max(int(when // self.tick), self.current + 1)
+        self.slots[tick_number % len(self.slots)].append((tick_number, item))
+        self.size += 1
+    
+    def advance(self, now):
+        """Продвигает колесо до now, возвращает сработавшие элементы"""
+        target = int(now // self.tick)
+        due = []
+        # После долгой паузы достаточно одного оборота: каждый слот разбирается один раз
+        ticks = range(self.current + 1, target + 1)
+        if len(ticks) > len(self.slots):
+            ticks = range(target - len(self.slots) + 1, target + 1)
+        for tick_number in ticks:
+            index = tick_number % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            # В слоте лежат и таймеры следующих оборотов - они остаются
+            keep = [entry for entry in slot if entry[0] > target]
+            due.extend(item for number, item in slot if number <= target)
+            self.slots[index] = keep
+        self.size -= len(due)
+        self.current = max(self.current, target)
+        return due
+    
+    def clear(self):
+        self.slots = [[] for _ in self.slots]
+        self.size = 0
+
+class ReminderScheduler:
+    """Напоминает покупателям об окончании аренды за REMINDER_MINUTES минут"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wheel = TimingWheel()
+        self.thread = None
+    
+    def schedule(self, rental):
+        """Ставит таймеры напоминаний аренды; устаревшие таймеры отбрасываются при срабатывании"""
+        if not REMINDER_MINUTES or not rental.is_active:
+            return
+        with self.lock:
+            for minutes in REMINDER_MINUTES:
+                # Аренда короче окна напоминания - напоминать сразу после выдачи незачем
+                if minutes in rental.reminders_sent or minutes * 60 >= rental.duration_hours * 3600:
+                    continue
+                self.wheel.schedule(rental.end_time - minutes * 60, (rental.id, minutes, rental.end_time))
+            metrics.set_gauge("steamrent_reminders_pending", self.wheel.size)
+        self.start()
+    
+    def rebuild(self):
+        """Заново ставит таймеры всех активных аренд (запуск, смена настроек)"""
+        with self.lock:
+            self.wheel.clear()
+        for rental in rental_manager.search_active_rentals():
+            self.schedule(rental)
+    
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def run(self):
+        STATE_READY.wait()
+        while True:
+            time.sleep(self.wheel.tick)
+            with self.lock:
+                due = self.wheel.advance(time.time())
+                metrics.set_gauge("steamrent_reminders_pending", self.wheel.size)
+            for item in due:
+                try:
+                    self.fire(*item)
+                except Exception as e:
+                    logger.error(f"{LOGGER_PREFIX} Ошибка отправки напоминания: {e}")
+    
+    def fire(self, rental_id, minutes, end_time):
+        with rental_manager.lock:
+            rental = rental_manager.rentals.get(rental_id)
+            # Аренда завершена, продлена или напоминание уже ушло
+            if (not rental or not rental.is_active or rental.end_time != end_time
+                    or minutes in rental.reminders_sent or minutes not in REMINDER_MINUTES):
+                return False
+            rental.reminders_sent.append(minutes)
+            rental_manager.save_data()
+        
+        account = rental_manager.accounts.get(rental.account_login)
+        message = format_message("rental_reminder",
+            login=rental.account_login,
+            account_type=account.type if account else "",
+            minutes_left=max(1, int((rental.end_time - time.time()) // 60)),
+            end_time=rental.get_formatted_end_time(),
+            username=rental.username,
+            order_id=rental.order_id
+        )
+        funpay_delivery.enqueue(rental.user_id, rental.username, message, kind="rental_reminder")
+        metrics.inc("steamrent_reminders_sent_total")
+        return True
+
+reminders = ReminderScheduler()
+
+def remind_cmd(message):
+    """Настраивает напоминания покупателям: /srent_remind 60 15 или /srent_remind off"""
+    global REMINDER_MINUTES
+    
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может настраивать напоминания.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        args = message.text.replace(",", " ").split()[1:]
+        if args:
+            if args[0].lower() == "off":
+                minutes = []
+            else:
+                try:
+                    minutes = sorted({int(arg) for arg in args}, reverse=True)
+                    if any(value <= 0 for value in minutes):
+                        raise ValueError
+                except ValueError:
+                    CARDINAL.telegram.bot.send_message(
+                        message.chat.id,
+                        "❌ Укажите минуты до окончания целыми положительными числами.\n\n"
+                        "Использование: <code>/srent_remind 60 15</code> или <code>/srent_remind off</code>",
+                        parse_mode="HTML"
+                    )
+                    return
+            REMINDER_MINUTES = minutes
+            save_config()
+            reminders.rebuild()
+        
+        current = ", ".join(f"{value} мин." for value in REMINDER_MINUTES) or "выключены"
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "🔔 <b>Напоминания об окончании аренды</b>\n\n"
+            f"Когда: <b>{current}</b> до окончания\n"
+            f"Ожидают отправки: <b>{reminders.wheel.size}</b>\n\n"
+            "• <code>/srent_remind 60 15</code> - за час и за 15 минут\n"
+            "• <code>/srent_remind off</code> - выключить\n\n"
+            "Текст: шаблон «Напоминание об окончании аренды».",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике remind_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+# Прогноз спроса
+DEMAND_HALF_LIFE_HOURS = 6  # За это время вес старых заказов падает вдвое
+DEMAND_DURATION_ALPHA = 0.2  # Сглаживание среднего срока аренды
+FORECAST_HORIZON_HOURS = 24  # Дальше прогноз не строим
+FORECAST_ALERT_HOURS = 2  # Предупреждать, если аккаунты типа закончатся раньше
+FORECAST_ALERT_COOLDOWN = 3600  # Не чаще раза в час на тип
+
+class DemandForecast:
+    """Потоковая статистика спроса по типам и прогноз, когда закончатся свободные аккаунты.
+    Обновляется на каждой выдаче и возврате, история заказов не перебирается"""
+    
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.stats = {}     # нормализованный тип -> {type, weight, updated, avg_duration, orders}
+        self.expiries = {}  # нормализованный тип -> отсортированный [(end_time, rental_id)] активных аренд
+        self.alerted = {}   # нормализованный тип -> время последнего предупреждения
+        self.dirty = False
+    
+    @staticmethod
+    def _decay(elapsed):
+        return math.exp(-math.log(2) * elapsed / (DEMAND_HALF_LIFE_HOURS * 3600))
+    
+    def record_order(self, account_type, duration_hours, units=1):
+        """Учитывает заказ: экспоненциально затухающий счетчик и сглаженный срок аренды"""
+        now = time.time()
+        with self.lock:
+            stats = self.stats.setdefault(normalize_account_type(account_type), {
+                "type": account_type, "weight": 0.0, "updated": now, "avg_duration": float(duration_hours), "orders": 0
+            })
+            stats["weight"] = stats["weight"] * self._decay(now - stats["updated"]) + units
+            stats["updated"] = now
+            stats["avg_duration"] += DEMAND_DURATION_ALPHA * (duration_hours - stats["avg_duration"])
+            stats["orders"] += units
+            self.dirty = True
+    
+    def rate(self, normalized_type, now=None):
+        """Ожидаемое число выдач в час"""
+        now = now or time.time()
+        stats = self.stats.get(normalized_type)
+        if not stats:
+            return 0.0
+        # Затухающий счетчик потока с интенсивностью λ в среднем равен λ·τ, где τ = период полураспада / ln 2
+        tau_hours = DEMAND_HALF_LIFE_HOURS / math.log(2)
+        return stats["weight"] * self._decay(now - stats["updated"]) / tau_hours
+    
+    def add_expiry(self, account_type, rental):
+        with self.lock:
+            bisect.insort(self.expiries.setdefault(normalize_account_type(account_type), []),
+                          (rental.end_time, rental.id))
+    
+    def nth_expiry(self, account_type, n=1):
+        """Время окончания n-й по счету активной аренды типа или None"""
+        with self.lock:
+            expiries = self.expiries.get(normalize_account_type(account_type), ())
+            return expiries[n - 1][0] if 0 < n <= len(expiries) else None
+    
+    def remove_expiry(self, account_type, rental_id, end_time):
+        with self.lock:
+            expiries = self.expiries.get(normalize_account_type(account_type), [])
+            index = bisect.bisect_left(expiries, (end_time, rental_id))
+            if index < len(expiries) and expiries[index] == (end_time, rental_id):
+                del expiries[index]
+    
+    def rebuild_expiries(self):
+        """Собирает расписание возвратов из активных аренд (один раз при запуске)"""
+        expiries = {}
+        with rental_manager.lock:
+            for rental in rental_manager.search_active_rentals():
+                account = rental_manager.accounts.get(rental.account_login)
+                if account:
+                    expiries.setdefault(normalize_account_type(account.type), []).append((rental.end_time, rental.id))
+        with self.lock:
+            self.expiries = {normalized_type: sorted(items) for normalized_type, items in expiries.items()}
+    
+    def forecast(self, account_type):
+        """Прогноз по типу: выдач в час, средний срок, свободно, возвратов за час и часов до исчерпания (None - не ожидается)"""
+        normalized_type = normalize_account_type(account_type)
+        now = time.time()
+        available = rental_manager.count_available(account_type)
+        with self.lock:
+            rate = self.rate(normalized_type, now)
+            stats = self.stats.get(normalized_type, {})
+            expiries = self.expiries.get(normalized_type, [])
+            # Просроченные аренды вернутся на ближайшей проверке
+            overdue = bisect.bisect_left(expiries, (now,))
+            end = bisect.bisect_left(expiries, (now + FORECAST_HORIZON_HOURS * 3600,))
+            upcoming = [(end_time - now) / 3600 for end_time, _ in expiries[overdue:end]]
+    
+        returns_hour = overdue + sum(1 for hours in upcoming if hours <= 1)
+        return {
+            "rate": rate,
+            "avg_duration": stats.get("avg_duration", 0.0),
+            "available": available,
+            "returns_hour": returns_hour,
+            "exhaustion_hours": self.exhaustion_hours(available + overdue, rate, upcoming),
+        }
+    
+    @staticmethod
+    def exhaustion_hours(stock, rate, return_hours, horizon=FORECAST_HORIZON_HOURS):
+        """Через сколько часов не останется ни одного свободного аккаунта (None - не в пределах horizon).
+        Запас убывает с темпом спроса rate в час и пополняется на 1 в каждый момент из отсортированного return_hours"""
+        if rate <= 0:
+            return None
+        for until in list(return_hours) + [horizon]:
+            # До следующего возврата запас только убывает: ноль наступает через stock / rate
+            crossing = stock / rate
+            if crossing < until:
+                return crossing
+            stock += 1
+        return None
+    
+    def check_alert(self, account_type):
+        """Предупреждает администратора, если аккаунты типа закончатся раньше FORECAST_ALERT_HOURS"""
+        normalized_type = normalize_account_type(account_type)
+        if normalized_type not in self.stats:
+            return False
+        forecast = self.forecast(account_type)
+        hours = forecast["exhaustion_hours"]
+        if hours is None or hours > FORECAST_ALERT_HOURS:
+            return False
+        now = time.time()
+        with self.lock:
+            if now - self.alerted.get(normalized_type, 0) < FORECAST_ALERT_COOLDOWN:
+                return False
+            self.alerted[normalized_type] = now
+        metrics.inc("steamrent_forecast_alerts_total", type=normalized_type)
+        notify_admin(
+            f"📉 <b>Скоро закончатся аккаунты</b>\n\n"
+            f"Тип: <code>{account_type}</code>\n"
+            f"Свободно: <b>{forecast['available']}</b>\n"
+            f"Спрос: <b>{forecast['rate']:.1f}</b> в час, средний срок {forecast['avg_duration']:.1f} ч.\n"
+            f"Возвратов в ближайший час: <b>{forecast['returns_hour']}</b>\n"
+            f"Закончатся примерно через: <b>{format_forecast_hours(hours)}</b>\n\n"
+            f"Добавьте аккаунты этого типа, чтобы заказы не ждали в очереди."
+        )
+        return True
+    
+    def check_alerts(self):
+        with self.lock:
+            types = [stats["type"] for stats in self.stats.values()]
+        for account_type in types:
+            self.check_alert(account_type)
+    
+    def load(self):
+        self.rebuild_expiries()
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            with self.lock:
+                self.stats = stored
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка загрузки статистики спроса: {e}")
+    
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        try:
+            with self.lock:
+                snapshot = {normalized_type: dict(stats) for normalized_type, stats in self.stats.items()}
+                self.dirty = False
+            write_json_file(self.path, snapshot)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка сохранения статистики спроса: {e}")
+
+demand = DemandForecast(DEMAND_STATS_FILE)
+
+def format_forecast_hours(hours):
+    """Часы прогноза в виде "N ч. M мин." """
+    if hours is None:
+        return "не ожидается"
+    minutes = int(hours * 60)
+    return f"{minutes // 60} ч. {minutes % 60} мин."
+
+def policy_cmd(message):
+    """Показывает статистику использования аккаунтов и меняет политику их выдачи"""
+    global ALLOCATION_POLICY
+    
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может менять политику выдачи.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        parts = message.text.split()
+        if len(parts) > 1:
+            policy = parts[1].lower()
+            if policy not in ALLOCATION_POLICIES:
+                CARDINAL.telegram.bot.send_message(
+                    message.chat.id,
+                    "❌ Неизвестная политика.\n\n"
+                    f"Доступные: <code>{'|'.join(ALLOCATION_POLICIES)}</code>",
+                    parse_mode="HTML"
+                )
+                return
+            ALLOCATION_POLICY = policy
+            save_config()
+        
+        # Самые нагруженные аккаунты - в начале
+        with rental_manager.lock:
+            accounts = sorted(rental_manager.accounts.values(),
+                              key=lambda account: (account.rented_hours, account.rental_count), reverse=True)
+        
+        text = "⚖️ <b>Политика выдачи аккаунтов</b>\n\n"
+        for name, description in ALLOCATION_POLICIES.items():
+            mark = "✅" if name == ALLOCATION_POLICY else "▫️"
+            text += f"{mark} <code>{name}</code> - {description}\n"
+        text += "\n<b>Использование аккаунтов:</b>\n"
+        for account in accounts[:15]:
+            rotated = (datetime.fromtimestamp(account.last_rotation).strftime("%d.%m %H:%M")
+                       if account.last_rotation else "—")
+            text += (f"• <code>{account.login}</code> ({account.type}): {account.rental_count} аренд, "
+                     f"{account.rented_hours} ч., сбоев {account.failure_count}, пароль сменен {rotated}\n")
+        if len(accounts) > 15:
+            text += f"... и еще {len(accounts) - 15}\n"
+        text += "\nСменить: <code>/srent_policy ПОЛИТИКА</code>"
+        CARDINAL.telegram.bot.send_message(message.chat.id, text, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике policy_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+def health_cmd(message):
+    """Показывает здоровье аккаунтов и карантин; release/quarantine ЛОГИН управляют карантином вручную"""
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может управлять карантином.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        parts = message.text.split(maxsplit=3)
+        action = parts[1].lower() if len(parts) > 1 else ""
+        if action in ("release", "quarantine"):
+            if len(parts) < 3:
+                CARDINAL.telegram.bot.send_message(
+                    message.chat.id,
+                    f"Использование: <code>/srent_health {action} ЛОГИН</code>",
+                    parse_mode="HTML"
+                )
+                return
+            if action == "release":
+                success, result = rental_manager.release_account(parts[2])
+            else:
+                reason = parts[3] if len(parts) > 3 else "вручную администратором"
+                success, result = rental_manager.quarantine_account(parts[2], reason)
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"{'✅' if success else '❌'} {result}")
+            return
+        
+        with rental_manager.lock:
+            quarantined = [rental_manager.accounts[login] for login in sorted(rental_manager.quarantined)
+                           if login in rental_manager.accounts]
+            weakest = sorted((account for account in rental_manager.accounts.values()
+                              if account.login not in rental_manager.quarantined),
+                             key=lambda account: account.health)[:10]
+        
+        text = f"🩺 <b>Здоровье аккаунтов</b>\n\nПорог карантина: <b>{HEALTH_QUARANTINE_THRESHOLD}</b>\n\n"
+        text += f"<b>В карантине ({len(quarantined)}):</b>\n"
+        for account in quarantined:
+            quarantine = account.quarantine or {}
+            next_check = quarantine.get("next_check")
+            check_text = (datetime.fromtimestamp(next_check).strftime("%d.%m %H:%M")
+                          if account.api_key and next_check else "вручную")
+            text += (f"• <code>{account.login}</code>: {quarantine.get('reason', '—')}, здоровье {account.health}, "
+                     f"перепроверка {check_text}\n")
+        if not quarantined:
+            text += "нет\n"
+        text += "\n<b>Наименее здоровые:</b>\n"
+        for account in weakest:
+            text += (f"• <code>{account.login}</code>: {account.health}, сбоев {account.failure_count}, "
+                     f"жалоб {account.complaints}\n")
+        text += ("\n• <code>/srent_health release ЛОГИН</code> - вернуть из карантина\n"
+                 "• <code>/srent_health quarantine ЛОГИН [ПРИЧИНА]</code> - отправить в карантин")
+        CARDINAL.telegram.bot.send_message(message.chat.id, text, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике health_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+def guard_cmd(message):
+    """Привязывает shared_secret к аккаунту и показывает текущий код Steam Guard"""
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может управлять Steam Guard.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        parts = message.text.split()
+        if len(parts) < 2:
+            with_guard = [login for login, account in rental_manager.accounts.items() if account.shared_secret]
+            CARDINAL.telegram.bot.send_message(
+                message.chat.id,
+                "🔐 <b>Steam Guard</b>\n\n"
+                f"Аккаунтов с аутентификатором: <b>{len(with_guard)}</b>\n"
+                f"Смещение времени Steam: <b>{steam_guard.offset} с</b>\n\n"
+                "• <code>/srent_guard ЛОГИН SHARED_SECRET</code> - привязать секрет\n"
+                "• <code>/srent_guard ЛОГИН</code> - текущий код\n"
+                "• <code>/srent_guard ЛОГИН off</code> - отвязать\n\n"
+                "Покупатели получают код командой <code>!код</code> в чате FunPay.",
+                parse_mode="HTML"
+            )
+            return
+        
+        login = parts[1]
+        account = rental_manager.accounts.get(login)
+        if not account:
+            CARDINAL.telegram.bot.send_message(message.chat.id, "❌ Аккаунт не найден")
+            return
+        
+        if len(parts) > 2:
+            secret = None if parts[2].lower() == "off" else parts[2]
+            if secret:
+                try:
+                    decode_shared_secret(secret)
+                except ValueError as e:
+                    CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ {e}")
+                    return
+            rental_manager.update_account(login, shared_secret=secret)
+            # Секрет не оставляем в истории чата
+            try:
+                CARDINAL.telegram.bot.delete_message(message.chat.id, message.message_id)
+            except Exception:
+                pass
+            if not secret:
+                CARDINAL.telegram.bot.send_message(message.chat.id, f"🔓 Steam Guard для <code>{login}</code> отвязан",
+                                                   parse_mode="HTML")
+                return
+        
+        if not account.shared_secret:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"ℹ️ У <code>{login}</code> нет shared_secret",
+                                               parse_mode="HTML")
+            return
+        code, expires_in = steam_guard.code(account)
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            f"🔐 Код Steam Guard для <code>{login}</code>: <code>{code}</code>\nДействует еще {expires_in} с.",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике guard_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
 # Основная функция инициализации
+def register_callback_routes():
+    """Заполняет таблицу callback-кнопок плагина"""
+    router = callback_router
+    
+    # Главное меню и система аренды
+    router.add("menu", show_menu_callback)
+    router.add("start", start_rental_callback)
+    router.add("stop", stop_rental_callback)
+    router.add("status", show_status_callback)
+    router.add("metrics", show_metrics_callback)
+    
+    # Аккаунты и аренды
+    router.add("accounts", show_accounts_callback)
+    router.add("rentals", show_rentals_callback)
+    router.add("add", interactive_add_account_start_callback)
+    router.add("cancel_add", cancel_add_account_callback)
+    router.add("delete", delete_account_callback, prefix=True)
+    router.add("return", show_return_account_callback)
+    router.add("force_return", force_return_account_from_callback, prefix=True)
+    router.add("force_pick", toggle_force_return_pick_callback, prefix=True)
+    router.add("fr", force_return_token_callback, prefix=True)
+    router.add("fp", toggle_force_return_token_callback, prefix=True)
+    router.add("rp", return_picker_page_callback, prefix=True)
+    router.add("return_search", return_search_callback)
+    router.add("return_clear", return_clear_search_callback)
+    router.add("force_selected", force_return_selected_callback)
+    router.add("bulk_confirm", bulk_confirm_callback, prefix=True)
+    router.add("bulk_cancel", bulk_cancel_callback, prefix=True)
+    
+    # Привязки лотов
+    router.add("lot_bindings", show_lot_bindings_callback)
+    router.add("show_bindings", lambda call: list_bindings_cmd(call.message))
+    router.add("all_bindings", show_all_bindings_callback)
+    router.add("add_binding", start_add_binding_callback)
+    router.add("cancel_binding", cancel_binding_callback)
+    router.add("binding_help", help_lot_binding_callback)
+    router.add("binding", manage_binding_callback, prefix=True)
+    router.add("binding_duration", binding_duration_callback, prefix=True)
+    router.add("edit_binding_type", edit_binding_type_callback, prefix=True)
+    router.add("edit_binding_time", edit_binding_time_callback, prefix=True)
+    router.add("delete_binding", delete_binding_callback, prefix=True)
+    
+    # Шаблоны и настройки
+    router.add("list_templates", list_templates_callback)
+    router.add("edit_template", edit_template_callback, prefix=True)
+    router.add("reset_templates_confirm", reset_templates_confirm_callback)
+    router.add("reset_templates_cancel", reset_templates_cancel_callback)
+    router.add("set_admin_id", set_admin_id_callback, prefix=True)
+
+def register_conversation_handlers():
+    """Связывает типы диалогов с обработчиками текстовых сообщений"""
+    CONVERSATION_HANDLERS["add_account"] = handle_account_add_steps
+    CONVERSATION_HANDLERS["add_binding"] = handle_binding_add_steps
+    CONVERSATION_HANDLERS["edit_template"] = handle_template_edit
+    CONVERSATION_HANDLERS["return_search"] = handle_return_search
+
 def init_plugin(c):
     """Функция инициализации плагина"""
     global CARDINAL, RUNNING, AUTO_START
@@ -1248,9 +4457,9 @@ def init_plugin(c):
     
     logger.info(f"{LOGGER_PREFIX} Плагин инициализируется...")
     
-    # Загружаем настройки
+    # Загружаем настройки; аккаунты, аренды и привязки загружаются в фоне
     load_config()
-    load_lot_bindings()
+    registration_started = time.perf_counter()
     
     try:
         
@@ -1260,38 +4469,51 @@ def init_plugin(c):
         ])
         
         # Регистрация обработчиков команд
-        c.telegram.msg_handler(show_menu, commands=["srent_menu"])
-        c.telegram.msg_handler(add_account_cmd, commands=["srent_add"])
-        c.telegram.msg_handler(interactive_add_account_start, commands=["steam_add"])
-        c.telegram.msg_handler(list_accounts_cmd, commands=["steam_list", "srent_list"])
-        c.telegram.msg_handler(list_rentals_cmd, commands=["steam_active"])
-        c.telegram.msg_handler(start_rental_system, commands=["srent_start"])
-        c.telegram.msg_handler(stop_rental_system, commands=["srent_stop"])
-        c.telegram.msg_handler(force_return_account_cmd, commands=["srent_force"])
-        c.telegram.msg_handler(manual_rent_account_cmd, commands=["srent_manual"])
-        c.telegram.msg_handler(return_account_cmd, commands=["srent_return"])
-        c.telegram.msg_handler(del_account_cmd, commands=["srent_del"])
+        c.telegram.msg_handler(requires_state(show_menu), commands=["srent_menu"])
+        c.telegram.msg_handler(requires_state(add_account_cmd), commands=["srent_add"])
+        c.telegram.msg_handler(requires_state(interactive_add_account_start), commands=["steam_add"])
+        c.telegram.msg_handler(requires_state(list_accounts_cmd), commands=["steam_list", "srent_list"])
+        c.telegram.msg_handler(requires_state(list_rentals_cmd), commands=["steam_active"])
+        c.telegram.msg_handler(requires_state(start_rental_system), commands=["srent_start"])
+        c.telegram.msg_handler(requires_state(stop_rental_system), commands=["srent_stop"])
+        c.telegram.msg_handler(requires_state(force_return_account_cmd), commands=["srent_force"])
+        c.telegram.msg_handler(requires_state(manual_rent_account_cmd), commands=["srent_manual"])
+        c.telegram.msg_handler(requires_state(return_account_cmd), commands=["srent_return"])
+        c.telegram.msg_handler(requires_state(del_account_cmd), commands=["srent_del"])
+        c.telegram.msg_handler(requires_state(bulk_cmd), commands=["srent_bulk"])
+        c.telegram.msg_handler(requires_state(metrics_cmd), commands=["srent_metrics"])
+        c.telegram.msg_handler(requires_state(debug_cmd), commands=["srent_debug"])
+        c.telegram.msg_handler(requires_state(trace_cmd), commands=["srent_trace"])
+        c.telegram.msg_handler(requires_state(slowest_traces_cmd), commands=["srent_traces"])
+        c.telegram.msg_handler(requires_state(live_board_cmd), commands=["srent_live"])
+        c.telegram.msg_handler(requires_state(digest_cmd), commands=["srent_digest"])
+        c.telegram.msg_handler(requires_state(backorders_cmd), commands=["srent_backorders"])
+        c.telegram.msg_handler(requires_state(policy_cmd), commands=["srent_policy"])
+        c.telegram.msg_handler(requires_state(health_cmd), commands=["srent_health"])
+        c.telegram.msg_handler(requires_state(guard_cmd), commands=["srent_guard"])
+        c.telegram.msg_handler(requires_state(remind_cmd), commands=["srent_remind"])
         
         # Регистрация команд для привязки лотов
-        c.telegram.msg_handler(unbind_lot_cmd, commands=["srent_unbind"])
-        c.telegram.msg_handler(list_bindings_cmd, commands=["srent_bindings"])
-        c.telegram.msg_handler(bind_lot_cmd, commands=["srent_bind"])
-        c.telegram.msg_handler(help_lot_binding_cmd, commands=["srent_help"])
+        c.telegram.msg_handler(requires_state(unbind_lot_cmd), commands=["srent_unbind"])
+        c.telegram.msg_handler(requires_state(list_bindings_cmd), commands=["srent_bindings"])
+        c.telegram.msg_handler(requires_state(bind_lot_cmd), commands=["srent_bind"])
+        c.telegram.msg_handler(requires_state(help_lot_binding_cmd), commands=["srent_help"])
         
         # Регистрация команд для управления шаблонами
-        c.telegram.msg_handler(list_templates_cmd, commands=["templates", "srent_templates"])
-        c.telegram.msg_handler(view_template_cmd, commands=["view_template"])
-        c.telegram.msg_handler(edit_template_cmd, commands=["edit_template"])
-        c.telegram.msg_handler(reset_templates_cmd, commands=["reset_templates"])
+        c.telegram.msg_handler(requires_state(list_templates_cmd), commands=["templates", "srent_templates"])
+        c.telegram.msg_handler(requires_state(view_template_cmd), commands=["view_template"])
+        c.telegram.msg_handler(requires_state(edit_template_cmd), commands=["edit_template"])
+        c.telegram.msg_handler(requires_state(reset_templates_cmd), commands=["reset_templates"])
         
         # Регистрация команды для установки admin_id
-        c.telegram.msg_handler(set_admin_id_cmd, commands=["admin_id", "srent_admin"])
+        c.telegram.msg_handler(requires_state(set_admin_id_cmd), commands=["admin_id", "srent_admin"])
         
         # Регистрация обработчика текстовых сообщений
-        c.telegram.msg_handler(handle_account_add_steps_and_template_edit, content_types=["text"])
+        c.telegram.msg_handler(requires_state(handle_account_add_steps_and_template_edit), content_types=["text"],
+                               func=has_conversation)
         
         # Регистрация обработчика кнопки меню в клавиатуре
-        c.telegram.msg_handler(show_menu, func=lambda message: message.text == "Меню💻" or message.text == "меню")
+        c.telegram.msg_handler(requires_state(show_menu), func=lambda message: message.text == "Меню💻" or message.text == "меню")
         
         # Создаем клавиатуру с кнопкой меню
         try:
@@ -1321,106 +4543,17 @@ def init_plugin(c):
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Ошибка создания клавиатуры меню: {e}")
         
-        # Обработчики кнопок
-        @c.telegram.bot.callback_query_handler(func=lambda call: call.data.startswith("srent_"))
+        # Обработчики кнопок и диалогов
+        register_callback_routes()
+        register_conversation_handlers()
+        
+        @c.telegram.bot.callback_query_handler(func=lambda call: call.data.startswith(callback_router.namespace))
         def handle_button_press(call):
+            if not wait_until_ready():
+                CARDINAL.telegram.bot.answer_callback_query(call.id, "⏳ Данные еще загружаются")
+                return
             try:
-                # Обработка особых callbacks
-                if call.data.startswith("srent_set_admin_id_"):
-                    set_admin_id_callback(call)
-                    return
-                elif call.data.startswith("srent_edit_template_"):
-                    template_name = call.data.replace("srent_edit_template_", "")
-                    edit_template_callback(call, template_name)
-                    return
-                elif call.data == "srent_reset_templates_confirm":
-                    reset_templates_confirm_callback(call)
-                    return
-                elif call.data == "srent_reset_templates_cancel":
-                    reset_templates_cancel_callback(call)
-                    return
-                elif call.data == "srent_list_templates":
-                    list_templates_callback(call)
-                    return
-                elif call.data == "srent_cancel_add":
-                    cancel_add_account_callback(call)
-                    return
-                
-                # Особая обработка для привязок лотов
-                if call.data == "srent_lot_bindings":
-                    show_lot_bindings_callback(call)
-                    return
-                elif call.data.startswith("srent_binding_"):
-                    # Новый формат: srent_binding_HASH
-                    binding_hash = call.data.replace("srent_binding_", "")
-                    manage_binding_callback(call, binding_hash)
-                    return
-                elif call.data == "srent_add_binding":
-                    # Здесь будет вызов функции для добавления привязки
-                    start_add_binding_callback(call)
-                    return
-                elif call.data == "srent_binding_help":
-                    # Вызываем функцию help_lot_binding_cmd с сообщением из call
-                    help_lot_binding_callback(call)
-                    return
-                elif call.data == "srent_all_bindings":
-                    # Здесь будет вызов функции для просмотра всех привязок
-                    show_all_bindings_callback(call)
-                    return
-                elif call.data == "srent_cancel_binding":
-                    # Обработка отмены добавления привязки
-                    cancel_binding_callback(call)
-                    return
-                elif call.data.startswith("srent_binding_duration_"):
-                    # Обработка выбора длительности привязки
-                    binding_duration_callback(call)
-                    return
-                elif call.data.startswith("srent_edit_binding_type_"):
-                    # Обработка изменения типа привязки
-                    binding_hash = call.data.replace("srent_edit_binding_type_", "")
-                    edit_binding_type_callback(call, binding_hash)
-                    return
-                elif call.data.startswith("srent_edit_binding_time_"):
-                    # Обработка изменения времени привязки
-                    binding_hash = call.data.replace("srent_edit_binding_time_", "")
-                    edit_binding_time_callback(call, binding_hash)
-                    return
-                elif call.data.startswith("srent_delete_binding_"):
-                    # Обработка удаления привязки
-                    binding_hash = call.data.replace("srent_delete_binding_", "")
-                    delete_binding_callback(call, binding_hash)
-                    return
-                    
-                # Стандартная обработка по первой части callback data
-                action = call.data.split("_")[1] if len(call.data.split("_")) > 1 else ""
-                
-                if action == "menu":
-                    show_menu_callback(call)
-                elif action == "start":
-                    start_rental_callback(call)
-                elif action == "stop":
-                    stop_rental_callback(call)
-                elif action == "status":
-                    show_status_callback(call)
-                elif action == "accounts":
-                    show_accounts_callback(call)
-                elif action == "rentals":
-                    show_rentals_callback(call)
-                elif action == "add":
-                    interactive_add_account_start_callback(call)
-                elif action == "delete" and len(call.data.split("_")) > 2:
-                    # Извлекаем логин аккаунта для удаления
-                    login = call.data.split("_")[2]
-                    delete_account_callback(call, login)
-                elif action == "return":
-                    show_return_account_callback(call)
-                elif action == "show" and call.data == "srent_show_bindings":
-                    list_bindings_cmd(call.message)
-                elif action == "force" and call.data.startswith("srent_force_return_"):
-                    login = call.data.replace("srent_force_return_", "")
-                    force_return_account_from_callback(call, login)
-                else:
-                    CARDINAL.telegram.bot.answer_callback_query(call.id, "Неизвестное действие")
+                callback_router.dispatch(call)
             except Exception as e:
                 logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике кнопок: {e}")
                 try:
@@ -1437,7 +4570,14 @@ def init_plugin(c):
             RUNNING = True
             logger.info(f"{LOGGER_PREFIX} Система аренды запущена автоматически")
         
-        logger.info(f"{LOGGER_PREFIX} Плагин успешно инициализирован!")
+        record_startup_timing("telegram_registration", time.perf_counter() - registration_started)
+        
+        # Данные загружаются после регистрации обработчиков, не задерживая запуск Cardinal
+        start_state_loading()
+        
+        logger.info(f"{LOGGER_PREFIX} Плагин успешно инициализирован! "
+                    f"Импорт: {STARTUP_TIMINGS.get('import', 0):.2f} с, "
+                    f"регистрация обработчиков: {STARTUP_TIMINGS['telegram_registration']:.2f} с")
         return True
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Ошибка при инициализации плагина: {e}")
@@ -1447,18 +4587,16 @@ def init_plugin(c):
 # Обработчик текстовых сообщений для всех интерактивных процессов
 def handle_account_add_steps_and_template_edit(message):
     """Обрабатывает шаги интерактивного добавления аккаунта и редактирования шаблонов"""
-    # Проверяем, находится ли пользователь в процессе редактирования шаблона
-    if message.chat.id in EDIT_TEMPLATE_STATES:
-        if handle_template_edit(message):
-            return True
-    
-    # Проверяем, находится ли пользователь в процессе добавления привязки
-    if message.chat.id in ADD_BINDING_STATES:
-        if handle_binding_add_steps(message):
-            return True
+    # Один поиск диалога на сообщение, дальше обработчик по типу диалога
+    conversation = conversations.get(message.chat.id)
+    if not conversation:
+        return False
     
-    # Если не редактируем шаблон и не добавляем привязку, проверяем добавление аккаунта
-    return handle_account_add_steps(message)
+    handler = CONVERSATION_HANDLERS.get(conversation["kind"])
+    if handler is None:
+        conversations.finish(message.chat.id)
+        return False
+    return handler(message, conversation)
 
 # Callback для редактирования шаблона
 def edit_template_callback(call, template_name):
@@ -1476,16 +4614,17 @@ def edit_template_callback(call, template_name):
     template = message_templates[template_name]
     
     # Сохраняем состояние редактирования
-    EDIT_TEMPLATE_STATES[call.message.chat.id] = {
-        "template_name": template_name,
-        "editing": True
-    }
+    conversations.start(call.message.chat.id, "edit_template", "text", {"template_name": template_name})
     
     # Определяем заголовок в зависимости от типа шаблона
     template_titles = {
         "rental_start": "Сообщение после оплаты",
+        "rental_start_multi": "Сообщение после оплаты нескольких аккаунтов",
         "rental_end": "Сообщение о завершении аренды",
         "rental_force_end": "Сообщение о досрочном завершении",
+        "rental_extend": "Сообщение о продлении аренды",
+        "rental_backorder": "Сообщение об ожидании в очереди",
+        "rental_reminder": "Напоминание об окончании аренды",
         "admin_rental_start": "Сообщение администратору о покупке",
         "admin_rental_end": "Сообщение администратору о завершении аренды"
     }
@@ -1509,6 +4648,9 @@ def edit_template_callback(call, template_name):
         f"• <code>{{{{'end_time'}}}}</code> - дата и время окончания аренды\n"
         f"• <code>{{{{'username'}}}}</code> - имя пользователя\n"
         f"• <code>{{{{'order_id'}}}}</code> - ID заказа\n"
+        f"• <code>{{{{'accounts'}}}}</code> - логины и пароли (для заказа нескольких аккаунтов)\n"
+        f"• <code>{{{{'position'}}}}</code>, <code>{{{{'eta'}}}}</code> - место в очереди и ожидаемое время выдачи\n"
+        f"• <code>{{{{'minutes_left'}}}}</code> - минут до окончания (для напоминания)\n"
         f"• <code>{{{{'new_password'}}}}</code> - новый пароль (для уведомлений об окончании)",
         call.message.chat.id,
         call.message.message_id,
@@ -1547,8 +4689,12 @@ def list_templates_callback(call):
     
     # Добавляем кнопки для стандартных шаблонов
     markup.row(InlineKeyboardButton("Сообщение после оплаты ✅", callback_data="srent_edit_template_rental_start"))
+    markup.row(InlineKeyboardButton("Сообщение после оплаты нескольких аккаунтов ✅", callback_data="srent_edit_template_rental_start_multi"))
     markup.row(InlineKeyboardButton("Сообщение о завершении аренды 🍉", callback_data="srent_edit_template_rental_end"))
     markup.row(InlineKeyboardButton("Сообщение о досрочном завершении ⚠️", callback_data="srent_edit_template_rental_force_end"))
+    markup.row(InlineKeyboardButton("Сообщение о продлении аренды ➕", callback_data="srent_edit_template_rental_extend"))
+    markup.row(InlineKeyboardButton("Сообщение об ожидании в очереди ⏳", callback_data="srent_edit_template_rental_backorder"))
+    markup.row(InlineKeyboardButton("Напоминание об окончании аренды 🔔", callback_data="srent_edit_template_rental_reminder"))
     markup.row(InlineKeyboardButton("Сообщение администратору о покупке 🛒", callback_data="srent_edit_template_admin_rental_start"))
     markup.row(InlineKeyboardButton("Сообщение администратору о завершении аренды 🕸️", callback_data="srent_edit_template_admin_rental_end"))
     
@@ -1592,6 +4738,8 @@ def stop_rent_plugin():
 
 def add_steam_account(login, password, account_type="standard", api_key=None):
     """Добавляет новый аккаунт через API"""
+    if not wait_until_ready():
+        return {"success": False, "message": "Данные еще загружаются"}
     success, message = rental_manager.add_account(login, password, account_type, api_key)
     return {"success": success, "message": message}
 
@@ -1599,6 +4747,8 @@ def check_rentals():
     """Проверяет состояние всех аренд"""
     if not RUNNING:
         return False, "Система аренды не запущена"
+    if not wait_until_ready():
+        return False, "Данные еще загружаются"
     
     try:
         expired_rentals = rental_manager.check_expired_rentals()
@@ -1614,6 +4764,8 @@ def check_rentals():
 
 def delete_steam_account(login):
     """Удаляет аккаунт через API"""
+    if not wait_until_ready():
+        return {"success": False, "message": "Данные еще загружаются"}
     success, message = rental_manager.remove_account(login)
     return {"success": success, "message": message}
 
@@ -1648,13 +4800,97 @@ def message_handler(c, event, *args):
     user_id = message.author_id
     text = message.text
     
-    logger.info(f"{LOGGER_PREFIX} Получено сообщение от {username}: {text}")
+    # Входящих сообщений много, поэтому пишем только выборочно и без текста
+    log_event(logging.DEBUG, "chat.message", sample=50, user=username, length=lambda: len(text or ""))
+    
+    # Настоящий чат покупателя пригодится для доставки сообщений
+    funpay_delivery.remember_chat(user_id, getattr(message, "chat_id", None), getattr(message, "chat_name", None))
+    
+    # Обычные сообщения отсекаются одной проверкой регулярным выражением
+    match = BUYER_COMMAND_RE.match(text or "")
+    if not match:
+        return
+    if not wait_until_ready():
+        return
+    
+    command = match.group(1).lower()
+    metrics.inc("steamrent_buyer_commands_total", command=command)
+    try:
+        reply = handle_buyer_command(command, user_id, username, text[match.end():].strip())
+        funpay_delivery.send(user_id, username, reply, kind="buyer_command")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка обработки команды покупателя {username}: {e}")
+
+# Команды покупателя в чате FunPay
+BUYER_COMMAND_RE = re.compile(r"^\s*!(время|данные|код|продлить|проблема|помощь)\b", re.IGNORECASE)
+BUYER_HELP_TEXT = ("Команды аренды:\n"
+                   "!время - сколько осталось\n"
+                   "!данные - повторно прислать логин и пароль\n"
+                   "!код - код Steam Guard для входа\n"
+                   "!продлить - как продлить аренду\n"
+                   "!проблема ОПИСАНИЕ - сообщить, что аккаунт не работает")
+
+def format_remaining_time(rental):
+    """Оставшееся время аренды: "N ч. M мин." """
+    remaining = max(0, int(rental.end_time - time.time()))
+    hours, remainder = divmod(remaining, 3600)
+    return f"{hours} ч. {remainder // 60} мин."
+
+def handle_buyer_command(command, user_id, username, argument=""):
+    """Отвечает покупателю на команду из чата; возвращает текст ответа"""
+    if command == "помощь":
+        return BUYER_HELP_TEXT
     
-    # Здесь можно добавить обработку команд из сообщений
-    # Например, команда для получения информации о текущей аренде
+    rentals = rental_manager.active_rentals_for_user(user_id)
+    if not rentals:
+        return "У вас нет активных аренд."
     
-    # В данной реализации не требуется особой обработки сообщений,
-    # основная логика выполняется через Telegram-команды
+    lines = []
+    if command == "время":
+        for rental in rentals:
+            lines.append(f"{rental.account_login}: осталось {format_remaining_time(rental)} (до {rental.get_formatted_end_time()})")
+    elif command == "данные":
+        for rental in rentals:
+            account = rental_manager.accounts.get(rental.account_login)
+            if account:
+                lines.append(f"Логин: {account.login}\nПароль: {account.password}\nДо: {rental.get_formatted_end_time()}")
+        metrics.inc("steamrent_credentials_resent_total", len(lines))
+    elif command == "код":
+        for rental in rentals:
+            account = rental_manager.accounts.get(rental.account_login)
+            if not account or not account.shared_secret:
+                lines.append(f"{rental.account_login}: Steam Guard не требуется")
+                continue
+            code, expires_in = steam_guard.code(account)
+            lines.append(f"Код Steam Guard для {account.login}: {code}\nДействует еще {expires_in} с.")
+    elif command == "продлить":
+        for rental in rentals:
+            account = rental_manager.accounts.get(rental.account_login)
+            lots = [lot_name for lot_name, binding in lot_bindings.items()
+                    if account and binding["account_type"] == account.type]
+            lot_hint = f": {', '.join(lots[:3])}" if lots else ""
+            lines.append(f"{rental.account_login} (до {rental.get_formatted_end_time()}) - оплатите лот этого типа еще раз{lot_hint}")
+        lines.append("Время добавится к текущей аренде.")
+    elif command == "проблема":
+        for rental in rentals:
+            # Повторная жалоба на ту же аренду здоровье не снижает, но администратор ее видит
+            counted = rental_manager.record_complaint(rental) is not None
+            account = rental_manager.accounts.get(rental.account_login)
+            if account and not account.is_healthy() and not account.quarantine:
+                # Нездоровый аккаунт больше не выдается: после этой аренды он уйдет в карантин
+                rental_manager.quarantine_account(account.login, f"жалобы покупателей ({account.complaints})")
+            # Текст жалобы пишет покупатель: без экранирования Telegram отклонит HTML и жалоба потеряется
+            notify_admin(
+                f"🚩 <b>{'Жалоба покупателя' if counted else 'Повторная жалоба покупателя'}</b>\n\n"
+                f"Покупатель: <b>{html.escape(str(username))}</b>\n"
+                f"Аккаунт: <code>{rental.account_login}</code>\n"
+                f"Здоровье: <b>{account.health if account else '—'}</b>\n"
+                f"Текст: {html.escape(argument) if argument else '—'}"
+            )
+        lines.append("Сообщение передано администратору, он свяжется с вами в этом чате.")
+    return "\n\n".join(lines)
+
+ORDER_STATE_TITLES = {"fulfilled": "выполнен", "in_flight": "выполняется", "backordered": "в очереди"}
 
 def order_handler(c, event, *args):
     """Обработчик новых заказов"""
@@ -1666,22 +4902,48 @@ def order_handler(c, event, *args):
         return
     
     order = event.order
+    
+    # Заказ, пришедший во время загрузки, ждет готовности данных
+    if not wait_until_ready():
+        reason = f"аварийный режим: {STATE_LOAD_ERROR}" if STATE_LOAD_ERROR else f"данные не загрузились за {STATE_WAIT_TIMEOUT} с"
+        logger.error(f"{LOGGER_PREFIX} Заказ {order.id} не обработан, {reason}")
+        return
+    
+    with tracer.trace("order", order.id):
+        # Повторно доставленное событие (переподключение, перезапуск) не выдает второй аккаунт
+        state = rental_manager.claim_order(order.id)
+        if state == "claimed" and backorders.contains(order.id):
+            rental_manager.release_order(order.id)
+            state = "backordered"
+        if state != "claimed":
+            metrics.inc("steamrent_orders_duplicate_total", state=state)
+            logger.warning(f"{LOGGER_PREFIX} Заказ {order.id} уже {ORDER_STATE_TITLES[state]}, повтор события пропущен")
+            return
+        try:
+            process_order(c, order)
+        finally:
+            rental_manager.release_order(order.id)
+        # Аккаунт мог освободиться, пока заказ ставился в очередь; пока заказ был занят, поток очереди его пропускал
+        backorders.notify()
+
+def process_order(c, order):
+    """Выдает аккаунт по заказу: привязка, аренда, сообщения покупателю и администратору"""
+    order_started = time.perf_counter()
+    metrics.inc("steamrent_orders_total")
     logger.info(f"{LOGGER_PREFIX} Получен новый заказ: {order.id}")
     
-    # Отладочный вывод для диагностики
-    logger.info(f"{LOGGER_PREFIX} Отладка заказа: {vars(order)}")
+    # Отладочный вывод для диагностики (только в режиме отладки заказа)
+    log_debug("order.dump", order_id=order.id, fields=lambda: vars(order))
     
     # Получаем описание лота
-    lot_description = None
     if hasattr(order, 'description'):
         full_description = order.description
-        logger.info(f"{LOGGER_PREFIX} Полное описание лота: {full_description}")
         
         # Извлекаем только название лота, отбрасывая категорию
         # Формат: "Название лота, Категория, Подкатегория"
         parts = full_description.split(',', 1)
         lot_name = parts[0].strip()
-        logger.info(f"{LOGGER_PREFIX} Извлеченное название лота: {lot_name}")
+        log_debug("order.lot", order_id=order.id, lot=lot_name, description=full_description)
     else:
         logger.info(f"{LOGGER_PREFIX} Не удалось получить описание лота")
         return
@@ -1691,12 +4953,14 @@ def order_handler(c, event, *args):
     matching_name = None
     
     # Проверяем точное совпадение
-    if lot_name in lot_bindings:
-        matching_binding = lot_bindings[lot_name]
-        matching_name = lot_name
-        logger.info(f"{LOGGER_PREFIX} Найдено точное совпадение: '{lot_name}'")
+    with tracer.span("binding_lookup"):
+        if lot_name in lot_bindings:
+            matching_binding = lot_bindings[lot_name]
+            matching_name = lot_name
+            log_debug("order.binding", order_id=order.id, lot=lot_name)
     
     # Если не нашли подходящую привязку - выходим
+    metrics.inc("steamrent_binding_lookups_total", result="hit" if matching_binding else "miss")
     if not matching_binding:
         logger.info(f"{LOGGER_PREFIX} Не найдено привязки для заказа {order.id} с названием: {lot_name}")
         return
@@ -1728,117 +4992,218 @@ def order_handler(c, event, *args):
             pass
         return
     
-    # Выбираем аккаунт нужного типа
-    account = rental_manager.get_account_by_type(account_type)
+    # Количество в заказе: умножает срок или число аккаунтов, если это включено в привязке
+    quantity = get_order_quantity(order)
+    quantity_mode = matching_binding.get("quantity_mode", "single")
+    count = 1
+    if quantity > 1 and quantity_mode != "single":
+        if quantity_mode == "accounts":
+            count = quantity
+        else:
+            duration_hours *= quantity
+        metrics.inc("steamrent_orders_multi_unit_total", mode=quantity_mode)
+        logger.info(f"{LOGGER_PREFIX} Заказ {order.id}: количество {quantity}, аккаунтов {count}, срок {duration_hours} ч.")
     
-    if not account:
-        try:
-            logger.error(f"{LOGGER_PREFIX} Нет доступных аккаунтов типа {account_type}")
-        except Exception:
-            pass
-        
-        # Отправляем уведомление администратору об отсутствии доступных аккаунтов
-        if CARDINAL and hasattr(CARDINAL, "MAIN_CFG") and "telegram" in CARDINAL.MAIN_CFG and "admin_id" in CARDINAL.MAIN_CFG["telegram"]:
-            admin_id = CARDINAL.MAIN_CFG["telegram"]["admin_id"]
-            try:
-                error_message = f"⚠️ <b>Ошибка аренды аккаунта</b>\n\n" \
-                               f"Заказ: <code>#{order.id}</code>\n" \
-                               f"Покупатель: <b>{username}</b>\n" \
-                               f"Требуемый тип: <code>{account_type}</code>\n\n" \
-                               f"<b>Нет доступных аккаунтов указанного типа!</b>"
-                CARDINAL.telegram.bot.send_message(admin_id, error_message, parse_mode="HTML")
-            except:
-                pass
-        
+    # Повторная покупка при активной аренде того же типа продлевает ее без смены аккаунта
+    if count == 1:
+        existing = rental_manager.find_active_rental(user_id, account_type)
+        if existing and extend_order(order, existing, duration_hours, user_id, username, order_started):
+            return
+    
+    # Спрос учитываем до выдачи: заказы из очереди тоже расходуют запас
+    demand.record_order(account_type, duration_hours, count)
+    
+    # Проверяем, хватает ли свободных аккаунтов нужного типа; ждущие заказы типа выдаются первыми
+    with tracer.span("account_lookup"):
+        available = rental_manager.count_available(account_type)
+    
+    if available < count or backorders.pending(account_type):
+        if available < count:
+            metrics.inc("steamrent_pool_exhausted_total", type=account_type)
+            logger.warning(f"{LOGGER_PREFIX} Нет доступных аккаунтов типа {account_type}, заказ {order.id} поставлен в очередь")
+        backorder_order(order.id, user_id, username, account_type, duration_hours, count)
         return
     
-    # Арендуем аккаунт
-    success, message_text, account, rental = rental_manager.rent_account(
-        user_id, username, duration_hours, account_type, order.id
-    )
+    # Аккаунт могли занять между проверкой и арендой - тогда заказ ждет в очереди
+    if not issue_order(order.id, user_id, username, account_type, duration_hours, count, order_started):
+        backorder_order(order.id, user_id, username, account_type, duration_hours, count)
+
+def issue_order(order_id, user_id, username, account_type, duration_hours, count=1, order_started=None):
+    """Арендует аккаунты по заказу и отправляет данные покупателю; False - свободных аккаунтов не хватило"""
+    # Арендуем аккаунты одной операцией
+    with tracer.span("rent_account"):
+        success, message_text, issued = rental_manager.rent_accounts(
+            user_id, username, duration_hours, account_type, order_id, count
+        )
     
     if not success:
-        try:
-            logger.error(f"{LOGGER_PREFIX} Не удалось арендовать аккаунт: {message_text}")
-        except Exception:
-            pass
-            
-        # Отправляем уведомление администратору о проблеме
-        if CARDINAL and hasattr(CARDINAL, "MAIN_CFG") and "telegram" in CARDINAL.MAIN_CFG and "admin_id" in CARDINAL.MAIN_CFG["telegram"]:
-            admin_id = CARDINAL.MAIN_CFG["telegram"]["admin_id"]
-            try:
-                error_message = f"⚠️ <b>Ошибка аренды аккаунта</b>\n\n" \
-                               f"Заказ: <code>#{order.id}</code>\n" \
-                               f"Покупатель: <b>{username}</b>\n" \
-                               f"Требуемый тип: <code>{account_type}</code>\n\n" \
-                               f"<b>Ошибка:</b> {message_text}"
-                CARDINAL.telegram.bot.send_message(admin_id, error_message, parse_mode="HTML")
-            except:
-                pass
-        
-        return
+        logger.error(f"{LOGGER_PREFIX} Не удалось арендовать аккаунт для заказа {order_id}: {message_text}")
+        return False
     
     # Формируем информацию об аренде
+    account, rental = issued[0]
     end_time_str = datetime.fromtimestamp(rental.end_time).strftime("%d.%m.%Y %H:%M")
+    logins_short = ", ".join(f"<code>{issued_account.login}</code>" for issued_account, _ in issued)
+    logins_text = ", ".join(f"<code>{issued_account.login}</code> / <code>{issued_account.password}</code>"
+                            for issued_account, _ in issued)
+    
+    # Используем шаблон сообщения вместо жестко закодированного текста; все аккаунты заказа - одним сообщением
+    if len(issued) == 1:
+        message = format_message("rental_start", 
+            login=account.login,
+            password=account.password,
+            account_type=account.type,
+            duration_hours=duration_hours,
+            end_time=end_time_str,
+            username=username,
+            order_id=order_id
+        )
+    else:
+        message = format_message("rental_start_multi",
+            accounts="\n".join(f"{number}. 👤 <code>{issued_account.login}</code> 🔑 <code>{issued_account.password}</code>"
+                               for number, (issued_account, _) in enumerate(issued, 1)),
+            account_type=account.type,
+            duration_hours=duration_hours,
+            end_time=end_time_str,
+            username=username,
+            order_id=order_id
+        )
+    
+    # Отправляем данные сразу; при неудаче сообщение остается в очереди повторов
+    delivered, error = funpay_delivery.send(user_id, username, message, kind="rental_start")
+    if delivered:
+        if order_started is not None:
+            metrics.observe("steamrent_order_delivery_seconds", time.perf_counter() - order_started)
+        logger.info(f"{LOGGER_PREFIX} Сообщение отправлено пользователю {username}")
+    else:
+        # Отправляем информацию администратору (сразу: покупатель не получил данные)
+        admin_digest.add(
+            "failed",
+            f"#{order_id} {username}: данные {logins_short} не доставлены",
+            f"⚠️ <b>Аккаунт выдан (ошибка отправки сообщения)</b>\n\n"
+            f"Заказ: <code>#{order_id}</code>\n"
+            f"Покупатель: <b>{username}</b>\n"
+            f"Аккаунт: {logins_text}\n"
+            f"Тип: <code>{account.type}</code>\n"
+            f"Срок: <code>{duration_hours} ч.</code>\n\n"
+            f"<b>Ошибка:</b> {error}\n"
+            f"Отправка будет повторена автоматически.",
+            critical=True
+        )
+    
+    # Отправляем подтверждение администратору
+    admin_digest.add(
+        "issued",
+        f"#{order_id} {username}: {logins_text} ({account.type}, {duration_hours} ч.)",
+        f"✅ <b>Аккаунт выдан</b>\n\n"
+        f"Заказ: <code>#{order_id}</code>\n"
+        f"Покупатель: <b>{username}</b>\n"
+        f"Аккаунт: {logins_text}\n"
+        f"Тип: <code>{account.type}</code>\n"
+        f"Срок: <code>{duration_hours} ч.</code>"
+    )
+    
+    # Предупреждаем, когда пул типа почти исчерпан
+    available = rental_manager.count_available(account.type)
+    if available in (0, LIVE_BOARD_LOW_STOCK):
+        admin_digest.add(
+            "low_stock",
+            f"{account.type}: свободно {available}",
+            f"⚠️ <b>Заканчиваются аккаунты</b>\n\n"
+            f"Тип: <code>{account.type}</code>\n"
+            f"Свободно: <b>{available}</b>"
+        )
+    demand.check_alert(account.type)
+    return True
+
+def backorder_order(order_id, user_id, username, account_type, duration_hours, count=1):
+    """Ставит заказ в очередь ожидания и сообщает покупателю примерное время выдачи"""
+    position, eta = backorders.add(order_id, user_id, username, account_type, duration_hours, count)
+    eta_text = format_backorder_eta(eta)
+    
+    message = format_message("rental_backorder",
+        order_id=order_id,
+        position=position,
+        eta=eta_text,
+        account_type=account_type,
+        duration_hours=duration_hours,
+        username=username
+    )
+    funpay_delivery.send(user_id, username, message, kind="rental_backorder")
+    
+    admin_digest.add(
+        "backorder",
+        f"#{order_id} {username}: {account_type} ×{count}, {position}-й в очереди, выдача {eta_text}",
+        f"⏳ <b>Заказ в очереди</b>\n\n"
+        f"Заказ: <code>#{order_id}</code>\n"
+        f"Покупатель: <b>{username}</b>\n"
+        f"Требуемый тип: <code>{account_type}</code>\n"
+        f"Требуется аккаунтов: <code>{count}</code>\n"
+        f"Место в очереди: <b>{position}</b>\n"
+        f"Ожидаемая выдача: {eta_text}\n\n"
+        f"Аккаунт будет выдан автоматически, как только освободится."
+    )
+
+def format_backorder_eta(eta):
+    """Ожидаемое время выдачи для покупателя"""
+    if eta is None:
+        return "уточняется"
+    minutes = max(1, int((eta - time.time() + 59) // 60))
+    return f"~{minutes} мин. ({datetime.fromtimestamp(eta).strftime('%d.%m.%Y %H:%M')})"
+
+# Что умножает количество в заказе: срок аренды или число аккаунтов
+# Что умножает количество в заказе; привязки без quantity_mode выдают один аккаунт на срок привязки, как раньше
+QUANTITY_MODES = {"один": "single", "single": "single", "часы": "hours", "hours": "hours",
+                  "аккаунты": "accounts", "accounts": "accounts"}
+QUANTITY_MODE_TITLES = {"single": "не учитывается", "hours": "часы", "accounts": "аккаунты"}
+
+def get_order_quantity(order):
+    """Количество единиц в заказе FunPay (не меньше 1)"""
+    try:
+        return max(1, int(getattr(order, "amount", 1) or 1))
+    except (TypeError, ValueError):
+        return 1
+
+def extend_order(order, rental, duration_hours, user_id, username, order_started):
+    """Продлевает активную аренду покупателя по повторному заказу; False - нужна новая выдача"""
+    with tracer.span("extend_rental"):
+        success, message_text = rental_manager.extend_rental(rental.id, duration_hours, order_id=order.id)
+    if not success:
+        logger.info(f"{LOGGER_PREFIX} Аренду {rental.id} не удалось продлить ({message_text}), выдаем новый аккаунт")
+        return False
+    
+    metrics.inc("steamrent_rentals_extended_total")
+    logger.info(f"{LOGGER_PREFIX} Заказ {order.id} продлил аренду {rental.id} ({rental.account_login}) на {duration_hours} ч.")
+    account = rental_manager.accounts.get(rental.account_login)
+    account_type = account.type if account else ""
+    end_time_str = rental.get_formatted_end_time()
     
-    # Используем шаблон сообщения вместо жестко закодированного текста
-    message = format_message("rental_start", 
-        login=account.login,
-        password=account.password,
-        account_type=account.type,
+    message = format_message("rental_extend",
+        login=rental.account_login,
+        account_type=account_type,
         duration_hours=duration_hours,
         end_time=end_time_str,
         username=username,
         order_id=order.id
     )
+    delivered, error = funpay_delivery.send(user_id, username, message, kind="rental_extend")
+    if delivered:
+        metrics.observe("steamrent_order_delivery_seconds", time.perf_counter() - order_started)
+    else:
+        logger.warning(f"{LOGGER_PREFIX} Сообщение о продлении для {username} не доставлено: {error}")
     
-    # Отправляем сообщение максимально простым способом
-    try:
-        # Прямая отправка сообщения через FunPay
-        if hasattr(c, 'account') and hasattr(c.account, 'send_message'):
-            # Получаем данные чата
-            chat_id = f"users-{user_id}-{c.account.id}"
-            interlocutor_id = user_id
-            chat_name = f"Переписка с {username}"
-            
-            # Используем низкоуровневый метод отправки сообщений
-            c.account.send_message(chat_id, message, chat_name, interlocutor_id, None, True, False, False)
-            logger.info(f"{LOGGER_PREFIX} Сообщение отправлено пользователю {username}")
-        else:
-            logger.warning(f"{LOGGER_PREFIX} Невозможно отправить сообщение: методы отправки недоступны")
-    except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка при отправке сообщения: {e}")
-        
-        # Отправляем информацию администратору
-        if CARDINAL and hasattr(CARDINAL, "MAIN_CFG") and "telegram" in CARDINAL.MAIN_CFG and "admin_id" in CARDINAL.MAIN_CFG["telegram"]:
-            admin_id = CARDINAL.MAIN_CFG["telegram"]["admin_id"]
-            try:
-                admin_message = f"⚠️ <b>Аккаунт выдан (ошибка отправки сообщения)</b>\n\n" \
-                              f"Заказ: <code>#{order.id}</code>\n" \
-                              f"Покупатель: <b>{username}</b>\n" \
-                              f"Аккаунт: <code>{account.login}</code>\n" \
-                              f"Пароль: <code>{account.password}</code>\n" \
-                              f"Тип: <code>{account.type}</code>\n" \
-                              f"Срок: <code>{duration_hours} ч.</code>\n\n" \
-                              f"<b>Ошибка:</b> {str(e)}"
-                CARDINAL.telegram.bot.send_message(admin_id, admin_message, parse_mode="HTML")
-            except:
-                pass
-    
-    # Отправляем подтверждение администратору
-    if CARDINAL and hasattr(CARDINAL, "MAIN_CFG") and "telegram" in CARDINAL.MAIN_CFG and "admin_id" in CARDINAL.MAIN_CFG["telegram"]:
-        admin_id = CARDINAL.MAIN_CFG["telegram"]["admin_id"]
-        try:
-            admin_message = f"✅ <b>Аккаунт выдан</b>\n\n" \
-                          f"Заказ: <code>#{order.id}</code>\n" \
-                          f"Покупатель: <b>{username}</b>\n" \
-                          f"Аккаунт: <code>{account.login}</code>\n" \
-                          f"Пароль: <code>{account.password}</code>\n" \
-                          f"Тип: <code>{account.type}</code>\n" \
-                          f"Срок: <code>{duration_hours} ч.</code>"
-            CARDINAL.telegram.bot.send_message(admin_id, admin_message, parse_mode="HTML")
-        except:
-            pass
+    admin_digest.add(
+        "extended",
+        f"#{order.id} {username}: <code>{rental.account_login}</code> +{duration_hours} ч. до {end_time_str}",
+        f"➕ <b>Аренда продлена</b>\n\n"
+        f"Заказ: <code>#{order.id}</code>\n"
+        f"Покупатель: <b>{username}</b>\n"
+        f"Аккаунт: <code>{rental.account_login}</code>\n"
+        f"Тип: <code>{account_type}</code>\n"
+        f"Добавлено: <code>{duration_hours} ч.</code>\n"
+        f"Окончание: {end_time_str}"
+    )
+    return True
 
 # Глобальные привязки (обязательные)
 BIND_TO_PRE_INIT = [init_plugin]
@@ -1859,7 +5224,7 @@ def interactive_add_account_start(message):
     """Начинает процесс интерактивного добавления аккаунта"""
     try:
         chat_id = message.chat.id
-        ADD_ACCOUNT_STATES[chat_id] = {"state": "login", "data": {}}
+        conversations.start(chat_id, "add_account", "login")
         
         # Создаем клавиатуру для отмены
         markup = InlineKeyboardMarkup()
@@ -1884,7 +5249,7 @@ def interactive_add_account_start_callback(call):
     """Начинает процесс интерактивного добавления аккаунта (callback)"""
     try:
         chat_id = call.message.chat.id
-        ADD_ACCOUNT_STATES[chat_id] = {"state": "login", "data": {}}
+        conversations.start(chat_id, "add_account", "login")
         
         # Создаем клавиатуру для отмены
         markup = InlineKeyboardMarkup()
@@ -1913,9 +5278,8 @@ def cancel_add_account_callback(call):
     try:
         chat_id = call.message.chat.id
         
-        # Проверяем, находится ли пользователь в процессе добавления аккаунта
-        if chat_id in ADD_ACCOUNT_STATES:
-            del ADD_ACCOUNT_STATES[chat_id]
+        # Завершаем диалог добавления аккаунта, если он был
+        conversations.finish(chat_id, "add_account")
         
         # Создаем клавиатуру для возврата в меню
         markup = InlineKeyboardMarkup()
@@ -1937,22 +5301,23 @@ def cancel_add_account_callback(call):
         except:
             pass
 
-def handle_account_add_steps(message):
+def handle_account_add_steps(message, conversation=None):
     """Обрабатывает шаги интерактивного добавления аккаунта"""
     try:
         chat_id = message.chat.id
         
         # Проверяем, находится ли пользователь в процессе добавления аккаунта
-        if chat_id not in ADD_ACCOUNT_STATES:
+        conversation = conversation or conversations.get(chat_id, "add_account")
+        if not conversation:
             return
         
         # Получаем текущее состояние и данные
-        state = ADD_ACCOUNT_STATES[chat_id]["state"]
-        data = ADD_ACCOUNT_STATES[chat_id]["data"]
+        state = conversation["state"]
+        data = conversation["data"]
         
         # Проверяем запрос на отмену
         if message.text.lower() in ["отмена", "cancel", "/cancel", "/отмена"]:
-            del ADD_ACCOUNT_STATES[chat_id]
+            conversations.finish(chat_id)
             CARDINAL.telegram.bot.send_message(
                 chat_id,
                 "❌ Процесс добавления аккаунта отменен.",
@@ -1974,7 +5339,7 @@ def handle_account_add_steps(message):
                 return
             
             data["login"] = login
-            ADD_ACCOUNT_STATES[chat_id]["state"] = "password"
+            conversations.set_state(chat_id, "password")
             
             CARDINAL.telegram.bot.send_message(
                 chat_id,
@@ -1988,7 +5353,7 @@ def handle_account_add_steps(message):
             # Получаем пароль
             password = message.text.strip()
             data["password"] = password
-            ADD_ACCOUNT_STATES[chat_id]["state"] = "type"
+            conversations.set_state(chat_id, "type")
             
             CARDINAL.telegram.bot.send_message(
                 chat_id,
@@ -2003,7 +5368,7 @@ def handle_account_add_steps(message):
             # Получаем тип
             account_type = message.text.strip().lower()
             data["type"] = account_type
-            ADD_ACCOUNT_STATES[chat_id]["state"] = "api_key"
+            conversations.set_state(chat_id, "api_key")
             
             CARDINAL.telegram.bot.send_message(
                 chat_id,
@@ -2033,7 +5398,7 @@ def handle_account_add_steps(message):
             )
             
             # Удаляем состояние
-            del ADD_ACCOUNT_STATES[chat_id]
+            conversations.finish(chat_id)
             
             # Формируем клавиатуру для перехода в меню
             markup = InlineKeyboardMarkup()
@@ -2058,88 +5423,95 @@ def handle_account_add_steps(message):
                     parse_mode="HTML"
                 )
     
-    except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике handle_account_add_steps: {e}")
-        try:
-            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
-        except:
-            pass
-        
-        # В случае ошибки удаляем состояние
-        if chat_id in ADD_ACCOUNT_STATES:
-            del ADD_ACCOUNT_STATES[chat_id]
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике handle_account_add_steps: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+        
+        # В случае ошибки удаляем состояние
+        conversations.finish(message.chat.id, "add_account")
+
+# Функции меню и интерфейса
+def build_menu_view(add_button=True):
+    """Строит текст и клавиатуру главного меню"""
+    # Создаем клавиатуру с кнопками
+    markup = InlineKeyboardMarkup(row_width=2)
+    
+    # Статус-секция
+    status_emoji = "✅" if RUNNING else "❌"
+    
+    # Верхние кнопки управления - самые важные
+    if RUNNING:
+        markup.row(InlineKeyboardButton("🔴 Остановить аренду", callback_data="srent_stop"))
+    else:
+        markup.row(InlineKeyboardButton("🟢 Запустить аренду", callback_data="srent_start"))
+    
+    # Раздел аккаунтов и добавление
+    markup.row(
+        InlineKeyboardButton("🕹️ Аккаунты", callback_data="srent_accounts"),
+        InlineKeyboardButton("➕ Добавить", callback_data="srent_add")
+    )
+    
+    # Раздел привязок и статистики
+    markup.row(
+        InlineKeyboardButton("🛜 Привязки", callback_data="srent_lot_bindings"),
+        InlineKeyboardButton("📊 Статистика", callback_data="srent_status")
+    )
+    
+    # Раздел возврата и шаблонов
+    markup.row(
+        InlineKeyboardButton("🛞 Возврат аккаунта", callback_data="srent_return"),
+        InlineKeyboardButton("✏️ Текст шаблонов", callback_data="srent_list_templates")
+    )
+    markup.row(InlineKeyboardButton("📈 Метрики", callback_data="srent_metrics"))
+    
+    # Создаем красивый вывод статуса
+    header = "🎮 Система аренды аккаунтов Steam"
+    status_line = f"\nСтатус: {status_emoji} {'АКТИВНА' if RUNNING else 'ОСТАНОВЛЕНА'}"
+    
+    # Добавляем список аккаунтов по типам
+    accounts_text = "\n\n📝 Список аккаунтов по типам:\n\n"
+    
+    # Группируем аккаунты по типам
+    accounts_by_type = {}
+    for acc in rental_manager.accounts.values():
+        if acc.type not in accounts_by_type:
+            accounts_by_type[acc.type] = []
+        accounts_by_type[acc.type].append(acc)
+    
+    # Формируем список аккаунтов по типам
+    for acc_type, accs in accounts_by_type.items():
+        accounts_text += f"🔹 {acc_type.upper()} ({len(accs)} шт.):\n"
+        for acc in accs:
+            status = "✅ Доступен" if acc.status == "available" else "❌ В аренде"
+            accounts_text += f"  • {acc.login} - {status} \n"
+        accounts_text += "\n"
+    
+    # Форматируем сообщение
+    message_text = f"{header}{status_line}\n\nВыберите действие из меню ниже:"
+    
+    # Добавляем список аккаунтов, если есть аккаунты
+    if rental_manager.accounts:
+        message_text += accounts_text
+    
+    # Добавляем кнопки для действий внизу сообщения
+    if add_button:
+        markup.row(
+            InlineKeyboardButton("Обновить 🆙", callback_data="srent_menu"),
+            InlineKeyboardButton("Добавить аккаунт ✅", callback_data="srent_add")
+        )
+    else:
+        # Только одна кнопка для обновления
+        markup.row(InlineKeyboardButton("Обновить 🆙", callback_data="srent_menu"))
+    
+    return message_text, markup
 
-# Функции меню и интерфейса
 def show_menu(message):
     """Показывает главное меню плагина"""
     try:
-        # Создаем клавиатуру с кнопками
-        markup = InlineKeyboardMarkup(row_width=2)
-        
-        # Статус-секция
-        status_emoji = "✅" if RUNNING else "❌"
-        available_count = sum(1 for acc in rental_manager.accounts.values() if acc.status == "available")
-        rented_count = sum(1 for acc in rental_manager.accounts.values() if acc.status == "rented")
-        
-        # Верхние кнопки управления - самые важные
-        if RUNNING:
-            markup.row(InlineKeyboardButton("🔴 Остановить аренду", callback_data="srent_stop"))
-        else:
-            markup.row(InlineKeyboardButton("🟢 Запустить аренду", callback_data="srent_start"))
-        
-        # Раздел аккаунтов и добавление
-        markup.row(
-            InlineKeyboardButton("🕹️ Аккаунты", callback_data="srent_accounts"),
-            InlineKeyboardButton("➕ Добавить", callback_data="srent_add")
-        )
-        
-        # Раздел привязок и статистики
-        markup.row(
-            InlineKeyboardButton("🛜 Привязки", callback_data="srent_lot_bindings"),
-            InlineKeyboardButton("📊 Статистика", callback_data="srent_status")
-        )
-        
-        # Раздел возврата и шаблонов
-        markup.row(
-            InlineKeyboardButton("🛞 Возврат аккаунта", callback_data="srent_return"),
-            InlineKeyboardButton("✏️ Текст шаблонов", callback_data="srent_list_templates")
-        )
-        
-        # Создаем красивый вывод статуса
-        header = "🎮 Система аренды аккаунтов Steam"
-        status_line = f"\nСтатус: {status_emoji} {'АКТИВНА' if RUNNING else 'ОСТАНОВЛЕНА'}"
-        
-        # Добавляем список аккаунтов по типам
-        accounts_text = "\n\n📝 Список аккаунтов по типам:\n\n"
-        
-        # Группируем аккаунты по типам
-        accounts_by_type = {}
-        for acc in rental_manager.accounts.values():
-            if acc.type not in accounts_by_type:
-                accounts_by_type[acc.type] = []
-            accounts_by_type[acc.type].append(acc)
-        
-        # Формируем список аккаунтов по типам
-        for acc_type, accs in accounts_by_type.items():
-            accounts_text += f"🔹 {acc_type.upper()} ({len(accs)} шт.):\n"
-            for acc in accs:
-                status = "✅ Доступен" if acc.status == "available" else "❌ В аренде"
-                accounts_text += f"  • {acc.login} - {status} \n"
-            accounts_text += "\n"
-        
-        # Форматируем сообщение
-        message_text = f"{header}{status_line}\n\nВыберите действие из меню ниже:"
-        
-        # Добавляем список аккаунтов, если есть аккаунты
-        if rental_manager.accounts:
-            message_text += accounts_text
-        
-        # Добавляем кнопки для действий внизу сообщения
-        # Только одна кнопка для обновления и добавления аккаунта
-        markup.row(
-            InlineKeyboardButton("Обновить 🆙", callback_data="srent_menu"),
-        )
-        
+        message_text, markup = render_cache.render("menu_message", lambda: build_menu_view(add_button=False))
         CARDINAL.telegram.bot.send_message(
             message.chat.id,
             message_text,
@@ -2156,403 +5528,682 @@ def show_menu(message):
 def show_menu_callback(call):
     """Обработчик кнопки меню"""
     try:
-        # Создаем клавиатуру с кнопками
-        markup = InlineKeyboardMarkup(row_width=2)
-        
-        # Статус-секция
-        status_emoji = "✅" if RUNNING else "❌"
-        available_count = sum(1 for acc in rental_manager.accounts.values() if acc.status == "available")
-        rented_count = sum(1 for acc in rental_manager.accounts.values() if acc.status == "rented")
-        
-        # Верхние кнопки управления - самые важные
+        edit_cached_view(call, "menu", build_menu_view, "Меню обновлено")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка обновления меню: {e}")
+        try:
+            CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
+        except:
+            pass
+
+def start_rental_callback(call):
+    """Обработчик кнопки запуска системы"""
+    global RUNNING
+    try:
         if RUNNING:
-            markup.row(InlineKeyboardButton("🔴 Остановить аренду", callback_data="srent_stop"))
-        else:
-            markup.row(InlineKeyboardButton("🟢 Запустить аренду", callback_data="srent_start"))
-        
-        # Раздел аккаунтов и добавление
-        markup.row(
-            InlineKeyboardButton("🕹️ Аккаунты", callback_data="srent_accounts"),
-            InlineKeyboardButton("➕ Добавить", callback_data="srent_add")
-        )
+            CARDINAL.telegram.bot.answer_callback_query(call.id, "Система уже запущена!")
+            return
+            
+        RUNNING = True
+        logger.info(f"{LOGGER_PREFIX} Система аренды запущена через кнопку меню")
         
-        # Раздел привязок и статистики
-        markup.row(
-            InlineKeyboardButton("🛜 Привязки", callback_data="srent_lot_bindings"),
-            InlineKeyboardButton("📊 Статистика", callback_data="srent_status")
-        )
+        # Обновляем сообщение меню
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
         
-        # Раздел возврата и шаблонов
-        markup.row(
-            InlineKeyboardButton("🛞 Возврат аккаунта", callback_data="srent_return"),
-            InlineKeyboardButton("✏️ Текст шаблонов", callback_data="srent_list_templates")
+        CARDINAL.telegram.bot.edit_message_text(
+            "✅ <b>Система аренды успешно запущена!</b>\n\n"
+            "Теперь бот будет автоматически выдавать аккаунты при покупке соответствующих лотов.",
+            call.message.chat.id,
+            call.message.message_id,
+            reply_markup=markup,
+            parse_mode="HTML"
         )
+        CARDINAL.telegram.bot.answer_callback_query(call.id, "Система запущена!")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка запуска системы аренды: {e}")
+        try:
+            CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
+        except:
+            pass
+
+def stop_rental_callback(call):
+    """Обработчик кнопки остановки системы"""
+    global RUNNING
+    try:
+        if not RUNNING:
+            CARDINAL.telegram.bot.answer_callback_query(call.id, "Система уже остановлена!")
+            return
+            
+        RUNNING = False
+        logger.info(f"{LOGGER_PREFIX} Система аренды остановлена через кнопку меню")
         
-        # Создаем красивый вывод статуса
-        header = "🎮 Система аренды аккаунтов Steam"
-        status_line = f"\nСтатус: {status_emoji} {'АКТИВНА' if RUNNING else 'ОСТАНОВЛЕНА'}"
-        
-        # Добавляем список аккаунтов по типам
-        accounts_text = "\n\n📝 Список аккаунтов по типам:\n\n"
+        # Обновляем сообщение меню
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
         
+        CARDINAL.telegram.bot.edit_message_text(
+            "🛑 <b>Система аренды остановлена!</b>\n\n"
+            "Автоматическая выдача аккаунтов при покупке лотов отключена.\n"
+            "Активные аренды продолжат работать до завершения.",
+            call.message.chat.id,
+            call.message.message_id,
+            reply_markup=markup,
+            parse_mode="HTML"
+        )
+        CARDINAL.telegram.bot.answer_callback_query(call.id, "Система остановлена!")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка остановки системы аренды: {e}")
+        try:
+            CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
+        except:
+            pass
+
+def build_status_view():
+    """Строит текст и клавиатуру статистики системы"""
+    # Считаем статистику
+    total_accounts = len(rental_manager.accounts)
+    available_accounts = sum(1 for acc in rental_manager.accounts.values() if acc.status == 'available')
+    rented_accounts = sum(1 for acc in rental_manager.accounts.values() if acc.status == 'rented')
+    disabled_accounts = sum(1 for acc in rental_manager.accounts.values() if acc.status == 'disabled')
+    
+    active_rentals = sum(1 for rent in rental_manager.rentals.values() if rent.is_active)
+    total_rentals = len(rental_manager.rentals)
+    
+    # Общая информация о состоянии
+    status_emoji = "🟢" if RUNNING else "🔴"
+    
+    # Создаем сообщение статистики
+    status_text = "📊 <b>СТАТИСТИКА СИСТЕМЫ</b> 📊\n\n"
+    status_text += f"{'='*30}\n\n"
+    
+    # Общий статус
+    status_text += f"<b>СТАТУС СИСТЕМЫ:</b> {status_emoji} <b>{'АКТИВНА' if RUNNING else 'ОСТАНОВЛЕНА'}</b>\n\n"
+    status_text += f"{'='*30}\n\n"
+    
+    # Секция аккаунтов
+    status_text += "🖥️ <b>АККАУНТЫ</b>\n\n"
+    
+    # Добавляем график в виде прогресс-бара для наглядности
+    if total_accounts > 0:
+        available_percent = int((available_accounts / total_accounts) * 10)
+        rented_percent = int((rented_accounts / total_accounts) * 10)
+        disabled_percent = max(0, 10 - available_percent - rented_percent)
+    
+        progress_bar = "🟢" * available_percent + "🔴" * rented_percent + "⚫" * disabled_percent
+        status_text += f"{progress_bar}\n\n"
+    
+    status_text += f"• <b>Всего аккаунтов:</b> {total_accounts}\n"
+    status_text += f"• <b>Доступно:</b> {available_accounts} ({int(available_accounts/total_accounts*100) if total_accounts else 0}%)\n"
+    status_text += f"• <b>В аренде:</b> {rented_accounts} ({int(rented_accounts/total_accounts*100) if total_accounts else 0}%)\n"
+    status_text += f"• <b>Отключено:</b> {disabled_accounts} ({int(disabled_accounts/total_accounts*100) if total_accounts else 0}%)\n\n"
+    
+    # Секция типов аккаунтов
+    if total_accounts > 0:
+        status_text += "<b>📋 ПО ТИПАМ</b>\n\n"
+    
         # Группируем аккаунты по типам
         accounts_by_type = {}
         for acc in rental_manager.accounts.values():
             if acc.type not in accounts_by_type:
-                accounts_by_type[acc.type] = []
-            accounts_by_type[acc.type].append(acc)
-        
-        # Формируем список аккаунтов по типам
-        for acc_type, accs in accounts_by_type.items():
-            accounts_text += f"🔹 {acc_type.upper()} ({len(accs)} шт.):\n"
-            for acc in accs:
-                status = "✅ Доступен" if acc.status == "available" else "❌ В аренде"
-                accounts_text += f"  • {acc.login} - {status} \n"
-            accounts_text += "\n"
-        
-        # Форматируем сообщение
-        message_text = f"{header}{status_line}\n\nВыберите действие из меню ниже:"
-        
-        # Добавляем список аккаунтов, если есть аккаунты
-        if rental_manager.accounts:
-            message_text += accounts_text
-        
-        # Добавляем кнопки для действий внизу сообщения
-        markup.row(
-            InlineKeyboardButton("Обновить 🆙", callback_data="srent_menu"),
-            InlineKeyboardButton("Добавить аккаунт ✅", callback_data="srent_add")
-        )
-        
+                accounts_by_type[acc.type] = {"total": 0, "available": 0, "rented": 0}
+    
+            accounts_by_type[acc.type]["total"] += 1
+            if acc.status == "available":
+                accounts_by_type[acc.type]["available"] += 1
+            elif acc.status == "rented":
+                accounts_by_type[acc.type]["rented"] += 1
+    
+        # Выводим статистику по каждому типу
+        for acc_type, stats in accounts_by_type.items():
+            status_text += f"• <b>{acc_type.upper()}</b>: {stats['total']} шт. "
+            status_text += f"(🟢 {stats['available']} | 🔴 {stats['rented']})\n"
+    
+        status_text += "\n"
+        
+        # Прогноз по типам, для которых уже есть статистика заказов
+        forecasts = [(acc_type, demand.forecast(acc_type)) for acc_type in accounts_by_type
+                     if normalize_account_type(acc_type) in demand.stats]
+        if forecasts:
+            status_text += "<b>📈 ПРОГНОЗ</b>\n\n"
+            for acc_type, forecast in forecasts:
+                warning = "⚠️ " if forecast["exhaustion_hours"] is not None and forecast["exhaustion_hours"] <= FORECAST_ALERT_HOURS else ""
+                status_text += (f"{warning}<b>{acc_type.upper()}</b>: {forecast['rate']:.1f} заказов/ч, "
+                                f"средний срок {forecast['avg_duration']:.1f} ч., возвратов за час {forecast['returns_hour']}\n"
+                                f"  Закончатся через: <b>{format_forecast_hours(forecast['exhaustion_hours'])}</b>\n")
+            status_text += "\n"
+    
+    status_text += f"{'='*30}\n\n"
+    
+    # Секция аренд
+    status_text += "⏰ <b>АРЕНДЫ</b>\n\n"
+    status_text += f"• <b>Активных аренд:</b> {active_rentals}\n"
+    status_text += f"• <b>Всего выдано:</b> {total_rentals}\n"
+    status_text += f"• <b>Завершено:</b> {total_rentals - active_rentals}\n\n"
+    
+    # Добавляем информацию о ближайших истечениях срока аренды, если есть активные аренды
+    if active_rentals > 0:
+        status_text += "<b>🔄 БЛИЖАЙШИЕ ИСТЕЧЕНИЯ</b>\n\n"
+    
+        # Сортируем аренды по оставшемуся времени
+        active_rental_objects = [r for r in rental_manager.rentals.values() if r.is_active]
+        active_rental_objects.sort(key=lambda r: r.end_time)
+    
+        # Показываем до 3 ближайших истечений
+        for i, rental in enumerate(active_rental_objects[:3]):
+            account_login = rental.account_login if hasattr(rental, 'account_login') else "Неизвестно"
+            remaining_time = rental.get_remaining_time()
+            hours, remainder = divmod(remaining_time.seconds, 3600)
+            minutes, _ = divmod(remainder, 60)
+    
+            time_warning = "⚠️ " if hours == 0 and minutes < 30 else ""
+    
+            status_text += f"{time_warning}<b>{rental.username}</b>: {account_login}\n"
+            status_text += f"⏱ Осталось: <b>{hours} ч. {minutes} мин.</b>\n\n"
+    
+    status_text += f"{'='*30}\n\n"
+    
+    # Секция привязок
+    status_text += "🔗 <b>ПРИВЯЗКИ</b>\n\n"
+    status_text += f"• <b>Всего привязок:</b> {len(lot_bindings)}\n\n"
+    
+    if len(lot_bindings) > 0:
+        # Группируем привязки по типам
+        bindings_by_type = {}
+        for binding in lot_bindings.values():
+            bind_type = binding.get("account_type", "unknown")
+            if bind_type not in bindings_by_type:
+                bindings_by_type[bind_type] = 0
+            bindings_by_type[bind_type] += 1
+    
+        # Выводим количество привязок по типам
+        for bind_type, count in bindings_by_type.items():
+            # Определяем наличие свободных аккаунтов для этого типа
+            avail_accounts = sum(1 for acc in rental_manager.accounts.values() 
+                             if acc.type == bind_type and acc.status == "available")
+            status_emoji = "🟢" if avail_accounts > 0 else "🔴"
+    
+            status_text += f"• {status_emoji} <b>{bind_type.upper()}</b>: {count} привязок\n"
+    
+    status_text += f"{'='*30}\n"
+    
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("⬅️ НАЗАД", callback_data="srent_menu"))
+    markup.row(InlineKeyboardButton("🔄 ОБНОВИТЬ", callback_data="srent_status"))
+    
+    # Опциональные кнопки управления
+    if RUNNING:
+        markup.row(InlineKeyboardButton("⛔ ОСТАНОВИТЬ", callback_data="srent_stop"))
+    else:
+        markup.row(InlineKeyboardButton("▶️ ЗАПУСТИТЬ", callback_data="srent_start"))
+    
+    return status_text, markup
+
+def show_status_callback(call):
+    """Показывает текущий статус системы аренды"""
+    try:
+        edit_cached_view(call, "status", build_status_view, "Статистика обновлена", ticking=True)
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка отображения статистики: {e}")
+        try:
+            CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
+        except:
+            pass
+
+def format_metrics_summary():
+    """Формирует краткую сводку метрик для Telegram"""
+    def fmt_seconds(value):
+        if value == float("inf"):
+            return "&gt;60 с"
+        return f"{value * 1000:.0f} мс" if value < 1 else f"{value:.1f} с"
+
+    text = "📈 <b>МЕТРИКИ</b>\n\n"
+    text += f"{'='*30}\n\n"
+
+    # Заказы
+    orders_total = metrics.get_counter("steamrent_orders_total")
+    delivered, delivery_avg, delivery_p95 = metrics.histogram_stats("steamrent_order_delivery_seconds")
+    text += "🛒 <b>ЗАКАЗЫ</b>\n"
+    text += f"• Получено: <b>{orders_total}</b> | Выдано: <b>{delivered}</b>\n"
+    if delivered:
+        text += f"• Время выдачи: среднее {fmt_seconds(delivery_avg)}, p95 ≤ {fmt_seconds(delivery_p95)}\n"
+    hits = metrics.get_counter("steamrent_binding_lookups_total", result="hit")
+    misses = metrics.get_counter("steamrent_binding_lookups_total", result="miss")
+    text += f"• Привязки: 🟢 {hits} найдено | 🔴 {misses} без привязки\n\n"
+
+    # Исчерпание пулов
+    exhausted = metrics.counters_by_label("steamrent_pool_exhausted_total", "type")
+    if exhausted:
+        text += "📉 <b>НЕТ АККАУНТОВ</b>\n"
+        for acc_type, count in sorted(exhausted.items(), key=lambda item: -item[1]):
+            text += f"• {acc_type}: {count}\n"
+        text += "\n"
+
+    # Истечения
+    expired, lag_avg, lag_p95 = metrics.histogram_stats("steamrent_expiry_lag_seconds")
+    text += "⏰ <b>ИСТЕЧЕНИЯ</b>\n"
+    text += f"• Завершено: <b>{expired}</b>\n"
+    if expired:
+        text += f"• Задержка: средняя {lag_avg:.0f} с, p95 ≤ {lag_p95:.0f} с\n"
+    text += "\n"
+
+    # Steam
+    endpoints = metrics.histogram_labels("steamrent_steam_request_seconds", "endpoint")
+    if endpoints:
+        text += "🎮 <b>STEAM</b>\n"
+        for endpoint in endpoints:
+            calls, avg, p95 = metrics.histogram_stats("steamrent_steam_request_seconds", endpoint=endpoint)
+            errors = metrics.get_counter("steamrent_steam_requests_total", endpoint=endpoint, outcome="error")
+            error_rate = errors / calls * 100 if calls else 0
+            text += f"• {endpoint}: {calls} выз., ошибок {error_rate:.0f}%, среднее {fmt_seconds(avg)}\n"
+        text += "\n"
+
+    # Сохранение
+    files = metrics.histogram_labels("steamrent_persist_seconds", "file")
+    if files:
+        text += "💾 <b>СОХРАНЕНИЕ</b>\n"
+        for file_name in files:
+            writes, avg, _ = metrics.histogram_stats("steamrent_persist_seconds", file=file_name)
+            size = metrics.get_gauge("steamrent_persist_bytes", file=file_name)
+            text += f"• {file_name}: {writes} зап., среднее {fmt_seconds(avg)}, {size / 1024:.1f} КБ\n"
+        text += "\n"
+
+    # Кнопки: самые медленные маршруты
+    routes = metrics.histogram_labels("steamrent_callback_seconds", "route")
+    if routes:
+        stats = [(route,) + metrics.histogram_stats("steamrent_callback_seconds", route=route) for route in routes]
+        text += "🔘 <b>КНОПКИ</b>\n"
+        for route, calls, avg, p95 in sorted(stats, key=lambda item: -item[2])[:5]:
+            text += f"• {route}: {calls} наж., среднее {fmt_seconds(avg)}, p95 ≤ {fmt_seconds(p95)}\n"
+        text += "\n"
+
+    if STARTUP_TIMINGS:
+        phases = ", ".join(f"{phase} {fmt_seconds(seconds)}" for phase, seconds in STARTUP_TIMINGS.items())
+        text += f"🚀 <b>Запуск:</b> {phases}\n\n"
+
+    queue_depth = metrics.get_gauge("steamrent_notification_queue_depth")
+    text += f"📬 <b>Очередь уведомлений:</b> {queue_depth}"
+    delayed = sum(metrics.counters_by_label("steamrent_telegram_delayed_total", "reason").values())
+    dropped = sum(metrics.counters_by_label("steamrent_telegram_dropped_total", "reason").values())
+    merged = metrics.get_counter("steamrent_telegram_merged_total")
+    if delayed or dropped or merged:
+        text += f" (отложено {delayed:.0f}, потеряно {dropped:.0f}, объединено {merged:.0f})"
+    text += "\n\n"
+    text += f"{'='*30}\n"
+    text += f"Экспорт Prometheus: <code>{METRICS_FILE}</code>"
+    return text
+
+def show_metrics_callback(call):
+    """Показывает сводку метрик"""
+    try:
+        metrics.dump()
+
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("⬅️ НАЗАД", callback_data="srent_menu"))
+        markup.row(InlineKeyboardButton("🔄 ОБНОВИТЬ", callback_data="srent_metrics"))
+
         try:
             CARDINAL.telegram.bot.edit_message_text(
-                message_text,
+                format_metrics_summary(),
                 call.message.chat.id,
                 call.message.message_id,
                 reply_markup=markup,
                 parse_mode="HTML"
             )
-            CARDINAL.telegram.bot.answer_callback_query(call.id, "Меню обновлено")
+            CARDINAL.telegram.bot.answer_callback_query(call.id, "Метрики обновлены")
         except Exception as edit_error:
-            # Если сообщение не изменилось, просто уведомляем пользователя
             if "message is not modified" in str(edit_error):
-                CARDINAL.telegram.bot.answer_callback_query(call.id, "Меню актуально")
+                CARDINAL.telegram.bot.answer_callback_query(call.id, "Метрики актуальны")
             else:
-                # Если другая ошибка - перебрасываем исключение
                 raise edit_error
     except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка обновления меню: {e}")
+        logger.error(f"{LOGGER_PREFIX} Ошибка отображения метрик: {e}")
         try:
             CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
         except:
             pass
 
-def start_rental_callback(call):
-    """Обработчик кнопки запуска системы"""
-    global RUNNING
+def metrics_cmd(message):
+    """Отправляет сводку метрик и выгружает их в файл"""
     try:
-        if RUNNING:
-            CARDINAL.telegram.bot.answer_callback_query(call.id, "Система уже запущена!")
+        metrics.dump()
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            format_metrics_summary(),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике metrics_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+def digest_cmd(message):
+    """Включает/выключает сводку событий для администратора и задает ее окно"""
+    global DIGEST_MODE, DIGEST_WINDOW
+    
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может управлять сводкой.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        parts = message.text.split()
+        arg = parts[1].lower() if len(parts) > 1 else ""
+        
+        if arg == "on":
+            DIGEST_MODE = True
+            save_config()
+        elif arg == "off":
+            DIGEST_MODE = False
+            save_config()
+            # Накопленное не теряем
+            admin_digest.flush(force=True)
+        elif arg == "now":
+            if not admin_digest.flush(force=True):
+                CARDINAL.telegram.bot.send_message(message.chat.id, "📭 С прошлой сводки событий не было")
             return
-            
-        RUNNING = True
-        logger.info(f"{LOGGER_PREFIX} Система аренды запущена через кнопку меню")
+        elif arg:
+            try:
+                window = int(arg)
+                if window < 1:
+                    raise ValueError
+            except ValueError:
+                CARDINAL.telegram.bot.send_message(
+                    message.chat.id,
+                    "❌ Окно сводки должно быть целым числом минут.\n\n"
+                    "Использование: <code>/srent_digest on|off|now|МИНУТЫ</code>",
+                    parse_mode="HTML"
+                )
+                return
+            DIGEST_WINDOW = window
+            DIGEST_MODE = True
+            save_config()
         
-        # Обновляем сообщение меню
-        markup = InlineKeyboardMarkup()
-        markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "📊 <b>Сводка для администратора</b>\n\n"
+            f"Статус: {'✅ включена' if DIGEST_MODE else '❌ выключена (каждое событие отдельным сообщением)'}\n"
+            f"Окно: <b>{DIGEST_WINDOW} мин.</b>\n\n"
+            "Выдачи, завершения аренд и предупреждения о нехватке аккаунтов собираются в одно сообщение. "
+            "Невыполненные заказы и недоставленные данные отправляются сразу.\n\n"
+            "• <code>/srent_digest on|off</code> - включить/выключить\n"
+            "• <code>/srent_digest 30</code> - окно в минутах\n"
+            "• <code>/srent_digest now</code> - отправить сводку сейчас",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике digest_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+def debug_cmd(message):
+    """Включает/выключает подробное логирование для заказа или аккаунта"""
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может управлять режимом отладки.",
+            parse_mode="HTML"
+        )
+        return
+    
+    try:
+        params = message.text.strip().split(maxsplit=2)[1:]
+        
+        if params and params[0].lower() == "off":
+            DEBUG_TARGETS["order"].clear()
+            DEBUG_TARGETS["account"].clear()
+            CARDINAL.telegram.bot.send_message(message.chat.id, "✅ Режим отладки выключен для всех заказов и аккаунтов.")
+            return
+        
+        if len(params) == 2 and params[0].lower() in ("order", "account"):
+            target_kind = params[0].lower()
+            target = params[1].strip()
+            targets = DEBUG_TARGETS[target_kind]
+            if target in targets:
+                targets.discard(target)
+                state = "выключена"
+            else:
+                targets.add(target)
+                state = "включена"
+            logger.info(f"{LOGGER_PREFIX} Отладка {state}: {target_kind} {target}")
+            CARDINAL.telegram.bot.send_message(
+                message.chat.id,
+                f"🐞 Отладка {state}: <code>{target_kind} {target}</code>",
+                parse_mode="HTML"
+            )
+            return
         
-        CARDINAL.telegram.bot.edit_message_text(
-            "✅ <b>Система аренды успешно запущена!</b>\n\n"
-            "Теперь бот будет автоматически выдавать аккаунты при покупке соответствующих лотов.",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup,
+        orders = ", ".join(sorted(DEBUG_TARGETS["order"])) or "—"
+        accounts = ", ".join(sorted(DEBUG_TARGETS["account"])) or "—"
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "🐞 <b>Режим отладки</b>\n\n"
+            f"Заказы: <code>{orders}</code>\n"
+            f"Аккаунты: <code>{accounts}</code>\n\n"
+            "Переключить: <code>/srent_debug order ID</code> или <code>/srent_debug account ЛОГИН</code>\n"
+            "Выключить всё: <code>/srent_debug off</code>",
             parse_mode="HTML"
         )
-        CARDINAL.telegram.bot.answer_callback_query(call.id, "Система запущена!")
     except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка запуска системы аренды: {e}")
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике debug_cmd: {e}")
         try:
-            CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
         except:
             pass
 
-def stop_rental_callback(call):
-    """Обработчик кнопки остановки системы"""
-    global RUNNING
+def trace_cmd(message):
+    """Управляет трассировкой и выборочным профилированием"""
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может управлять трассировкой.",
+            parse_mode="HTML"
+        )
+        return
+    
     try:
-        if not RUNNING:
-            CARDINAL.telegram.bot.answer_callback_query(call.id, "Система уже остановлена!")
-            return
-            
-        RUNNING = False
-        logger.info(f"{LOGGER_PREFIX} Система аренды остановлена через кнопку меню")
-        
-        # Обновляем сообщение меню
-        markup = InlineKeyboardMarkup()
-        markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
+        params = [part.lower() for part in message.text.strip().split()[1:]]
+        
+        if params and params[0] in ("on", "off"):
+            tracer.enabled = params[0] == "on"
+            if not tracer.enabled:
+                tracer.profile_rate = 0.0
+        elif len(params) == 2 and params[0] == "profile":
+            if params[1] == "off":
+                tracer.profile_rate = 0.0
+            else:
+                try:
+                    rate = float(params[1].rstrip("%"))
+                    if params[1].endswith("%") or rate > 1:
+                        rate /= 100
+                    if not 0 < rate <= 1:
+                        raise ValueError
+                except ValueError:
+                    CARDINAL.telegram.bot.send_message(
+                        message.chat.id,
+                        "❌ Доля профилирования должна быть числом от 0 до 1 (или процентом).",
+                        parse_mode="HTML"
+                    )
+                    return
+                tracer.profile_rate = rate
+                tracer.enabled = True
         
-        CARDINAL.telegram.bot.edit_message_text(
-            "🛑 <b>Система аренды остановлена!</b>\n\n"
-            "Автоматическая выдача аккаунтов при покупке лотов отключена.\n"
-            "Активные аренды продолжат работать до завершения.",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup,
+        profile_state = f"{tracer.profile_rate * 100:.0f}% трасс" if tracer.profile_rate else "выключено"
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "🔬 <b>Трассировка</b>\n\n"
+            f"Статус: {'✅ включена' if tracer.enabled else '❌ выключена'}\n"
+            f"cProfile: {profile_state}\n"
+            f"В буфере: {len(tracer.traces)} из {tracer.traces.maxlen}\n\n"
+            "• <code>/srent_trace on|off</code> - включить/выключить\n"
+            "• <code>/srent_trace profile 0.1|off</code> - профилировать долю трасс\n"
+            "• <code>/srent_traces 5</code> - самые медленные трассы",
             parse_mode="HTML"
         )
-        CARDINAL.telegram.bot.answer_callback_query(call.id, "Система остановлена!")
     except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка остановки системы аренды: {e}")
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике trace_cmd: {e}")
         try:
-            CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
         except:
             pass
 
-def show_status_callback(call):
-    """Показывает текущий статус системы аренды"""
+def slowest_traces_cmd(message):
+    """Выводит самые медленные трассы из буфера"""
+    if admin_id and message.chat.id != admin_id:
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            "❌ <b>Доступ запрещен</b>\n\n"
+            "Только администратор может просматривать трассы.",
+            parse_mode="HTML"
+        )
+        return
+    
     try:
-        # Считаем статистику
-        total_accounts = len(rental_manager.accounts)
-        available_accounts = sum(1 for acc in rental_manager.accounts.values() if acc.status == 'available')
-        rented_accounts = sum(1 for acc in rental_manager.accounts.values() if acc.status == 'rented')
-        disabled_accounts = sum(1 for acc in rental_manager.accounts.values() if acc.status == 'disabled')
-        
-        active_rentals = sum(1 for rent in rental_manager.rentals.values() if rent.is_active)
-        total_rentals = len(rental_manager.rentals)
-        
-        # Общая информация о состоянии
-        status_emoji = "🟢" if RUNNING else "🔴"
-        
-        # Создаем сообщение статистики
-        status_text = "📊 <b>СТАТИСТИКА СИСТЕМЫ</b> 📊\n\n"
-        status_text += f"{'='*30}\n\n"
-        
-        # Общий статус
-        status_text += f"<b>СТАТУС СИСТЕМЫ:</b> {status_emoji} <b>{'АКТИВНА' if RUNNING else 'ОСТАНОВЛЕНА'}</b>\n\n"
-        status_text += f"{'='*30}\n\n"
-        
-        # Секция аккаунтов
-        status_text += "🖥️ <b>АККАУНТЫ</b>\n\n"
-        
-        # Добавляем график в виде прогресс-бара для наглядности
-        if total_accounts > 0:
-            available_percent = int((available_accounts / total_accounts) * 10)
-            rented_percent = int((rented_accounts / total_accounts) * 10)
-            disabled_percent = max(0, 10 - available_percent - rented_percent)
-            
-            progress_bar = "🟢" * available_percent + "🔴" * rented_percent + "⚫" * disabled_percent
-            status_text += f"{progress_bar}\n\n"
+        params = message.text.strip().split()[1:]
+        count = 5
+        if params:
+            try:
+                count = max(1, min(20, int(params[0])))
+            except ValueError:
+                pass
         
-        status_text += f"• <b>Всего аккаунтов:</b> {total_accounts}\n"
-        status_text += f"• <b>Доступно:</b> {available_accounts} ({int(available_accounts/total_accounts*100) if total_accounts else 0}%)\n"
-        status_text += f"• <b>В аренде:</b> {rented_accounts} ({int(rented_accounts/total_accounts*100) if total_accounts else 0}%)\n"
-        status_text += f"• <b>Отключено:</b> {disabled_accounts} ({int(disabled_accounts/total_accounts*100) if total_accounts else 0}%)\n\n"
+        traces = tracer.slowest(count)
+        if not traces:
+            CARDINAL.telegram.bot.send_message(
+                message.chat.id,
+                "ℹ️ Трасс пока нет."
+                + ("" if tracer.enabled else "\nВключите трассировку: <code>/srent_trace on</code>"),
+                parse_mode="HTML"
+            )
+            return
         
-        # Секция типов аккаунтов
-        if total_accounts > 0:
-            status_text += "<b>📋 ПО ТИПАМ</b>\n\n"
-            
-            # Группируем аккаунты по типам
-            accounts_by_type = {}
-            for acc in rental_manager.accounts.values():
-                if acc.type not in accounts_by_type:
-                    accounts_by_type[acc.type] = {"total": 0, "available": 0, "rented": 0}
-                
-                accounts_by_type[acc.type]["total"] += 1
-                if acc.status == "available":
-                    accounts_by_type[acc.type]["available"] += 1
-                elif acc.status == "rented":
-                    accounts_by_type[acc.type]["rented"] += 1
-            
-            # Выводим статистику по каждому типу
-            for acc_type, stats in accounts_by_type.items():
-                status_text += f"• <b>{acc_type.upper()}</b>: {stats['total']} шт. "
-                status_text += f"(🟢 {stats['available']} | 🔴 {stats['rented']})\n"
-            
-            status_text += "\n"
+        traces_text = f"🐢 <b>Самые медленные трассы ({len(traces)})</b>\n\n"
+        for record in traces:
+            started = datetime.fromtimestamp(record["started"]).strftime("%d.%m %H:%M:%S")
+            traces_text += f"<b>{record['kind']}</b> <code>{html.escape(record['key'])}</code> — {record['duration'] * 1000:.0f} мс ({started})\n"
+            for name, offset, duration in record["spans"]:
+                traces_text += f"  • {name}: {duration * 1000:.0f} мс (+{offset * 1000:.0f})\n"
+            if record["error"]:
+                traces_text += f"  ❗ {html.escape(record['error'][:100])}\n"
+            traces_text += "\n"
+        
+        CARDINAL.telegram.bot.send_message(message.chat.id, truncate_lines(traces_text), parse_mode="HTML")
+        
+        # Профили отправляем отдельными сообщениями
+        for record in traces:
+            if record["profile"]:
+                # Экранируем после обрезки, чтобы не разрезать сущность вроде &amp;
+                profile_text = html.escape(record["profile"][:3500], quote=False)
+                CARDINAL.telegram.bot.send_message(
+                    message.chat.id,
+                    f"📄 <b>cProfile: {record['kind']} {html.escape(record['key'])}</b>\n<pre>{profile_text}</pre>",
+                    parse_mode="HTML"
+                )
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике slowest_traces_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+def build_accounts_view():
+    """Строит текст и клавиатуру списка аккаунтов"""
+    if not rental_manager.accounts:
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("⬅️ НАЗАД", callback_data="srent_menu"))
+        markup.row(InlineKeyboardButton("➕ ДОБАВИТЬ АККАУНТ", callback_data="srent_add"))
         
-        status_text += f"{'='*30}\n\n"
+        return (
+            "🖥️ <b>АККАУНТЫ STEAM</b>\n\n"
+            f"{'='*30}\n\n"
+            "⚠️ В системе еще нет добавленных аккаунтов.\n\n"
+            "Используйте кнопку ниже, чтобы добавить аккаунт.\n\n"
+            f"{'='*30}",
+            markup
+        )
+    
+    # Группируем аккаунты по типам
+    accounts_by_type = {}
+    for login, account in rental_manager.accounts.items():
+        acc_type = account.type
+        if acc_type not in accounts_by_type:
+            accounts_by_type[acc_type] = []
+        accounts_by_type[acc_type].append(account)
+    
+    # Формируем список аккаунтов по группам
+    accounts_text = "🖥️ <b>АККАУНТЫ STEAM</b> 🖥️\n\n"
+    accounts_text += f"{'='*30}\n\n"
+    
+    total = len(rental_manager.accounts)
+    available = sum(1 for acc in rental_manager.accounts.values() if acc.status == "available")
+    rented = sum(1 for acc in rental_manager.accounts.values() if acc.status == "rented")
+    
+    # Добавляем статистику
+    accounts_text += "<b>📊 СТАТИСТИКА</b>\n\n"
+    accounts_text += f"🔸 Всего: <b>{total}</b>\n"
+    accounts_text += f"🔸 Доступно: <b>{available}</b> 🟢\n"
+    accounts_text += f"🔸 В аренде: <b>{rented}</b> 🔴\n\n"
+    accounts_text += f"{'='*30}\n\n"
+    
+    # Добавляем разделы по типам аккаунтов
+    for acc_type, accounts in accounts_by_type.items():
+        accounts_text += f"<b>📁 ТИП: {acc_type.upper()}</b>\n\n"
         
-        # Секция аренд
-        status_text += "⏰ <b>АРЕНДЫ</b>\n\n"
-        status_text += f"• <b>Активных аренд:</b> {active_rentals}\n"
-        status_text += f"• <b>Всего выдано:</b> {total_rentals}\n"
-        status_text += f"• <b>Завершено:</b> {total_rentals - active_rentals}\n\n"
+        available_in_type = sum(1 for acc in accounts if acc.status == "available")
+        rented_in_type = sum(1 for acc in accounts if acc.status == "rented")
         
-        # Добавляем информацию о ближайших истечениях срока аренды, если есть активные аренды
-        if active_rentals > 0:
-            status_text += "<b>🔄 БЛИЖАЙШИЕ ИСТЕЧЕНИЯ</b>\n\n"
-            
-            # Сортируем аренды по оставшемуся времени
-            active_rental_objects = [r for r in rental_manager.rentals.values() if r.is_active]
-            active_rental_objects.sort(key=lambda r: r.end_time)
+        accounts_text += f"<b>Всего:</b> {len(accounts)} | <b>Доступно:</b> {available_in_type} | <b>В аренде:</b> {rented_in_type}\n\n"
+        
+        for account in accounts:
+            status_emoji = "🟢" if account.status == "available" else "🔴" if account.status == "rented" else "🟡" if account.status == "quarantined" else "⚫"
+            accounts_text += f"{status_emoji} <b>{account.login}</b>\n"
             
-            # Показываем до 3 ближайших истечений
-            for i, rental in enumerate(active_rental_objects[:3]):
-                account_login = rental.account_login if hasattr(rental, 'account_login') else "Неизвестно"
+            # Если аккаунт в аренде, показываем информацию об аренде
+            if account.status == "rented" and account.rental_id in rental_manager.rentals:
+                rental = rental_manager.rentals[account.rental_id]
                 remaining_time = rental.get_remaining_time()
                 hours, remainder = divmod(remaining_time.seconds, 3600)
                 minutes, _ = divmod(remainder, 60)
-                
-                time_warning = "⚠️ " if hours == 0 and minutes < 30 else ""
-                
-                status_text += f"{time_warning}<b>{rental.username}</b>: {account_login}\n"
-                status_text += f"⏱ Осталось: <b>{hours} ч. {minutes} мин.</b>\n\n"
-        
-        status_text += f"{'='*30}\n\n"
-        
-        # Секция привязок
-        status_text += "🔗 <b>ПРИВЯЗКИ</b>\n\n"
-        status_text += f"• <b>Всего привязок:</b> {len(lot_bindings)}\n\n"
-        
-        if len(lot_bindings) > 0:
-            # Группируем привязки по типам
-            bindings_by_type = {}
-            for binding in lot_bindings.values():
-                bind_type = binding.get("account_type", "unknown")
-                if bind_type not in bindings_by_type:
-                    bindings_by_type[bind_type] = 0
-                bindings_by_type[bind_type] += 1
-            
-            # Выводим количество привязок по типам
-            for bind_type, count in bindings_by_type.items():
-                # Определяем наличие свободных аккаунтов для этого типа
-                avail_accounts = sum(1 for acc in rental_manager.accounts.values() 
-                                 if acc.type == bind_type and acc.status == "available")
-                status_emoji = "🟢" if avail_accounts > 0 else "🔴"
-                
-                status_text += f"• {status_emoji} <b>{bind_type.upper()}</b>: {count} привязок\n"
-        
-        status_text += f"{'='*30}\n"
-        
-        markup = InlineKeyboardMarkup()
-        markup.row(InlineKeyboardButton("⬅️ НАЗАД", callback_data="srent_menu"))
-        markup.row(InlineKeyboardButton("🔄 ОБНОВИТЬ", callback_data="srent_status"))
-        
-        # Опциональные кнопки управления
-        if RUNNING:
-            markup.row(InlineKeyboardButton("⛔ ОСТАНОВИТЬ", callback_data="srent_stop"))
-        else:
-            markup.row(InlineKeyboardButton("▶️ ЗАПУСТИТЬ", callback_data="srent_start"))
+                accounts_text += f"  👤 <b>{rental.username}</b>\n"
+                accounts_text += f"  ⏱ Осталось: <b>{hours} ч. {minutes} мин.</b>\n"
+                accounts_text += f"  🔄 <code>/srent_force {account.login}</code>\n"
         
-        try:
-            CARDINAL.telegram.bot.edit_message_text(
-                status_text,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup,
-                parse_mode="HTML"
-            )
-            CARDINAL.telegram.bot.answer_callback_query(call.id, "Статистика обновлена")
-        except Exception as edit_error:
-            # Если сообщение не изменилось, просто отвечаем callback_query
-            if "message is not modified" in str(edit_error):
-                CARDINAL.telegram.bot.answer_callback_query(call.id, "Статистика актуальна")
-            else:
-                # Если другая ошибка - перебрасываем исключение
-                raise edit_error
-    except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка отображения статистики: {e}")
-        try:
-            CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
-        except:
-            pass
+        accounts_text += f"\n{'-'*20}\n\n"
+    
+    # Если текст слишком длинный, обрезаем его
+    if len(accounts_text) > 3500:
+        accounts_text = accounts_text[:3500] + "...\n\n⚠️ Список слишком длинный, показаны не все аккаунты"
+    
+    accounts_text += f"{'='*30}\n\n"
+    accounts_text += "<b>КОМАНДЫ:</b>\n"
+    accounts_text += "• <code>/srent_del ЛОГИН</code> - удалить аккаунт\n"
+    accounts_text += "• <code>/srent_force ЛОГИН [ЛОГИН2 ...]</code> - принудительный возврат\n"
+    accounts_text += "• <code>/srent_bulk</code> - групповые операции"
+    
+    markup = InlineKeyboardMarkup(row_width=2)
+    markup.row(InlineKeyboardButton("⬅️ НАЗАД", callback_data="srent_menu"))
+    markup.row(
+        InlineKeyboardButton("➕ ДОБАВИТЬ", callback_data="srent_add"),
+        InlineKeyboardButton("🔄 ВОЗВРАТ", callback_data="srent_return")
+    )
+    
+    return accounts_text, markup
 
 def show_accounts_callback(call):
     """Показывает список аккаунтов"""
     try:
-        if not rental_manager.accounts:
-            markup = InlineKeyboardMarkup()
-            markup.row(InlineKeyboardButton("⬅️ НАЗАД", callback_data="srent_menu"))
-            markup.row(InlineKeyboardButton("➕ ДОБАВИТЬ АККАУНТ", callback_data="srent_add"))
-            
-            CARDINAL.telegram.bot.edit_message_text(
-                "🖥️ <b>АККАУНТЫ STEAM</b>\n\n"
-                f"{'='*30}\n\n"
-                "⚠️ В системе еще нет добавленных аккаунтов.\n\n"
-                "Используйте кнопку ниже, чтобы добавить аккаунт.\n\n"
-                f"{'='*30}",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup,
-                parse_mode="HTML"
-            )
-            CARDINAL.telegram.bot.answer_callback_query(call.id, "Список аккаунтов пуст")
-            return
-        
-        # Группируем аккаунты по типам
-        accounts_by_type = {}
-        for login, account in rental_manager.accounts.items():
-            acc_type = account.type
-            if acc_type not in accounts_by_type:
-                accounts_by_type[acc_type] = []
-            accounts_by_type[acc_type].append(account)
-        
-        # Формируем список аккаунтов по группам
-        accounts_text = "🖥️ <b>АККАУНТЫ STEAM</b> 🖥️\n\n"
-        accounts_text += f"{'='*30}\n\n"
-        
-        total = len(rental_manager.accounts)
-        available = sum(1 for acc in rental_manager.accounts.values() if acc.status == "available")
-        rented = sum(1 for acc in rental_manager.accounts.values() if acc.status == "rented")
-        
-        # Добавляем статистику
-        accounts_text += "<b>📊 СТАТИСТИКА</b>\n\n"
-        accounts_text += f"🔸 Всего: <b>{total}</b>\n"
-        accounts_text += f"🔸 Доступно: <b>{available}</b> 🟢\n"
-        accounts_text += f"🔸 В аренде: <b>{rented}</b> 🔴\n\n"
-        accounts_text += f"{'='*30}\n\n"
-        
-        # Добавляем разделы по типам аккаунтов
-        for acc_type, accounts in accounts_by_type.items():
-            accounts_text += f"<b>📁 ТИП: {acc_type.upper()}</b>\n\n"
-            
-            available_in_type = sum(1 for acc in accounts if acc.status == "available")
-            rented_in_type = sum(1 for acc in accounts if acc.status == "rented")
-            
-            accounts_text += f"<b>Всего:</b> {len(accounts)} | <b>Доступно:</b> {available_in_type} | <b>В аренде:</b> {rented_in_type}\n\n"
-            
-            for account in accounts:
-                status_emoji = "🟢" if account.status == "available" else "🔴" if account.status == "rented" else "⚫"
-                accounts_text += f"{status_emoji} <b>{account.login}</b>\n"
-                
-                # Если аккаунт в аренде, показываем информацию об аренде
-                if account.status == "rented" and account.rental_id in rental_manager.rentals:
-                    rental = rental_manager.rentals[account.rental_id]
-                    remaining_time = rental.get_remaining_time()
-                    hours, remainder = divmod(remaining_time.seconds, 3600)
-                    minutes, _ = divmod(remainder, 60)
-                    accounts_text += f"  👤 <b>{rental.username}</b>\n"
-                    accounts_text += f"  ⏱ Осталось: <b>{hours} ч. {minutes} мин.</b>\n"
-                    accounts_text += f"  🔄 <code>/srent_force {account.login}</code>\n"
-            
-            accounts_text += f"\n{'-'*20}\n\n"
-        
-        # Если текст слишком длинный, обрезаем его
-        if len(accounts_text) > 3500:
-            accounts_text = accounts_text[:3500] + "...\n\n⚠️ Список слишком длинный, показаны не все аккаунты"
-        
-        accounts_text += f"{'='*30}\n\n"
-        accounts_text += "<b>КОМАНДЫ:</b>\n"
-        accounts_text += "• <code>/srent_del ЛОГИН</code> - удалить аккаунт\n"
-        accounts_text += "• <code>/srent_force ЛОГИН</code> - принудительный возврат"
-        
-        markup = InlineKeyboardMarkup(row_width=2)
-        markup.row(InlineKeyboardButton("⬅️ НАЗАД", callback_data="srent_menu"))
-        markup.row(
-            InlineKeyboardButton("➕ ДОБАВИТЬ", callback_data="srent_add"),
-            InlineKeyboardButton("🔄 ВОЗВРАТ", callback_data="srent_return")
-        )
-        
-        CARDINAL.telegram.bot.edit_message_text(
-            accounts_text,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup,
-            parse_mode="HTML"
-        )
-        CARDINAL.telegram.bot.answer_callback_query(call.id, "Список аккаунтов")
+        answer = "Список аккаунтов" if rental_manager.accounts else "Список аккаунтов пуст"
+        edit_cached_view(call, "accounts", build_accounts_view, answer, ticking=True)
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Ошибка отображения списка аккаунтов: {e}")
         try:
@@ -2563,8 +6214,8 @@ def show_accounts_callback(call):
 def show_rentals_callback(call):
     """Показывает список активных аренд"""
     try:
-        # Фильтруем только активные аренды
-        active_rentals = [rental for rental in rental_manager.rentals.values() if rental.is_active]
+        # Активные аренды из индекса, ближайшие к завершению в начале
+        active_rentals = rental_manager.search_active_rentals()
         
         if not active_rentals:
             markup = InlineKeyboardMarkup()
@@ -2583,9 +6234,6 @@ def show_rentals_callback(call):
             CARDINAL.telegram.bot.answer_callback_query(call.id, "Нет активных аренд")
             return
         
-        # Сортируем аренды по времени окончания (ближайшие к завершению в начале)
-        active_rentals.sort(key=lambda rental: rental.expires_at)
-        
         # Формируем сообщение с информацией об арендах
         rentals_text = "⏰ <b>АКТИВНЫЕ АРЕНДЫ</b> ⏰\n\n"
         rentals_text += f"{'='*30}\n\n"
@@ -2611,12 +6259,7 @@ def show_rentals_callback(call):
         for username, user_rentals in rentals_by_user.items():
             rentals_text += f"<b>👤 {username}</b>\n"
             for rental in user_rentals:
-                # Находим аккаунт по rental_id
-                account = None
-                for acc in rental_manager.accounts.values():
-                    if acc.rental_id == rental.id:
-                        account = acc
-                        break
+                account = rental_manager.accounts.get(rental.account_login)
                 
                 remaining_time = rental.get_remaining_time()
                 hours, remainder = divmod(remaining_time.seconds, 3600)
@@ -2637,7 +6280,7 @@ def show_rentals_callback(call):
             rentals_text = rentals_text[:3900] + "...\n\n⚠️ Список слишком длинный, показаны не все аренды"
         
         rentals_text += f"{'='*30}\n\n"
-        rentals_text += "<b>УПРАВЛЕНИЕ:</b> <code>/srent_force ЛОГИН</code> - принудительный возврат"
+        rentals_text += "<b>УПРАВЛЕНИЕ:</b> <code>/srent_force ЛОГИН [ЛОГИН2 ...]</code> - принудительный возврат"
         
         markup = InlineKeyboardMarkup()
         markup.row(InlineKeyboardButton("⬅️ НАЗАД", callback_data="srent_menu"))
@@ -2658,42 +6301,211 @@ def show_rentals_callback(call):
         except:
             pass
 
-def show_return_account_callback(call):
-    """Показывает список аккаунтов для принудительного возврата"""
+# Фоновые задачи администратора
+ADMIN_JOB_WORKERS = 4  # Сколько возвратов выполняется параллельно
+ADMIN_JOB_PROGRESS_INTERVAL = 1.0  # Не чаще одного редактирования прогресса в секунду
+ADMIN_JOB_REPORT_LINES = 30  # Сколько строк результата показывать в сообщении
+FORCE_RETURN_TITLE = "Возврат аккаунтов"
+admin_executor = ThreadPoolExecutor(max_workers=ADMIN_JOB_WORKERS, thread_name_prefix="srent-admin")
+return_pickers = ConversationStore()  # chat_id -> меню возврата {query, page, selected}, с TTL и лимитом диалогов
+RETURN_PICKER_PAGE_SIZE = 8
+BULK_CONFIRM_TTL = 10 * 60  # Неподтвержденная групповая операция забывается через 10 минут
+bulk_pending = ConversationStore(ttl=BULK_CONFIRM_TTL)  # chat_id -> операция, state - токен кнопок ее предпросмотра
+BULK_ACTIONS = {
+    "delete": "Удаление аккаунтов",
+    "disable": "Отключение аккаунтов",
+    "enable": "Включение аккаунтов",
+    "retype": "Смена типа",
+    "force": "Возврат аккаунтов",
+    "reset": "Сброс пароля"
+}
+
+def parse_logins(text):
+    """Разбирает список логинов через пробел или запятую, сохраняя порядок"""
+    return list(dict.fromkeys(login for login in re.split(r"[\s,]+", text) if login))
+
+def send_force_end_message(login, username, user_id):
+    """Сообщает покупателю на FunPay о принудительном завершении аренды"""
     try:
-        # Фильтруем только арендованные аккаунты
-        rented_accounts = {login: account for login, account in rental_manager.accounts.items() if account.status == "rented"}
-        
-        if not rented_accounts:
-            markup = InlineKeyboardMarkup()
-            markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
-            
-            CARDINAL.telegram.bot.edit_message_text(
-                "🔄 <b>Возврат аккаунта</b>\n\n"
-                "В данный момент нет арендованных аккаунтов для возврата.",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup,
-                parse_mode="HTML"
-            )
-            CARDINAL.telegram.bot.answer_callback_query(call.id, "Нет арендованных аккаунтов")
-            return
+        message = format_message("rental_force_end", 
+            login=login,
+            username=username
+        )
         
-        # Создаем клавиатуру с кнопками для каждого аккаунта
+        # Через очередь: при групповом возврате сообщения одному покупателю объединяются
+        funpay_delivery.enqueue(user_id, username, message, kind="rental_force_end")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка отправки сообщения о завершении аренды: {e}")
+
+def force_return_job(login, notify_buyer=True):
+    """Возвращает один аккаунт; выполняется в пуле admin_executor"""
+    account = rental_manager.accounts.get(login)
+    if not account:
+        return login, False, "аккаунт не найден"
+    if account.status != "rented" or not account.rental_id:
+        return login, False, "аккаунт не арендован"
+    rental = rental_manager.rentals.get(account.rental_id)
+    if not rental:
+        return login, False, "данные аренды не найдены"
+    
+    username, user_id = rental.username, rental.user_id
+    with tracer.trace("force_return", login):
+        success, message, new_password = rental_manager.return_account(rental.id)
+    if not success:
+        return login, False, message
+    
+    if notify_buyer:
+        send_force_end_message(login, username, user_id)
+    return login, True, f"{username}, новый пароль: <code>{new_password}</code>"
+
+def reset_password_job(login):
+    """Сбрасывает пароль одного аккаунта к исходному; выполняется в пуле admin_executor"""
+    success, message = rental_manager.reset_account_password(login)
+    return login, success, message
+
+def format_admin_job_results(title, results, total):
+    """Формирует текст с прогрессом или итогом групповой операции"""
+    done = len(results)
+    succeeded = sum(1 for _, success, _ in results if success)
+    if done < total:
+        text = f"⏳ <b>{title}: {done}/{total}</b>\n\n"
+    else:
+        text = f"{'✅' if succeeded == total else '⚠️'} <b>{title}: {succeeded}/{total} успешно</b>\n\n"
+    
+    # Сначала ошибки, затем успешные; длинные списки обрезаем под лимит сообщения Telegram
+    ordered = sorted(results, key=lambda result: result[1])
+    for login, success, detail in ordered[:ADMIN_JOB_REPORT_LINES]:
+        text += f"{'✅' if success else '❌'} <b>{login}</b>: {detail}\n"
+    if len(ordered) > ADMIN_JOB_REPORT_LINES:
+        text += f"... и еще {len(ordered) - ADMIN_JOB_REPORT_LINES}\n"
+    return text
+
+def start_admin_job(chat_id, message_id, title, job, logins, kind):
+    """Выполняет job(login) для всех логинов в пуле с одной записью данных и обновляет сообщение message_id"""
+    def run():
+        results = []
+        last_edit = 0
         markup = InlineKeyboardMarkup()
-        for login in rented_accounts:
-            markup.row(InlineKeyboardButton(f"🔄 {login}", callback_data=f"srent_force_return_{login}"))
         markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
         
-        CARDINAL.telegram.bot.edit_message_text(
-            "🔄 <b>Возврат аккаунта</b>\n\n"
-            "Выберите аккаунт для принудительного возврата из аренды.\n\n"
-            "⚠️ <b>Внимание!</b> При возврате будет изменен пароль аккаунта и текущие сессии будут завершены.",
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=markup,
-            parse_mode="HTML"
+        with rental_manager.batch() as scope:
+            def batched_job(login):
+                # Сохранения задачи откладываются до ее конца, не задевая другие потоки
+                with rental_manager.batch(scope):
+                    return job(login)
+            
+            futures = [admin_executor.submit(batched_job, login) for login in logins]
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    logger.error(f"{LOGGER_PREFIX} Ошибка фоновой задачи {kind}: {e}")
+                    results.append(("?", False, f"ошибка: {e}"))
+                
+                finished = len(results) == len(logins)
+                if finished or time.monotonic() - last_edit >= ADMIN_JOB_PROGRESS_INTERVAL:
+                    last_edit = time.monotonic()
+                    try:
+                        CARDINAL.telegram.bot.edit_message_text(
+                            format_admin_job_results(title, results, len(logins)),
+                            chat_id,
+                            message_id,
+                            reply_markup=markup if finished else None,
+                            parse_mode="HTML"
+                        )
+                    except Exception as e:
+                        logger.error(f"{LOGGER_PREFIX} Ошибка обновления прогресса задачи {kind}: {e}")
+        
+        metrics.inc("steamrent_admin_jobs_total", kind=kind)
+    
+    # Отдельный поток ждет результатов, а сама работа со Steam выполняется в пуле
+    threading.Thread(target=run, daemon=True).start()
+
+def start_force_return(chat_id, message_id, logins, notify_buyer=True):
+    """Запускает возврат аккаунтов в фоне"""
+    start_admin_job(chat_id, message_id, FORCE_RETURN_TITLE,
+                    functools.partial(force_return_job, notify_buyer=notify_buyer), logins, "force_return")
+
+def format_remaining(rental):
+    """Оставшееся время аренды в виде '1 ч. 20 мин.'"""
+    remaining = int(max(0, rental.end_time - time.time()))
+    hours, remainder = divmod(remaining, 3600)
+    return f"{hours} ч. {remainder // 60} мин."
+
+def get_return_picker(chat_id):
+    """Состояние меню возврата чата: поиск, страница и отмеченные логины; каждое обращение продлевает TTL"""
+    entry = return_pickers.get(chat_id)
+    if entry is None:
+        entry = return_pickers.start(chat_id, "return_picker", "open", {"query": "", "page": 0, "selected": set()})
+    else:
+        return_pickers.set_state(chat_id, "open")
+    return entry["data"]
+
+def build_return_picker(chat_id):
+    """Формирует страницу меню возврата по текущему поиску чата"""
+    picker = get_return_picker(chat_id)
+    rentals = rental_manager.search_active_rentals(picker["query"])
+    selected = picker["selected"]
+    selected.intersection_update(login for login, account in rental_manager.accounts.items() if account.status == "rented")
+    
+    pages = max(1, (len(rentals) + RETURN_PICKER_PAGE_SIZE - 1) // RETURN_PICKER_PAGE_SIZE)
+    picker["page"] = page = min(max(picker["page"], 0), pages - 1)
+    page_rentals = rentals[page * RETURN_PICKER_PAGE_SIZE:(page + 1) * RETURN_PICKER_PAGE_SIZE]
+    
+    text = "🔄 <b>Возврат аккаунта</b>\n\n"
+    if picker["query"]:
+        text += f"🔍 Поиск: <code>{html.escape(picker['query'])}</code>\n"
+    text += f"Найдено аренд: <b>{len(rentals)}</b>"
+    if selected:
+        text += f" | Отмечено: <b>{len(selected)}</b>"
+    text += "\n\n"
+    for rental in page_rentals:
+        order = f", заказ #{str(rental.order_id).lstrip('#')}" if rental.order_id else ""
+        text += f"• <b>{rental.account_login}</b> - {rental.username}, осталось {format_remaining(rental)}{order}\n"
+    text += ("\nНажмите на логин для немедленного возврата или отметьте несколько аккаунтов.\n"
+             "⚠️ При возврате будет изменен пароль аккаунта и текущие сессии будут завершены.")
+    
+    markup = InlineKeyboardMarkup()
+    for rental in page_rentals:
+        login = rental.account_login
+        token = account_tokens.token(login)
+        markup.row(
+            InlineKeyboardButton(f"🔄 {login[:24]} · {format_remaining(rental)}", callback_data=f"srent_fr_{token}"),
+            InlineKeyboardButton("☑️" if login in selected else "⬜", callback_data=f"srent_fp_{token}")
+        )
+    if pages > 1:
+        markup.row(
+            InlineKeyboardButton("◀️", callback_data=f"srent_rp_{(page - 1) % pages}"),
+            InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"srent_rp_{page}"),
+            InlineKeyboardButton("▶️", callback_data=f"srent_rp_{(page + 1) % pages}")
         )
+    search_row = [InlineKeyboardButton("🔍 Поиск", callback_data="srent_return_search")]
+    if picker["query"]:
+        search_row.append(InlineKeyboardButton("✖️ Сбросить поиск", callback_data="srent_return_clear"))
+    markup.row(*search_row)
+    if rentals:
+        markup.row(InlineKeyboardButton("☑️ Отметить найденные", callback_data="srent_fp_all"))
+    if selected:
+        markup.row(InlineKeyboardButton(f"🔄 Вернуть отмеченные ({len(selected)})", callback_data="srent_force_selected"))
+    markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
+    return text, markup
+
+def refresh_return_picker(call):
+    """Перерисовывает меню возврата в том же сообщении"""
+    text, markup = build_return_picker(call.message.chat.id)
+    CARDINAL.telegram.bot.edit_message_text(
+        text,
+        call.message.chat.id,
+        call.message.message_id,
+        reply_markup=markup,
+        parse_mode="HTML"
+    )
+
+def show_return_account_callback(call):
+    """Показывает меню принудительного возврата с поиском и страницами"""
+    try:
+        get_return_picker(call.message.chat.id)["page"] = 0
+        refresh_return_picker(call)
         CARDINAL.telegram.bot.answer_callback_query(call.id, "Выберите аккаунт для возврата")
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Ошибка отображения меню возврата аккаунта: {e}")
@@ -2702,76 +6514,120 @@ def show_return_account_callback(call):
         except:
             pass
 
+def return_picker_page_callback(call, page):
+    """Переключает страницу меню возврата"""
+    get_return_picker(call.message.chat.id)["page"] = int(page)
+    refresh_return_picker(call)
+    CARDINAL.telegram.bot.answer_callback_query(call.id)
+
+def return_search_callback(call):
+    """Запрашивает поисковый запрос для меню возврата"""
+    conversations.start(call.message.chat.id, "return_search", "query")
+    CARDINAL.telegram.bot.send_message(
+        call.message.chat.id,
+        "🔍 <b>Поиск аренды</b>\n\n"
+        "Отправьте начало логина, <code>@покупатель</code> или <code>#номер_заказа</code>.\n"
+        "Напишите <code>отмена</code>, чтобы выйти.",
+        parse_mode="HTML"
+    )
+    CARDINAL.telegram.bot.answer_callback_query(call.id, "Введите запрос")
+
+def handle_return_search(message, conversation=None):
+    """Принимает поисковый запрос и присылает найденные аренды"""
+    chat_id = message.chat.id
+    conversations.finish(chat_id)
+    query = (message.text or "").strip()
+    if query.lower() in ["отмена", "cancel", "/cancel", "/отмена"]:
+        CARDINAL.telegram.bot.send_message(chat_id, "❌ Поиск отменен.")
+        return True
+    
+    get_return_picker(chat_id).update(query=query, page=0)
+    text, markup = build_return_picker(chat_id)
+    CARDINAL.telegram.bot.send_message(chat_id, text, reply_markup=markup, parse_mode="HTML")
+    return True
+
+def return_clear_search_callback(call):
+    """Сбрасывает поиск в меню возврата"""
+    get_return_picker(call.message.chat.id).update(query="", page=0)
+    refresh_return_picker(call)
+    CARDINAL.telegram.bot.answer_callback_query(call.id, "Поиск сброшен")
+
+def resolve_account_token(call, token):
+    """Находит логин по токену кнопки; None, если меню устарело"""
+    login = account_tokens.resolve(token, list(rental_manager.accounts))
+    if login is None:
+        CARDINAL.telegram.bot.answer_callback_query(call.id, "Список устарел, откройте меню заново")
+    return login
+
+def force_return_token_callback(call, token):
+    """Возврат аккаунта по кнопке с коротким токеном"""
+    login = resolve_account_token(call, token)
+    if login:
+        force_return_account_from_callback(call, login)
+
+def toggle_force_return_pick_callback(call, login):
+    """Отмечает аккаунт для группового возврата"""
+    chat_id = call.message.chat.id
+    picker = get_return_picker(chat_id)
+    selected = picker["selected"]
+    if login == "all":
+        selected.update(rental.account_login for rental in rental_manager.search_active_rentals(picker["query"]))
+    elif login in selected:
+        selected.discard(login)
+    else:
+        selected.add(login)
+    
+    try:
+        refresh_return_picker(call)
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка обновления меню возврата: {e}")
+    CARDINAL.telegram.bot.answer_callback_query(call.id, f"Отмечено: {len(selected)}")
+
+def toggle_force_return_token_callback(call, token):
+    """Отметка аккаунта по кнопке с коротким токеном"""
+    login = "all" if token == "all" else resolve_account_token(call, token)
+    if login:
+        toggle_force_return_pick_callback(call, login)
+
+def force_return_selected_callback(call):
+    """Возвращает все отмеченные аккаунты параллельно"""
+    chat_id = call.message.chat.id
+    picker = get_return_picker(chat_id)
+    logins = sorted(picker["selected"])
+    picker["selected"] = set()
+    if not logins:
+        CARDINAL.telegram.bot.answer_callback_query(call.id, "Ничего не отмечено")
+        return
+    
+    CARDINAL.telegram.bot.answer_callback_query(call.id, f"Возвращаем {len(logins)} акк.")
+    CARDINAL.telegram.bot.edit_message_text(
+        format_admin_job_results(FORCE_RETURN_TITLE, [], len(logins)),
+        chat_id,
+        call.message.message_id,
+        parse_mode="HTML"
+    )
+    start_force_return(chat_id, call.message.message_id, logins)
+
 def force_return_account_from_callback(call, login):
     """Принудительно возвращает аккаунт из аренды по callback"""
     try:
-        # Проверяем, существует ли аккаунт
-        if login not in rental_manager.accounts:
+        # Быстрые проверки до запуска фоновой задачи
+        account = rental_manager.accounts.get(login)
+        if not account:
             CARDINAL.telegram.bot.answer_callback_query(call.id, "Аккаунт не найден!")
             return
-            
-        account = rental_manager.accounts[login]
-        
-        # Проверяем, арендован ли аккаунт
         if account.status != "rented" or not account.rental_id:
             CARDINAL.telegram.bot.answer_callback_query(call.id, "Аккаунт не арендован!")
             return
-            
-        # Находим аренду
-        rental = rental_manager.rentals.get(account.rental_id)
-        if not rental:
-            CARDINAL.telegram.bot.answer_callback_query(call.id, "Данные аренды не найдены!")
-            return
-            
-        # Запоминаем данные пользователя
-        username = rental.username
-        user_id = rental.user_id
-        
-        # Возвращаем аккаунт
-        success, message, new_password = rental_manager.return_account(account.rental_id)
-        
-        if not success:
-            CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {message}")
-            return
-            
-        # Создаем клавиатуру для возврата в меню
-        markup = InlineKeyboardMarkup()
-        markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
         
+        CARDINAL.telegram.bot.answer_callback_query(call.id, "Возврат запущен")
         CARDINAL.telegram.bot.edit_message_text(
-            "✅ <b>Аккаунт успешно возвращен</b>\n\n"
-            f"🎮 Логин: {login}\n"
-            f"👤 Пользователь: {username}\n"
-            f"✅ Статус аккаунта изменен на 'available'\n"
-            f"✅ Пароль изменен на: <code>{new_password}</code>\n"
-            "✅ Текущие сессии завершены",
+            format_admin_job_results(FORCE_RETURN_TITLE, [], 1),
             call.message.chat.id,
             call.message.message_id,
-            reply_markup=markup,
             parse_mode="HTML"
         )
-        CARDINAL.telegram.bot.answer_callback_query(call.id, "Аккаунт успешно возвращен")
-        
-        # Отправляем сообщение пользователю FunPay о завершении аренды
-        try:
-            message = format_message("rental_force_end", 
-                login=login,
-                username=username
-            )
-            
-            if hasattr(CARDINAL, 'account') and hasattr(CARDINAL.account, 'send_message'):
-                # Получаем данные чата
-                chat_id = f"users-{user_id}-{CARDINAL.account.id}"
-                interlocutor_id = user_id
-                chat_name = f"Переписка с {username}"
-                
-                # Используем низкоуровневый метод отправки сообщений
-                CARDINAL.account.send_message(chat_id, message, chat_name, interlocutor_id, None, True, False, False)
-                logger.info(f"{LOGGER_PREFIX} Сообщение о принудительном завершении аренды отправлено")
-            else:
-                logger.warning(f"{LOGGER_PREFIX} Невозможно отправить сообщение: методы отправки недоступны")
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Ошибка отправки сообщения о завершении аренды: {e}")
+        start_force_return(call.message.chat.id, call.message.message_id, [login])
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Ошибка принудительного возврата аккаунта: {e}")
         try:
@@ -2779,117 +6635,104 @@ def force_return_account_from_callback(call, login):
         except:
             pass
 
-def show_lot_bindings_callback(call):
-    """Показывает список привязок лотов"""
-    try:
-        if not lot_bindings:
-            markup = InlineKeyboardMarkup()
-            markup.row(InlineKeyboardButton("⬅️ Назад в меню", callback_data="srent_menu"))
-            markup.row(InlineKeyboardButton("Добавить привязку лота", callback_data="srent_add_binding"))
-            
-            CARDINAL.telegram.bot.edit_message_text(
-                "🔗 ПРИВЯЗКИ ЛОТОВ\n\n"
-                "━━━━━━━━━━━━━━━━━━━━━━\n"
-                "В данный момент нет привязок лотов.\n\n"
-                "Нажмите кнопку ниже для добавления привязки.\n"
-                "━━━━━━━━━━━━━━━━━━━━━━",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup,
-                parse_mode="HTML"
-            )
-            CARDINAL.telegram.bot.answer_callback_query(call.id, "Нет привязок лотов")
-            return
-        
-        # Сортируем привязки по типу аккаунта
-        sorted_bindings = sorted(lot_bindings.items(), key=lambda x: (x[1]["account_type"], x[1]["duration_hours"]))
-        
-        # Группируем привязки по типу аккаунта
-        bindings_by_type = {}
-        for lot_name, binding in sorted_bindings:
-            acc_type = binding["account_type"]
-            if acc_type not in bindings_by_type:
-                bindings_by_type[acc_type] = []
-            bindings_by_type[acc_type].append((lot_name, binding))
-        
-        # Формируем список привязок
-        bindings_text = "🔗 ПРИВЯЗКИ ЛОТОВ\n\n"
-        bindings_text += "━━━━━━━━━━━━━━━━━━━━━━\n"
-        bindings_text += f"Всего привязок: {len(lot_bindings)}\n"
-        bindings_text += "━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        
-        # Создаем клавиатуру с кнопками для каждой привязки
-        markup = InlineKeyboardMarkup(row_width=1)
-        
-        # Показываем не более 10 привязок, чтобы не превысить лимит Telegram
-        binding_count = 0
-        shown_types = []
+def build_lot_bindings_view():
+    """Строит текст и клавиатуру списка привязок лотов"""
+    global binding_hash_map
+    
+    if not lot_bindings:
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("⬅️ Назад в меню", callback_data="srent_menu"))
+        markup.row(InlineKeyboardButton("Добавить привязку лота", callback_data="srent_add_binding"))
         
-        # Создаем словарь для хранения соответствия хешей с оригинальными названиями лотов
-        binding_hashes = {}
+        return (
+            "🔗 ПРИВЯЗКИ ЛОТОВ\n\n"
+            "━━━━━━━━━━━━━━━━━━━━━━\n"
+            "В данный момент нет привязок лотов.\n\n"
+            "Нажмите кнопку ниже для добавления привязки.\n"
+            "━━━━━━━━━━━━━━━━━━━━━━",
+            markup
+        )
+    
+    # Сортируем привязки по типу аккаунта
+    sorted_bindings = sorted(lot_bindings.items(), key=lambda x: (x[1]["account_type"], x[1]["duration_hours"]))
+    
+    # Группируем привязки по типу аккаунта
+    bindings_by_type = {}
+    for lot_name, binding in sorted_bindings:
+        acc_type = binding["account_type"]
+        if acc_type not in bindings_by_type:
+            bindings_by_type[acc_type] = []
+        bindings_by_type[acc_type].append((lot_name, binding))
+    
+    # Формируем список привязок
+    bindings_text = "🔗 ПРИВЯЗКИ ЛОТОВ\n\n"
+    bindings_text += "━━━━━━━━━━━━━━━━━━━━━━\n"
+    bindings_text += f"Всего привязок: {len(lot_bindings)}\n"
+    bindings_text += "━━━━━━━━━━━━━━━━━━━━━━\n\n"
+    
+    # Создаем клавиатуру с кнопками для каждой привязки
+    markup = InlineKeyboardMarkup(row_width=1)
+    
+    # Показываем не более 10 привязок, чтобы не превысить лимит Telegram
+    binding_count = 0
+    shown_types = []
+    
+    # Создаем словарь для хранения соответствия хешей с оригинальными названиями лотов
+    binding_hashes = {}
+    
+    for acc_type, bindings in bindings_by_type.items():
+        if binding_count >= 10:
+            break
+            
+        bindings_text += f"📋 ТИП: {acc_type.upper()}\n\n"
+        shown_types.append(acc_type)
         
-        for acc_type, bindings in bindings_by_type.items():
+        for lot_name, binding in bindings[:3]:  # Показываем до 3 привязок каждого типа
             if binding_count >= 10:
                 break
                 
-            bindings_text += f"📋 ТИП: {acc_type.upper()}\n\n"
-            shown_types.append(acc_type)
+            # Сокращаем длинные названия лотов
+            display_name = lot_name
+            if len(display_name) > 40:
+                display_name = display_name[:37] + "..."
             
-            for lot_name, binding in bindings[:3]:  # Показываем до 3 привязок каждого типа
-                if binding_count >= 10:
-                    break
-                    
-                # Сокращаем длинные названия лотов
-                display_name = lot_name
-                if len(display_name) > 40:
-                    display_name = display_name[:37] + "..."
-                
-                bindings_text += f"⏱ {binding['duration_hours']} ч. | 💜 {display_name}\n"
-                
-                # Создаем уникальный короткий хеш для лота
-                lot_hash = str(abs(hash(lot_name)) % 1000000)  # Используем хеш для создания короткого идентификатора
-                binding_hashes[lot_hash] = lot_name  # Сохраняем соответствие хеша оригинальному имени
-                
-                # Добавляем кнопку для этой привязки с коротким идентификатором
-                markup.row(InlineKeyboardButton(f"Управление: {display_name[:20]}...", callback_data=f"srent_binding_{lot_hash}"))
-                
-                binding_count += 1
-        
-        # Сохраняем словарь хешей в глобальную переменную для использования в других функциях
-        global binding_hash_map
-        binding_hash_map = binding_hashes
-        
-        # Добавляем кнопки управления привязками
-        bindings_text += "\n━━━━━━━━━━━━━━━━━━━━━━\n"
-        bindings_text += "Доступные команды:"
-        
-        # Если показаны не все типы, добавляем кнопку "Показать все"
-        if len(shown_types) < len(bindings_by_type):
-            markup.row(InlineKeyboardButton("Показать все привязки 📋", callback_data="srent_all_bindings"))
-        
-        # Добавляем кнопки для добавления/удаления привязок
-        markup.row(InlineKeyboardButton("Добавить привязку лота", callback_data="srent_add_binding"))
-        markup.row(InlineKeyboardButton("Справка по привязкам", callback_data="srent_binding_help"))
-        markup.row(InlineKeyboardButton("⬅️ Назад в меню", callback_data="srent_menu"))
-        markup.row(InlineKeyboardButton("🔄 Обновить", callback_data="srent_lot_bindings"))
-        
-        try:
-            CARDINAL.telegram.bot.edit_message_text(
-                bindings_text,
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=markup,
-                parse_mode="HTML"
-            )
-        except Exception as edit_error:
-            # Если сообщение не изменилось, просто отвечаем callback_query
-            if "message is not modified" in str(edit_error):
-                CARDINAL.telegram.bot.answer_callback_query(call.id, "Список привязок актуален")
-            else:
-                # Если другая ошибка - перебрасываем исключение
-                raise edit_error
-                
-        CARDINAL.telegram.bot.answer_callback_query(call.id, "Список привязок лотов")
+            units = {"accounts": " | 👥 ×аккаунты", "hours": " | ⏱ ×часы"}.get(binding.get("quantity_mode"), "")
+            bindings_text += f"⏱ {binding['duration_hours']} ч.{units} | 💜 {display_name}\n"
+            
+            # Создаем уникальный короткий хеш для лота
+            lot_hash = str(abs(hash(lot_name)) % 1000000)  # Используем хеш для создания короткого идентификатора
+            binding_hashes[lot_hash] = lot_name  # Сохраняем соответствие хеша оригинальному имени
+            
+            # Добавляем кнопку для этой привязки с коротким идентификатором
+            markup.row(InlineKeyboardButton(f"Управление: {display_name[:20]}...", callback_data=f"srent_binding_{lot_hash}"))
+            
+            binding_count += 1
+    
+    # Сохраняем словарь хешей в глобальную переменную для использования в других функциях
+    # (при попадании в кеш словарь остается от той же версии привязок)
+    binding_hash_map = binding_hashes
+    
+    # Добавляем кнопки управления привязками
+    bindings_text += "\n━━━━━━━━━━━━━━━━━━━━━━\n"
+    bindings_text += "Доступные команды:"
+    
+    # Если показаны не все типы, добавляем кнопку "Показать все"
+    if len(shown_types) < len(bindings_by_type):
+        markup.row(InlineKeyboardButton("Показать все привязки 📋", callback_data="srent_all_bindings"))
+    
+    # Добавляем кнопки для добавления/удаления привязок
+    markup.row(InlineKeyboardButton("Добавить привязку лота", callback_data="srent_add_binding"))
+    markup.row(InlineKeyboardButton("Справка по привязкам", callback_data="srent_binding_help"))
+    markup.row(InlineKeyboardButton("⬅️ Назад в меню", callback_data="srent_menu"))
+    markup.row(InlineKeyboardButton("🔄 Обновить", callback_data="srent_lot_bindings"))
+    
+    return bindings_text, markup
+
+def show_lot_bindings_callback(call):
+    """Показывает список привязок лотов"""
+    try:
+        answer = "Список привязок лотов" if lot_bindings else "Нет привязок лотов"
+        edit_cached_view(call, "lot_bindings", build_lot_bindings_view, answer)
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Ошибка отображения привязок лотов: {e}")
         try:
@@ -3054,7 +6897,7 @@ def list_accounts_cmd(message):
         # Формируем список аккаунтов
         accounts_text = ""
         for login, account in rental_manager.accounts.items():
-            status_emoji = "🟢" if account.status == "available" else "🔴" if account.status == "rented" else "⚫"
+            status_emoji = "🟢" if account.status == "available" else "🔴" if account.status == "rented" else "🟡" if account.status == "quarantined" else "⚫"
             accounts_text += f"{status_emoji} <b>{login}</b> ({account.type})\n"
             accounts_text += f"   Статус: {account.status}\n"
             
@@ -3137,7 +6980,7 @@ def list_rentals_cmd(message):
             pass
 
 def force_return_account_cmd(message):
-    """Принудительно возвращает аккаунт из аренды"""
+    """Принудительно возвращает аккаунты из аренды"""
     try:
         text = message.text.strip()
         
@@ -3145,95 +6988,24 @@ def force_return_account_cmd(message):
         if text.startswith('/srent_force'):
             text = text[len('/srent_force'):].strip()
         
-        if not text:
+        logins = parse_logins(text)
+        if not logins:
             CARDINAL.telegram.bot.send_message(
                 message.chat.id, 
                 "❌ <b>Неверный формат команды</b>\n\n"
-                "Используйте: <code>/srent_force ЛОГИН</code>\n\n"
+                "Используйте: <code>/srent_force ЛОГИН [ЛОГИН2 ...]</code>\n\n"
                 "Список активных аренд можно посмотреть командой <code>/steam_active</code>",
                 parse_mode="HTML"
             )
             return
         
-        login = text
-        
-        # Проверяем, существует ли аккаунт
-        if login not in rental_manager.accounts:
-            CARDINAL.telegram.bot.send_message(
-                message.chat.id,
-                "❌ Аккаунт не найден.",
-                parse_mode="HTML"
-            )
-            return
-            
-        account = rental_manager.accounts[login]
-        
-        # Проверяем, арендован ли аккаунт
-        if account.status != "rented" or not account.rental_id:
-            CARDINAL.telegram.bot.send_message(
-                message.chat.id,
-                "❌ Аккаунт не арендован.",
-                parse_mode="HTML"
-            )
-            return
-            
-        # Находим аренду
-        rental = rental_manager.rentals.get(account.rental_id)
-        if not rental:
-            CARDINAL.telegram.bot.send_message(
-                message.chat.id,
-                "❌ Данные аренды не найдены.",
-                parse_mode="HTML"
-            )
-            return
-            
-        # Запоминаем данные пользователя
-        username = rental.username
-        user_id = rental.user_id
-        
-        # Возвращаем аккаунт
-        success, message_text, new_password = rental_manager.return_account(account.rental_id)
-        
-        if not success:
-            CARDINAL.telegram.bot.send_message(
-                message.chat.id,
-                f"❌ {message_text}",
-                parse_mode="HTML"
-            )
-            return
-            
-        CARDINAL.telegram.bot.send_message(
+        # Сразу отвечаем, а возврат выполняем в фоне с обновлением этого сообщения
+        progress = CARDINAL.telegram.bot.send_message(
             message.chat.id,
-            "✅ <b>Аккаунт успешно возвращен</b>\n\n"
-            f"🎮 Логин: {login}\n"
-            f"👤 Пользователь: {username}\n\n"
-            "✅ Статус аккаунта изменен на 'available'\n"
-            f"✅ Пароль изменен на: <code>{new_password}</code>\n"
-            "✅ Текущие сессии завершены",
+            format_admin_job_results(FORCE_RETURN_TITLE, [], len(logins)),
             parse_mode="HTML"
         )
-        
-        # Отправляем сообщение пользователю FunPay о завершении аренды
-        try:
-            message = format_message("rental_force_end", 
-                login=login,
-                username=username
-            )
-            
-            if hasattr(CARDINAL, 'account') and hasattr(CARDINAL.account, 'send_message'):
-                # Получаем данные чата
-                chat_id = f"users-{user_id}-{CARDINAL.account.id}"
-                interlocutor_id = user_id
-                chat_name = f"Переписка с {username}"
-                
-                # Используем низкоуровневый метод отправки сообщений
-                CARDINAL.account.send_message(chat_id, message, chat_name, interlocutor_id, None, True, False, False)
-                logger.info(f"{LOGGER_PREFIX} Сообщение о принудительном завершении аренды отправлено")
-            else:
-                logger.warning(f"{LOGGER_PREFIX} Невозможно отправить сообщение: методы отправки недоступны")
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Ошибка отправки сообщения о завершении аренды: {e}")
-
+        start_force_return(message.chat.id, progress.message_id, logins)
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике force_return_account_cmd: {e}")
         try:
@@ -3341,17 +7113,14 @@ def manual_rent_account_cmd(message):
         try:
             message_text = f"Аренда аккаунта Steam\n\nЛогин: {account.login}\nПароль: {account.password}\nТип: {account.type}\n\nСрок аренды: {duration_hours} ч.\nДата окончания: {end_time_str}\n\nВажно:\n- По истечении срока доступ будет заблокирован\n- Пароль будет изменен\n- Не меняйте пароль от аккаунта\n- Не включайте двухфакторную аутентификацию"
             
-            if hasattr(CARDINAL, 'account') and hasattr(CARDINAL.account, 'send_message'):
-                # Получаем данные чата
-                chat_id = f"users-{user_id}-{CARDINAL.account.id}"
-                interlocutor_id = user_id
-                chat_name = f"Переписка с {username}"
-                
-                # Используем низкоуровневый метод отправки сообщений
-                CARDINAL.account.send_message(chat_id, message_text, chat_name, interlocutor_id, None, True, False, False)
+            delivered, error = funpay_delivery.send(user_id, username, message_text, kind="manual_rent")
+            if delivered:
                 logger.info(f"{LOGGER_PREFIX} Сообщение о выдаче аккаунта отправлено")
             else:
-                logger.warning(f"{LOGGER_PREFIX} Невозможно отправить сообщение: методы отправки недоступны")
+                CARDINAL.telegram.bot.send_message(
+                    message.chat.id,
+                    f"⚠️ Сообщение покупателю не доставлено ({error}), отправка будет повторена автоматически."
+                )
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Ошибка отправки сообщения о выдаче аккаунта: {e}")
     except Exception as e:
@@ -3371,49 +7140,14 @@ def return_account_cmd(message):
             text = text[len('/srent_return'):].strip()
         
         if text:
-            # Если указан логин аккаунта
-            login = text
-            
-            # Проверяем, существует ли аккаунт
-            if login not in rental_manager.accounts:
-                CARDINAL.telegram.bot.send_message(
-                    message.chat.id,
-                    "❌ Аккаунт не найден.",
-                    parse_mode="HTML"
-                )
-                return
-                
-            account = rental_manager.accounts[login]
-            
-            # Проверяем, арендован ли аккаунт
-            if account.status != "rented" or not account.rental_id:
-                CARDINAL.telegram.bot.send_message(
-                    message.chat.id,
-                    "❌ Аккаунт не арендован.",
-                    parse_mode="HTML"
-                )
-                return
-                
-            # Возвращаем аккаунт
-            success, message_text, new_password = rental_manager.return_account(account.rental_id)
-            
-            if not success:
-                CARDINAL.telegram.bot.send_message(
-                    message.chat.id,
-                    f"❌ {message_text}",
-                    parse_mode="HTML"
-                )
-                return
-                
-            CARDINAL.telegram.bot.send_message(
+            # Если указаны логины, возвращаем их в фоне без уведомления покупателей
+            logins = parse_logins(text)
+            progress = CARDINAL.telegram.bot.send_message(
                 message.chat.id,
-                "✅ <b>Аккаунт успешно возвращен</b>\n\n"
-                f"🎮 Логин: {login}\n\n"
-                "✅ Статус аккаунта изменен на 'available'\n"
-                f"✅ Пароль изменен на: <code>{new_password}</code>\n"
-                "✅ Текущие сессии завершены",
+                format_admin_job_results(FORCE_RETURN_TITLE, [], len(logins)),
                 parse_mode="HTML"
             )
+            start_force_return(message.chat.id, progress.message_id, logins, notify_buyer=False)
         else:
             # Если логин не указан, показываем список аккаунтов для возврата
             # Фильтруем только арендованные аккаунты
@@ -3521,6 +7255,141 @@ def del_account_cmd(message):
         except:
             pass
 
+def bulk_cmd(message):
+    """Групповая операция над аккаунтами: /srent_bulk ДЕЙСТВИЕ [ТИП] [фильтры или логины]"""
+    try:
+        text = message.text.strip()
+        
+        # Убираем команду из начала
+        if text.startswith('/srent_bulk'):
+            text = text[len('/srent_bulk'):].strip()
+        
+        tokens = text.split()
+        action = tokens[0].lower() if tokens else ""
+        if action not in BULK_ACTIONS or (action == "retype" and len(tokens) < 2):
+            CARDINAL.telegram.bot.send_message(
+                message.chat.id,
+                "📦 <b>Групповые операции</b>\n\n"
+                "Используйте: <code>/srent_bulk ДЕЙСТВИЕ [фильтры] [логины]</code>\n\n"
+                "<b>Действия:</b>\n"
+                "• <code>delete</code> - удалить\n"
+                "• <code>disable</code> / <code>enable</code> - отключить / включить\n"
+                "• <code>retype НОВЫЙ_ТИП</code> - сменить тип\n"
+                "• <code>force</code> - принудительно вернуть из аренды\n"
+                "• <code>reset</code> - сбросить пароль к исходному\n\n"
+                "<b>Фильтры:</b>\n"
+                "• <code>type=ТИП</code>\n"
+                "• <code>status=available|rented|disabled</code>\n"
+                "• <code>idle=ЧАСЫ</code> - свободен не меньше указанного времени\n\n"
+                "Пример: <code>/srent_bulk disable type=pubg idle=72</code>",
+                parse_mode="HTML"
+            )
+            return
+        
+        value = tokens[1] if action == "retype" else None
+        filters = {}
+        logins = []
+        for token in tokens[2 if value else 1:]:
+            key, sep, arg = token.partition("=")
+            if not sep:
+                logins.extend(parse_logins(token))
+            elif key == "type":
+                filters["account_type"] = arg
+            elif key == "status":
+                filters["status"] = arg
+            elif key == "idle":
+                filters["idle_hours"] = float(arg)
+            else:
+                CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Неизвестный фильтр: {key}")
+                return
+        
+        if not logins and not filters:
+            CARDINAL.telegram.bot.send_message(
+                message.chat.id,
+                "❌ Укажите логины или хотя бы один фильтр, чтобы не затронуть все аккаунты случайно.",
+                parse_mode="HTML"
+            )
+            return
+        
+        selected = rental_manager.select_accounts(logins, **filters)
+        if not selected:
+            CARDINAL.telegram.bot.send_message(message.chat.id, "ℹ️ Под условия не попал ни один аккаунт.")
+            return
+        
+        # Перед выполнением просим подтверждение
+        # Токен связывает кнопки с этим предпросмотром: новая команда делает старые кнопки недействительными
+        token = uuid4().hex[:12]
+        bulk_pending.start(message.chat.id, "bulk", token, {"action": action, "value": value, "logins": selected})
+        preview = ", ".join(selected[:20]) + (f" и еще {len(selected) - 20}" if len(selected) > 20 else "")
+        markup = InlineKeyboardMarkup()
+        markup.row(
+            InlineKeyboardButton(f"✅ Выполнить ({len(selected)})", callback_data=f"srent_bulk_confirm_{token}"),
+            InlineKeyboardButton("❌ Отмена", callback_data=f"srent_bulk_cancel_{token}")
+        )
+        CARDINAL.telegram.bot.send_message(
+            message.chat.id,
+            f"📦 <b>{BULK_ACTIONS[action]}</b>{f' → {value}' if value else ''}\n\n"
+            f"Аккаунтов: <b>{len(selected)}</b>\n"
+            f"<code>{preview}</code>",
+            reply_markup=markup,
+            parse_mode="HTML"
+        )
+    except ValueError:
+        CARDINAL.telegram.bot.send_message(message.chat.id, "❌ idle должен быть числом часов")
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике bulk_cmd: {e}")
+        try:
+            CARDINAL.telegram.bot.send_message(message.chat.id, f"❌ Произошла ошибка: {e}")
+        except:
+            pass
+
+def bulk_confirm_callback(call, token):
+    """Выполняет подтвержденную групповую операцию, если кнопка от ее предпросмотра"""
+    chat_id = call.message.chat.id
+    entry = bulk_pending.take(chat_id, "bulk", token)
+    if not entry:
+        CARDINAL.telegram.bot.answer_callback_query(call.id, "Операция уже выполнена, отменена или устарела")
+        return
+    
+    pending = entry["data"]
+    action, logins = pending["action"], pending["logins"]
+    title = BULK_ACTIONS[action]
+    CARDINAL.telegram.bot.answer_callback_query(call.id, "Выполняется...")
+    
+    if action in ("force", "reset"):
+        # Смена паролей в Steam идет параллельно в пуле
+        job = force_return_job if action == "force" else reset_password_job
+        CARDINAL.telegram.bot.edit_message_text(
+            format_admin_job_results(title, [], len(logins)),
+            chat_id,
+            call.message.message_id,
+            parse_mode="HTML"
+        )
+        start_admin_job(chat_id, call.message.message_id, title, job, logins, f"bulk_{action}")
+        return
+    
+    results = rental_manager.bulk_update(logins, action, pending["value"])
+    metrics.inc("steamrent_admin_jobs_total", kind=f"bulk_{action}")
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("« Назад в меню", callback_data="srent_menu"))
+    CARDINAL.telegram.bot.edit_message_text(
+        format_admin_job_results(title, results, len(logins)),
+        chat_id,
+        call.message.message_id,
+        reply_markup=markup,
+        parse_mode="HTML"
+    )
+
+def bulk_cancel_callback(call, token):
+    """Отменяет групповую операцию этого предпросмотра"""
+    bulk_pending.take(call.message.chat.id, "bulk", token)
+    CARDINAL.telegram.bot.edit_message_text(
+        "❌ Групповая операция отменена",
+        call.message.chat.id,
+        call.message.message_id
+    )
+    CARDINAL.telegram.bot.answer_callback_query(call.id, "Отменено")
+
 # Функции для работы с привязками лотов
 def unbind_lot_cmd(message):
     """Удаляет привязку аккаунта к лоту"""
@@ -3683,11 +7552,13 @@ def bind_lot_cmd(message):
             CARDINAL.telegram.bot.send_message(
                 message.chat.id, 
                 "❌ <b>Неверный формат команды</b>\n\n"
-                "Используйте: <code>/srent_bind НАЗВАНИЕ_ЛОТА | ТИП | ЧАСЫ</code>\n\n"
+                "Используйте: <code>/srent_bind НАЗВАНИЕ_ЛОТА | ТИП | ЧАСЫ | КОЛИЧЕСТВО</code>\n\n"
                 "Пример: <code>/srent_bind Аренда PUBG на 2 часа | PUBG | 2</code>\n\n"
                 "• НАЗВАНИЕ_ЛОТА - точное название лота на FunPay\n"
                 "• ТИП - тип аккаунта (например: PUBG, CSGO, REPO)\n"
-                "• ЧАСЫ - срок аренды в часах",
+                "• ЧАСЫ - срок аренды в часах\n"
+                "• КОЛИЧЕСТВО - что умножает количество в заказе: <code>часы</code> или <code>аккаунты</code>; "
+                "без него выдается один аккаунт на указанный срок",
                 parse_mode="HTML"
             )
             return
@@ -3722,11 +7593,25 @@ def bind_lot_cmd(message):
                 )
                 return
         
+        # Режим количества: заказ "x3" дает втрое больше часов или три аккаунта; по умолчанию количество не учитывается
+        quantity_mode = "single"
+        if len(parts) > 3:
+            quantity_mode = QUANTITY_MODES.get(parts[3].lower())
+            if not quantity_mode:
+                CARDINAL.telegram.bot.send_message(
+                    message.chat.id,
+                    "❌ Количество: укажите <code>часы</code>, <code>аккаунты</code> или <code>один</code>.",
+                    parse_mode="HTML"
+                )
+                return
+        
         # Создаем привязку
         lot_bindings[lot_name] = {
             "account_type": account_type,
             "duration_hours": duration_hours
         }
+        if quantity_mode != "single":
+            lot_bindings[lot_name]["quantity_mode"] = quantity_mode
         save_lot_bindings()
         
         CARDINAL.telegram.bot.send_message(
@@ -3734,7 +7619,8 @@ def bind_lot_cmd(message):
             "✅ <b>Привязка успешно создана!</b>\n\n"
             f"🔹 Название лота: {lot_name}\n"
             f"🔹 Тип аккаунта: {account_type}\n"
-            f"🔹 Срок аренды: {duration_hours} ч.\n\n"
+            f"🔹 Срок аренды: {duration_hours} ч.\n"
+            f"🔹 Количество в заказе: {QUANTITY_MODE_TITLES[quantity_mode]}\n\n"
             "Теперь при покупке этого лота будет автоматически выдан аккаунт.",
             parse_mode="HTML"
         )
@@ -3767,11 +7653,14 @@ def help_lot_binding_cmd(message):
             "<b>📝 ПРИМЕРЫ ИСПОЛЬЗОВАНИЯ:</b>\n\n"
             "• <code>/srent_bind АРЕНДА PUBG НА 3 ЧАСА | PUBG | 3</code>\n\n"
             "• <code>/srent_bind АРЕНДА STEAM | REPO | 12</code>\n\n"
+            "• <code>/srent_bind НАБОР ДЛЯ КОМАНДЫ | PUBG | 3 | аккаунты</code>\n\n"
             f"{'='*30}\n\n"
             "<b>⚠️ ВАЖНАЯ ИНФОРМАЦИЯ:</b>\n\n"
             "• Название лота должно <b>точно</b> совпадать с названием на FunPay\n\n"
             "• Тип должен соответствовать существующим аккаунтам\n\n"
-            "• Часы аренды должны быть положительным целым числом",
+            "• Часы аренды должны быть положительным целым числом\n\n"
+            "• Количество в заказе учитывается, только если оно указано в привязке: с <code>| часы</code> умножается срок аренды, "
+            "с <code>| аккаунты</code> выдается столько же аккаунтов",
             parse_mode="HTML"
         )
     except Exception as e:
@@ -3889,7 +7778,7 @@ def start_add_binding_callback(call):
         chat_id = call.message.chat.id
         
         # Инициализируем состояние
-        ADD_BINDING_STATES[chat_id] = {"state": "name", "data": {}}
+        conversations.start(chat_id, "add_binding", "name")
         
         # Создаем клавиатуру для отмены
         markup = InlineKeyboardMarkup()
@@ -3914,21 +7803,22 @@ def start_add_binding_callback(call):
         except:
             pass
 
-def handle_binding_add_steps(message):
+def handle_binding_add_steps(message, conversation=None):
     """Обрабатывает шаги добавления привязки лота"""
     chat_id = message.chat.id
     
     # Проверяем, находится ли пользователь в процессе добавления привязки
-    if chat_id not in ADD_BINDING_STATES:
+    conversation = conversation or conversations.get(chat_id, "add_binding")
+    if not conversation:
         return False
     
     # Получаем текущее состояние и данные
-    state = ADD_BINDING_STATES[chat_id]["state"]
-    data = ADD_BINDING_STATES[chat_id]["data"]
+    state = conversation["state"]
+    data = conversation["data"]
     
     # Проверяем запрос на отмену
     if message.text.lower() in ["отмена", "cancel", "/cancel", "/отмена"]:
-        del ADD_BINDING_STATES[chat_id]
+        conversations.finish(chat_id)
         CARDINAL.telegram.bot.send_message(
             chat_id,
             "❌ Процесс добавления привязки отменен.",
@@ -3953,11 +7843,11 @@ def handle_binding_add_steps(message):
                     reply_markup=markup,
                     parse_mode="HTML"
                 )
-                del ADD_BINDING_STATES[chat_id]
+                conversations.finish(chat_id)
                 return True
             
             data["name"] = lot_name
-            ADD_BINDING_STATES[chat_id]["state"] = "type"
+            conversations.set_state(chat_id, "type")
             
             # Получаем доступные типы аккаунтов для выбора
             available_types = set()
@@ -3991,7 +7881,7 @@ def handle_binding_add_steps(message):
             # Получаем тип аккаунта
             account_type = message.text.strip()
             data["type"] = account_type
-            ADD_BINDING_STATES[chat_id]["state"] = "duration"
+            conversations.set_state(chat_id, "duration")
             
             # Создаем клавиатуру с кнопкой отмены и стандартными вариантами времени
             markup = InlineKeyboardMarkup(row_width=3)
@@ -4043,7 +7933,7 @@ def handle_binding_add_steps(message):
             save_lot_bindings()
             
             # Очищаем состояние
-            del ADD_BINDING_STATES[chat_id]
+            conversations.finish(chat_id)
             
             # Создаем клавиатуру для перехода к списку привязок
             markup = InlineKeyboardMarkup()
@@ -4071,7 +7961,7 @@ def handle_binding_add_steps(message):
             save_lot_bindings()
             
             # Очищаем состояние
-            del ADD_BINDING_STATES[chat_id]
+            conversations.finish(chat_id)
             
             # Создаем клавиатуру для перехода к управлению привязкой
             markup = InlineKeyboardMarkup()
@@ -4111,7 +8001,7 @@ def handle_binding_add_steps(message):
             save_lot_bindings()
             
             # Очищаем состояние
-            del ADD_BINDING_STATES[chat_id]
+            conversations.finish(chat_id)
             
             # Создаем клавиатуру для перехода к управлению привязкой
             markup = InlineKeyboardMarkup()
@@ -4136,8 +8026,7 @@ def handle_binding_add_steps(message):
             pass
         
         # В случае ошибки удаляем состояние
-        if chat_id in ADD_BINDING_STATES:
-            del ADD_BINDING_STATES[chat_id]
+        conversations.finish(chat_id, "add_binding")
         
         return True
 
@@ -4147,8 +8036,7 @@ def cancel_binding_callback(call):
         chat_id = call.message.chat.id
         
         # Проверяем, находится ли пользователь в процессе добавления привязки
-        if chat_id in ADD_BINDING_STATES:
-            del ADD_BINDING_STATES[chat_id]
+        conversations.finish(chat_id, "add_binding")
         
         # Создаем клавиатуру для возврата к списку привязок
         markup = InlineKeyboardMarkup()
@@ -4169,18 +8057,17 @@ def cancel_binding_callback(call):
         except:
             pass
 
-def binding_duration_callback(call):
+def binding_duration_callback(call, duration_str):
     """Обрабатывает выбор стандартной длительности аренды при создании привязки"""
     try:
         chat_id = call.message.chat.id
         
         # Проверяем, находится ли пользователь в процессе добавления или редактирования привязки
-        if chat_id not in ADD_BINDING_STATES:
+        conversation = conversations.get(chat_id, "add_binding")
+        if not conversation:
             CARDINAL.telegram.bot.answer_callback_query(call.id, "Нет активного процесса работы с привязкой")
             return
         
-        # Получаем длительность из callback data
-        duration_str = call.data.replace("srent_binding_duration_", "")
         try:
             duration_hours = int(duration_str)
         except ValueError:
@@ -4188,8 +8075,8 @@ def binding_duration_callback(call):
             return
         
         # Получаем данные привязки и состояние
-        data = ADD_BINDING_STATES[chat_id]["data"]
-        state = ADD_BINDING_STATES[chat_id]["state"]
+        data = conversation["data"]
+        state = conversation["state"]
         
         if state == "duration":
             # Создание новой привязки
@@ -4204,7 +8091,7 @@ def binding_duration_callback(call):
             save_lot_bindings()
             
             # Очищаем состояние
-            del ADD_BINDING_STATES[chat_id]
+            conversations.finish(chat_id)
             
             # Создаем клавиатуру для перехода к списку привязок
             markup = InlineKeyboardMarkup()
@@ -4232,7 +8119,7 @@ def binding_duration_callback(call):
             save_lot_bindings()
             
             # Очищаем состояние
-            del ADD_BINDING_STATES[chat_id]
+            conversations.finish(chat_id)
             
             # Создаем клавиатуру для перехода к управлению привязкой
             markup = InlineKeyboardMarkup()
@@ -4295,14 +8182,11 @@ def edit_binding_type_callback(call, binding_hash):
         
         # Инициализируем состояние для редактирования типа
         chat_id = call.message.chat.id
-        ADD_BINDING_STATES[chat_id] = {
-            "state": "edit_type",
-            "data": {
-                "name": lot_name,
-                "current_type": current_type,
-                "hash": binding_hash
-            }
-        }
+        conversations.start(chat_id, "add_binding", "edit_type", {
+            "name": lot_name,
+            "current_type": current_type,
+            "hash": binding_hash
+        })
         
         # Получаем доступные типы аккаунтов для выбора
         available_types = set()
@@ -4364,14 +8248,11 @@ def edit_binding_time_callback(call, binding_hash):
         
         # Инициализируем состояние для редактирования длительности
         chat_id = call.message.chat.id
-        ADD_BINDING_STATES[chat_id] = {
-            "state": "edit_duration",
-            "data": {
-                "name": lot_name,
-                "current_duration": current_duration,
-                "hash": binding_hash
-            }
-        }
+        conversations.start(chat_id, "add_binding", "edit_duration", {
+            "name": lot_name,
+            "current_duration": current_duration,
+            "hash": binding_hash
+        })
         
         # Создаем клавиатуру с кнопкой отмены и стандартными вариантами времени
         markup = InlineKeyboardMarkup(row_width=3)
@@ -4457,3 +8338,6 @@ def delete_binding_callback(call, binding_hash):
             CARDINAL.telegram.bot.answer_callback_query(call.id, f"Ошибка: {str(e)[:50]}")
         except:
             pass
+
+# Время импорта модуля (до вызова init_plugin)
+record_startup_timing("import", time.perf_counter() - _IMPORT_STARTED)
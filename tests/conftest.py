@@ -0,0 +1,104 @@
+import importlib
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _stub_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+# Telegram и HTTP-клиент нужны только для импорта плагина: тесты в сеть не ходят
+try:
+    import telebot.types  # noqa: F401
+except ImportError:
+    class _Markup:
+        def __init__(self, *args, **kwargs):
+            self.keyboard = []
+
+        def row(self, *buttons):
+            self.keyboard.append(list(buttons))
+            return self
+
+        add = row
+
+    class _Button:
+        def __init__(self, text, callback_data=None, **kwargs):
+            self.text = text
+            self.callback_data = callback_data
+
+    telebot = _stub_module("telebot")
+    telebot.types = _stub_module("telebot.types", InlineKeyboardMarkup=_Markup, InlineKeyboardButton=_Button,
+                                 ReplyKeyboardMarkup=_Markup, KeyboardButton=_Button)
+
+try:
+    import requests  # noqa: F401
+except ImportError:
+    def _offline(*args, **kwargs):
+        raise ConnectionError("сеть в тестах недоступна")
+
+    class _Session:
+        cookies = []
+        post = staticmethod(_offline)
+
+    _stub_module("requests", post=_offline, Session=_Session)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return types.SimpleNamespace(message_id=len(self.sent), chat=types.SimpleNamespace(id=chat_id))
+
+    def __getattr__(self, name):
+        # Остальные методы бота (edit_message_text, answer_callback_query, ...) ничего не делают
+        return lambda *args, **kwargs: True
+
+
+class FakeFunPayAccount:
+    id = 1
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self.sent.append((chat_id, text))
+        return types.SimpleNamespace(id=len(self.sent))
+
+    def get_chat_by_name(self, name, make_request=False):
+        return types.SimpleNamespace(id=f"chat-{name}", name=name)
+
+
+class FakeCardinal:
+    def __init__(self):
+        self.telegram = types.SimpleNamespace(bot=FakeBot(), msg_handler=lambda *args, **kwargs: None)
+        self.account = FakeFunPayAccount()
+        self.MAIN_CFG = {"telegram": {"admin_id": 1}}
+
+
+@pytest.fixture
+def srent(tmp_path, monkeypatch):
+    """Свежий модуль плагина с данными во временной папке, загруженным состоянием и заглушками Cardinal и Steam"""
+    monkeypatch.chdir(tmp_path)
+    sys.modules.pop("SteamRent", None)
+    module = importlib.import_module("SteamRent")
+    module.CARDINAL = FakeCardinal()
+    module.STATE_READY.set()
+    module.STATE_SETTLED.set()
+    # Steam недоступен: обращения к нему тест задает сам
+    monkeypatch.setattr(module.Account, "end_session_via_api", lambda self: True)
+    monkeypatch.setattr(module.Account, "change_password_via_api",
+                        lambda self, old, new: (False, "Ошибка изменения пароля: 503", None))
+    monkeypatch.setattr(module.Account, "verify_password_via_api", lambda self, password: False)
+    yield module
+    sys.modules.pop("SteamRent", None)
@@ -0,0 +1,599 @@
+import base64
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+
+def add_accounts(srent, count, account_type="cs", api_key=None):
+    for index in range(count):
+        srent.rental_manager.add_account(f"a{index}", "origpw", account_type, api_key)
+    return srent.rental_manager
+
+
+# Запуск
+
+def test_conversation_filter_does_not_wait_for_loading(srent, monkeypatch):
+    monkeypatch.setattr(srent, "start_state_loading", lambda: None)
+    srent.conversations.start(1, "add_account", "login")
+    message = SimpleNamespace(chat=SimpleNamespace(id=1))
+
+    srent.CONVERSATIONS_READY.clear()
+    started = time.monotonic()
+    assert srent.has_conversation(message) is False
+    assert time.monotonic() - started < 1
+
+    srent.CONVERSATIONS_READY.set()
+    assert srent.has_conversation(message) is True
+
+
+# Пул свободных аккаунтов и возврат
+
+def test_pool_selects_longest_idle_account_first(srent):
+    manager = add_accounts(srent, 3)
+    _, _, account, rental = manager.rent_account(1, "u", 2, "cs")
+    assert account.login == "a0"
+    manager.return_account(rental.id)
+
+    # a0 только что вернулся, a1 и a2 простаивают дольше
+    assert manager.pool.select(manager.accounts, "cs").login == "a1"
+    assert manager.accounts["a0"].rental_count == 1 and manager.accounts["a0"].rented_hours == 2
+
+
+def test_pool_counts_follow_rent_and_return(srent):
+    manager = add_accounts(srent, 2)
+    assert manager.count_available("cs") == 2
+    assert manager.count_available("CS") == 2  # типы сравниваются нормализованными
+
+    _, _, _, rental = manager.rent_account(1, "u", 1, "cs")
+    assert manager.count_available("cs") == 1
+    manager.bulk_update(["a1"], "disable")
+    assert manager.count_available("cs") == 0
+    assert manager.get_available_account("cs") is None
+
+    manager.return_account(rental.id)
+    assert manager.count_available("cs") == 1
+
+
+def test_settle_returned_quarantines_unhealthy_account(srent):
+    manager = add_accounts(srent, 1)
+    _, _, account, rental = manager.rent_account(1, "u", 1, "cs")
+    account.health = srent.HEALTH_QUARANTINE_THRESHOLD - 1
+
+    manager.return_account(rental.id)
+
+    assert account.status == "quarantined"
+    assert "a0" in manager.quarantined
+    assert manager.pool.select(manager.accounts, "cs") is None
+    assert manager.count_available("cs") == 0
+
+
+def test_settle_returned_puts_healthy_account_back(srent):
+    manager = add_accounts(srent, 1)
+    account = manager.accounts["a0"]
+    account.status = "rented"
+    manager.pool.take("a0")
+
+    assert manager.settle_returned(account) is True
+    assert account.status == "available"
+    assert manager.pool.select(manager.accounts, "cs") is account
+
+
+def test_complaint_text_is_escaped_for_admin(srent, monkeypatch):
+    manager = add_accounts(srent, 1)
+    manager.rent_account(1, "<i>u</i>", 1, "cs")
+    sent = []
+    monkeypatch.setattr(srent, "notify_admin", lambda text, *args, **kwargs: sent.append(text))
+
+    srent.handle_buyer_command("проблема", 1, "<i>u</i>", 'не входит <a href="x">тут</a> & всё')
+
+    assert "&lt;i&gt;u&lt;/i&gt;" in sent[0]
+    assert "не входит &lt;a href=&quot;x&quot;&gt;тут&lt;/a&gt; &amp; всё" in sent[0]
+    assert "<a" not in sent[0]
+
+
+# Смена пароля через Steam
+
+def test_pending_rotation_keeps_returned_account_out_of_pool(srent, monkeypatch):
+    manager = add_accounts(srent, 1, api_key="key")
+    _, _, account, rental = manager.rent_account(1, "u", 1, "cs")
+
+    manager.return_account(rental.id)
+    assert account.pending_rotation
+    assert account.status == "rented" and account.rental_id is None
+    assert manager.get_available_account("cs") is None
+
+    monkeypatch.setattr(srent.Account, "change_password_via_api",
+                        lambda self, old, new: (True, "Пароль успешно изменен", new))
+    manager.process_rotation_queue()
+
+    assert account.pending_rotation is None and account.password != "origpw"
+    assert account.status == "available"
+    assert manager.get_available_account("cs") is account
+    assert not manager.rotation_queue
+
+
+def test_abandoned_rotation_quarantines_account(srent, monkeypatch):
+    manager = add_accounts(srent, 1, api_key="key")
+    calls = []
+    monkeypatch.setattr(srent.Account, "change_password_via_api",
+                        lambda self, old, new: calls.append("change") or (False, "Ошибка авторизации: captcha", None))
+    monkeypatch.setattr(srent.Account, "verify_password_via_api",
+                        lambda self, password: calls.append("verify") or False)
+    _, _, account, rental = manager.rent_account(1, "u", 1, "cs")
+
+    manager.return_account(rental.id)
+    for _ in range(srent.ROTATION_MAX_ATTEMPTS):
+        manager.process_rotation_queue()
+
+    # Каждое обращение к Steam, включая проверку входом, считается попыткой
+    assert len(calls) == srent.ROTATION_MAX_ATTEMPTS
+    assert account.pending_rotation is None
+    assert account.status == "quarantined"
+    assert "смену пароля" in account.quarantine["reason"]
+    assert manager.get_available_account("cs") is None
+    assert not manager.rotation_queue
+    assert not manager.rent_account(2, "next", 1, "cs")[0]
+
+
+def test_rotation_already_applied_is_confirmed_by_login(srent, monkeypatch):
+    account = srent.Account("a0", "old", api_key="key")
+    changes, logins = [], []
+    monkeypatch.setattr(srent.Account, "change_password_via_api",
+                        lambda self, old, new: changes.append((old, new)) or (False, "Ошибка авторизации: bad", None))
+    monkeypatch.setattr(srent.Account, "verify_password_via_api",
+                        lambda self, password: logins.append(password) or True)
+
+    assert account.change_password("new") == "new"
+
+    assert changes == [("old", "new")]
+    assert logins == ["new"]
+    assert account.pending_rotation is None
+
+
+def test_rotation_failure_without_auth_error_is_retried(srent):
+    account = srent.Account("a0", "old", api_key="key")
+
+    account.change_password("new")
+
+    assert account.password == "old"
+    assert account.pending_rotation["attempts"] == 1
+    assert account.resolve_pending_rotation() is False
+    assert account.pending_rotation["attempts"] == 2
+
+
+def read_saved_account(srent, login):
+    with open(srent.ACCOUNTS_FILE, encoding="utf-8") as f:
+        return json.load(f)[login]
+
+
+def test_force_return_writes_rotation_through_batch(srent, monkeypatch):
+    manager = add_accounts(srent, 1, api_key="key")
+    _, _, account, _ = manager.rent_account(1, "u", 1, "cs")
+    saved_before_steam = []
+    monkeypatch.setattr(srent.Account, "change_password_via_api",
+                        lambda self, old, new: saved_before_steam.append(read_saved_account(srent, "a0"))
+                        or (True, "Пароль успешно изменен", new))
+
+    with manager.batch():
+        _, success, _ = srent.force_return_job("a0", notify_buyer=False)
+        saved_after = read_saved_account(srent, "a0")
+
+    assert success
+    # Новый пароль на диске до обращения к Steam и подтвержден до ответа админу
+    assert saved_before_steam[0]["pending_rotation"]["new_password"] == account.password
+    assert saved_after["password"] == account.password and saved_after["pending_rotation"] is None
+
+
+def test_bulk_reset_writes_rotation_through_batch(srent, monkeypatch):
+    manager = add_accounts(srent, 1, api_key="key")
+    account = manager.accounts["a0"]
+    account.password = "rotated"
+    saved_before_steam = []
+    monkeypatch.setattr(srent.Account, "change_password_via_api",
+                        lambda self, old, new: saved_before_steam.append(read_saved_account(srent, "a0"))
+                        or (False, "Ошибка изменения пароля: 503", None))
+
+    with manager.batch():
+        _, success, _ = srent.reset_password_job("a0")
+        saved_after = read_saved_account(srent, "a0")
+
+    assert not success
+    assert saved_before_steam[0]["pending_rotation"]["new_password"] == "origpw"
+    assert saved_after["pending_rotation"]["attempts"] == 1
+
+
+# Индекс активных аренд
+
+def test_rental_index_follows_rent_extend_and_return_without_rebuild(srent, monkeypatch):
+    manager = add_accounts(srent, 3)
+    rebuilds = []
+    monkeypatch.setattr(manager._refresh_index(), "rebuild", lambda *args: rebuilds.append(args))
+
+    _, _, _, first = manager.rent_account(1, "u", 5, "cs", "ORDER1")
+    _, _, _, second = manager.rent_account(1, "u", 1, "cs")
+    _, _, _, other = manager.rent_account(2, "v", 3, "cs")
+    manager.extend_rental(second.id, 10)
+    manager.return_account(other.id)
+
+    assert manager.active_rentals_for_user(1) == [first, second]
+    assert manager.active_rentals_for_user(2) == []
+    assert manager.search_active_rentals() == [first, second]
+    assert manager.search_active_rentals("#order1") == [first]
+    assert manager.search_active_rentals("a") == [first, second]
+    assert not rebuilds
+
+
+def test_repurchase_finds_rental_by_buyer_and_type(srent):
+    manager = add_accounts(srent, 2)
+    _, _, _, rental = manager.rent_account(1, "u", 1, "cs")
+    manager.extend_rental(rental.id, 2)
+
+    assert manager.find_active_rental(1, "C.S") is rental
+    assert manager.find_active_rental(2, "cs") is None
+
+    manager.update_account(rental.account_login, type="dota")
+    assert manager.find_active_rental(1, "cs") is None
+    assert manager.find_active_rental(1, "dota") is rental
+
+
+def test_return_picker_escapes_search_query(srent):
+    manager = add_accounts(srent, 1)
+    manager.rent_account(1, "u", 1, "cs")
+    srent.get_return_picker(1)["query"] = "<a & b"
+
+    text = srent.build_return_picker(1)[0]
+
+    assert "<code>&lt;a &amp; b</code>" in text
+
+
+# Заказы на несколько аккаунтов
+
+def test_rent_accounts_rolls_back_partial_order(srent, monkeypatch):
+    manager = add_accounts(srent, 3)
+    rent_one = manager._rent_account
+    attempts = []
+
+    def fail_second(*args):
+        attempts.append(args)
+        if len(attempts) == 2:
+            return False, "Нет доступных аккаунтов", None, None
+        return rent_one(*args)
+
+    monkeypatch.setattr(manager, "_rent_account", fail_second)
+    success, _, issued = manager.rent_accounts(1, "u", 2, "cs", "ORDER1", 2)
+
+    assert not success and issued == []
+    assert not manager.rentals
+    assert manager.find_rental_by_order("ORDER1") is None
+    assert all(account.status == "available" and account.rental_count == 0 for account in manager.accounts.values())
+    assert manager.count_available("cs") == 3
+    assert srent.reminders.wheel.size == 0
+    assert not any(srent.demand.expiries.values())
+
+
+def test_rent_accounts_issues_all_units(srent):
+    manager = add_accounts(srent, 3)
+
+    success, _, issued = manager.rent_accounts(1, "u", 2, "cs", "ORDER1", 2)
+
+    assert success and len(issued) == 2
+    assert manager.count_available("cs") == 1
+    assert len(srent.demand.expiries["cs"]) == 2
+    assert not manager.rent_accounts(1, "u", 2, "cs", "ORDER2", 2)[0]
+
+
+@pytest.mark.parametrize("mode, accounts, hours", [
+    (None, 1, 2),        # привязки без режима выдают один аккаунт на срок привязки, как до учета количества
+    ("hours", 1, 6),
+    ("accounts", 3, 2),
+])
+def test_order_quantity_follows_binding_mode(srent, monkeypatch, mode, accounts, hours):
+    manager = add_accounts(srent, 3)
+    binding = {"account_type": "cs", "duration_hours": 2}
+    if mode:
+        binding["quantity_mode"] = mode
+    monkeypatch.setitem(srent.lot_bindings, "Аренда CS", binding)
+    order = SimpleNamespace(id="ORDER1", description="Аренда CS, Steam", buyer_id=1, buyer_username="u", amount=3)
+
+    srent.process_order(srent.CARDINAL, order)
+
+    rentals = manager.find_rentals_by_order("ORDER1")
+    assert len(rentals) == accounts
+    assert all(rental.duration_hours == hours for rental in rentals)
+
+
+def test_order_index_keeps_every_rental_of_an_order(srent):
+    manager = add_accounts(srent, 3)
+    _, _, issued = manager.rent_accounts(1, "u", 2, "cs", "ORDER1", 2)
+
+    rentals = [rental for _, rental in issued]
+    assert manager.find_rentals_by_order("#order1") == rentals
+    assert sorted(manager.search_active_rentals("#order1"), key=id) == sorted(rentals, key=id)
+
+    # Индекс старого формата (один rental_id на заказ) читается после перезапуска
+    with open(srent.ORDER_INDEX_FILE, "w", encoding="utf-8") as f:
+        json.dump({"order1": rentals[0].id}, f)
+    restored = srent.RentalManager()
+    assert [rental.id for rental in restored.find_rentals_by_order("ORDER1")] == [rental.id for rental in rentals]
+
+
+# Прогноз спроса
+
+def test_forecast_without_demand_expects_no_exhaustion(srent):
+    add_accounts(srent, 2)
+
+    forecast = srent.demand.forecast("cs")
+
+    assert forecast["rate"] == 0
+    assert forecast["available"] == 2
+    assert forecast["exhaustion_hours"] is None
+
+
+def test_forecast_counts_returns_within_hour(srent):
+    manager = add_accounts(srent, 3)
+    manager.rent_account(1, "u", 0.5, "cs")
+    manager.rent_account(1, "u", 5, "cs")
+
+    forecast = srent.demand.forecast("cs")
+
+    assert forecast["available"] == 1
+    assert forecast["returns_hour"] == 1
+
+
+@pytest.mark.parametrize("stock, rate, returns, expected", [
+    (1, 1.0, [], 1.0),           # последний свободный аккаунт уйдет через час, а не сразу
+    (0, 1.0, [], 0.0),           # свободных уже нет
+    (2, 1.0, [0.5], 3.0),        # возврат через полчаса отодвигает исчерпание на час
+    (1, 2.0, [1.0], 0.5),        # запас кончается раньше возврата
+    (30, 1.0, [], None),         # дальше горизонта прогноза
+    (1, 0.0, [], None),          # спроса нет
+])
+def test_forecast_exhaustion_crossing(srent, stock, rate, returns, expected):
+    hours = srent.DemandForecast.exhaustion_hours(stock, rate, returns)
+
+    assert hours == pytest.approx(expected) if expected is not None else hours is None
+
+
+def test_single_order_does_not_raise_exhaustion_alert(srent):
+    manager = add_accounts(srent, 2)
+    manager.rent_account(1, "u", 3, "cs")
+    srent.demand.record_order("cs", 3)
+
+    assert srent.demand.forecast("cs")["exhaustion_hours"] > srent.FORECAST_ALERT_HOURS
+    assert srent.demand.check_alert("cs") is False
+
+
+# Панель статуса
+
+def test_live_board_reads_accounts_under_lock(srent, monkeypatch):
+    manager = add_accounts(srent, 2)
+    manager.rent_account(1, "u", 1, "cs")
+
+    class LockedAccounts(dict):
+        # Без блокировки параллельное добавление аккаунта ломает обход словаря
+        def values(self):
+            assert manager.lock._is_owned()
+            return super().values()
+
+    monkeypatch.setattr(manager, "accounts", LockedAccounts(manager.accounts))
+    text, _ = srent.build_live_board_view()
+
+    assert "<b>CS</b>: 1 / 2" in text
+    assert "АРЕНДЫ:</b> 1 активных" in text
+
+
+# Сводка для администратора
+
+def test_long_digest_is_split_on_whole_lines(srent, monkeypatch):
+    monkeypatch.setattr(srent, "DIGEST_MODE", True)
+    sent = []
+    monkeypatch.setattr(srent, "notify_admin", lambda text, *args, **kwargs: sent.append(text))
+    for kind in srent.DIGEST_KINDS:
+        for index in range(srent.DIGEST_DETAIL_LINES):
+            srent.admin_digest.add(kind, f"{kind} {index}: <code>{'x' * 200}</code>", "")
+
+    assert srent.admin_digest.flush(force=True)
+
+    assert len(sent) > 1
+    assert all(len(part) <= 3900 and part.count("<code>") == part.count("</code>") for part in sent)
+    assert sum(part.count("<code>") for part in sent) == len(srent.DIGEST_KINDS) * srent.DIGEST_DETAIL_LINES
+
+
+# Трассировка
+
+def test_slowest_traces_escape_errors_and_cut_whole_lines(srent):
+    for index in range(20):
+        srent.tracer.traces.append({
+            "kind": "order", "key": f"#{index}<x>", "started": 0, "duration": 1 + index,
+            "spans": [(f"span_{span}", 0.1, 0.2) for span in range(12)],
+            "profile": None, "error": "ValueError: <bad> & broken",
+        })
+
+    srent.slowest_traces_cmd(SimpleNamespace(chat=SimpleNamespace(id=1), text="/srent_traces 20"))
+
+    _, text = srent.CARDINAL.telegram.bot.sent[-1]
+    assert len(text) <= 3900 and text.endswith("\n...")
+    assert "&lt;bad&gt; &amp; broken" in text and "<bad>" not in text
+    assert text.count("<b>") == text.count("</b>") and text.count("<code>") == text.count("</code>")
+
+
+# Колесо таймеров напоминаний
+
+def test_timing_wheel_fires_items_on_their_tick(srent):
+    wheel = srent.TimingWheel(tick=5, slots=12)
+    start = wheel.current * 5
+    wheel.schedule(start + 12, "soon")  # тик округляется вниз: срабатывает на отметке start + 10
+    wheel.schedule(start + 30, "later")
+    wheel.schedule(start - 100, "overdue")  # прошедшее время срабатывает на ближайшем тике
+
+    assert sorted(wheel.advance(start + 5)) == ["overdue"]
+    assert wheel.advance(start + 10) == ["soon"]
+    assert wheel.advance(start + 25) == []
+    assert wheel.advance(start + 30) == ["later"]
+    assert wheel.size == 0
+
+
+def test_timing_wheel_keeps_items_of_later_revolutions(srent):
+    wheel = srent.TimingWheel(tick=5, slots=12)
+    start = wheel.current * 5
+    # Через оборот колеса (60 с) элемент попадает в тот же слот, что и ближайший
+    wheel.schedule(start + 10, "first")
+    wheel.schedule(start + 70, "next revolution")
+
+    assert wheel.advance(start + 10) == ["first"]
+    assert wheel.advance(start + 65) == []
+    assert wheel.advance(start + 70) == ["next revolution"]
+
+
+def test_timing_wheel_catches_up_after_long_pause(srent):
+    wheel = srent.TimingWheel(tick=5, slots=12)
+    start = wheel.current * 5
+    wheel.schedule(start + 20, "a")
+    wheel.schedule(start + 55, "b")
+
+    assert sorted(wheel.advance(start + 3600)) == ["a", "b"]
+    assert wheel.size == 0
+
+
+# Очередь ожидания заказов
+
+def test_backorders_are_fulfilled_in_order(srent):
+    manager = srent.rental_manager
+    srent.backorders.add("ORDER1", 11, "first", "cs", 1)
+    srent.backorders.add("ORDER2", 12, "second", "cs", 1)
+    assert srent.backorders.pending("cs") == 2
+
+    manager.add_account("a0", "pw", "cs")
+    srent.backorders.drain()
+
+    assert manager.find_rental_by_order("ORDER1").username == "first"
+    assert manager.find_rental_by_order("ORDER2") is None
+    assert [entry["order_id"] for _, entry in srent.backorders.entries()] == ["ORDER2"]
+
+
+def test_backorder_waits_for_whole_order(srent):
+    manager = srent.rental_manager
+    manager.add_account("a0", "pw", "cs")
+    srent.backorders.add("ORDER1", 11, "first", "cs", 1, count=2)
+
+    srent.backorders.drain()
+
+    assert srent.backorders.contains("ORDER1")
+    assert not manager.rentals
+
+
+def test_backorder_queued_by_order_is_woken_after_release(srent, monkeypatch):
+    manager = add_accounts(srent, 1)
+    monkeypatch.setattr(srent, "RUNNING", True)
+    # Аккаунт освободился, пока заказ ставился в очередь
+    monkeypatch.setattr(srent, "process_order",
+                        lambda c, order: srent.backorders.add(order.id, 11, "first", "cs", 1))
+    monkeypatch.setattr(srent.backorders, "notify", srent.backorders.drain)
+
+    srent.order_handler(srent.CARDINAL, SimpleNamespace(order=SimpleNamespace(id="ORDER1")))
+
+    assert manager.find_rental_by_order("ORDER1").username == "first"
+    assert not srent.backorders.contains("ORDER1")
+
+
+def test_backorder_eta_uses_returns_of_its_type(srent):
+    manager = add_accounts(srent, 2)
+    manager.add_account("d0", "pw", "dota")
+    _, _, _, late = manager.rent_account(1, "u", 3, "cs")
+    _, _, _, early = manager.rent_account(2, "v", 1, "cs")
+    manager.rent_account(3, "w", 0.5, "dota")
+
+    assert manager.expected_return("CS", 1) == early.end_time
+    assert manager.expected_return("cs", 2) == late.end_time
+    assert manager.expected_return("cs", 3) is None
+    assert srent.backorders.add("ORDER1", 11, "first", "cs", 1)[1] == early.end_time
+
+
+def test_backorders_survive_restart(srent):
+    srent.backorders.add("ORDER1", 11, "first", "cs", 3)
+
+    restored = srent.BackorderQueue(srent.BACKORDERS_FILE)
+    restored.load()
+
+    assert restored.contains("#ORDER1")
+    assert restored.entries()[0][1]["duration_hours"] == 3
+
+
+# Коды Steam Guard
+
+RFC4226_SECRET = base64.b64encode(b"12345678901234567890").decode()
+
+
+def steam_code(value, chars):
+    # Пять символов алфавита Steam из 31-битного значения HOTP
+    code = ""
+    for _ in range(5):
+        value, index = divmod(value, len(chars))
+        code += chars[index]
+    return code
+
+
+@pytest.mark.parametrize("timestamp, truncated", [
+    (0, 1284755224),   # счетчик 0 из RFC 4226, приложение D
+    (59, 1094287082),  # счетчик 1
+    (60, 137359152),   # счетчик 2
+])
+def test_steam_guard_code_matches_rfc4226_vectors(srent, timestamp, truncated):
+    code = srent.generate_steam_guard_code(RFC4226_SECRET, timestamp)
+
+    assert code == steam_code(truncated, srent.STEAM_GUARD_CHARS)
+    assert len(code) == 5 and set(code) <= set(srent.STEAM_GUARD_CHARS)
+
+
+def test_steam_guard_code_is_stable_within_period(srent):
+    assert (srent.generate_steam_guard_code(RFC4226_SECRET, 30)
+            == srent.generate_steam_guard_code(RFC4226_SECRET, 59))
+
+
+@pytest.mark.parametrize("secret", ["not base64!", base64.b64encode(b"short").decode()])
+def test_steam_guard_rejects_bad_secret(srent, secret):
+    with pytest.raises(ValueError):
+        srent.decode_shared_secret(secret)
+
+
+# Метрики и экспорт Prometheus
+
+def test_metrics_render_counters_and_cumulative_histogram(srent):
+    metrics = srent.Metrics()
+    metrics.inc("steamrent_orders_total", result="ok")
+    metrics.inc("steamrent_orders_total", 2, result="ok")
+    metrics.inc("steamrent_orders_total", result='bad "lot"')
+    metrics.set_gauge("steamrent_accounts", 4, status="available")
+    for value in (0.03, 0.2, 0.2, 100):
+        metrics.observe("steamrent_order_seconds", value, buckets=(0.1, 1))
+
+    lines = metrics.render_prometheus().splitlines()
+
+    assert "# TYPE steamrent_orders_total counter" in lines
+    assert 'steamrent_orders_total{result="ok"} 3' in lines
+    assert 'steamrent_orders_total{result="bad \\"lot\\""} 1' in lines
+    assert "# TYPE steamrent_accounts gauge" in lines
+    assert 'steamrent_accounts{status="available"} 4' in lines
+    # Корзины накопительные, значение выше последней границы попадает только в +Inf
+    assert "# TYPE steamrent_order_seconds histogram" in lines
+    assert 'steamrent_order_seconds_bucket{le="0.1"} 1' in lines
+    assert 'steamrent_order_seconds_bucket{le="1"} 3' in lines
+    assert 'steamrent_order_seconds_bucket{le="+Inf"} 4' in lines
+    assert "steamrent_order_seconds_sum 100.430000" in lines
+    assert "steamrent_order_seconds_count 4" in lines
+    assert metrics.histogram_stats("steamrent_order_seconds") == (4, pytest.approx(25.1075), float("inf"))
+
+
+def test_metrics_dump_replaces_file_atomically(srent, tmp_path):
+    metrics = srent.Metrics()
+    metrics.inc("steamrent_expiries_total")
+    path = str(tmp_path / "metrics.prom")
+
+    assert metrics.dump(path) is True
+    assert metrics.dump(path) is True
+
+    assert "steamrent_expiries_total 1" in (tmp_path / "metrics.prom").read_text(encoding="utf-8").splitlines()
+    assert not (tmp_path / "metrics.prom.tmp").exists()
+    assert metrics.dump(str(tmp_path / "missing" / "metrics.prom")) is False